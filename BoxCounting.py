@@ -0,0 +1,488 @@
+"""
+Ethan Armstrong
+Section AD
+
+This module contains the NumPy routines used by the Fractal class to
+count the number of grid squares in an image that contain a foreground
+(non background) pixel
+"""
+
+import math
+import numpy as np
+
+
+def pixel_array(img):
+    """
+    pixel_array() | gets the pixel values of an image as a NumPy array,
+        using the same values PIL.Image.getdata() would produce
+    img     | (PIL.Image) image to read
+    returns | (np.ndarray) (h, w) for single band images,
+        (h, w, bands) otherwise
+    """
+    # "1" images are stored as bools by NumPy, but getdata() gives 0 / 255
+    if img.mode == "1":
+        img = img.convert("L")
+
+    return np.asarray(img)
+
+
+def most_frequent_color(img):
+    """
+    most_frequent_color() | gets the most occuring color in an image from
+        a single pass histogram of the image
+    img     | (PIL.Image) image to search
+    returns | pixel in the image format, either: int, (int,int,int),
+        (int, int, int, int)
+    """
+    colors = img.getcolors(maxcolors=img.width * img.height)
+    return max(colors, key=lambda pair: pair[0])[1]
+
+
+def border_color(img):
+    """
+    border_color() | gets the most occuring color along the outside edge of
+        an image, for images where the subject takes up most of the frame
+    img     | (PIL.Image) image to search
+    returns | pixel in the image format, either: int, (int,int,int),
+        (int, int, int, int)
+    """
+    arr = _pixel_rows(img)
+    border = np.concatenate([arr[0], arr[-1], arr[1:-1, 0], arr[1:-1, -1]])
+    return _most_frequent_pixel(border)
+
+
+def _pixel_rows(img):
+    """
+    _pixel_rows() | gets the pixel values of an image with a band axis,
+        even for single band images
+    img     | (PIL.Image) image to read
+    returns | (np.ndarray) (h, w, bands)
+    """
+    arr = pixel_array(img)
+    return arr.reshape(arr.shape[0], arr.shape[1], -1)
+
+
+def _most_frequent_pixel(pixels):
+    """
+    _most_frequent_pixel() | gets the most occuring pixel in a list of pixels
+    pixels  | (np.ndarray) (n, bands)
+    returns | pixel in the image format, either: int, (int,int,int),
+        (int, int, int, int)
+    """
+    colors, counts = np.unique(pixels, axis=0, return_counts=True)
+    pixel = colors[np.argmax(counts)].tolist()
+
+    return pixel[0] if len(pixel) == 1 else tuple(pixel)
+
+
+def most_frequent_luminance(img):
+    """
+    most_frequent_luminance() | gets the most occuring brightness in an image
+    img     | (PIL.Image) image to search
+    returns | (int) 0-255
+    """
+    histogram = img.convert("L").histogram()
+    return histogram.index(max(histogram))
+
+
+def luminance_mask(img, threshold, bckg):
+    """
+    luminance_mask() | builds a mask of every pixel on the other side of a
+        brightness threshold from the background
+    img       | (PIL.Image) image to build the mask of
+    threshold | (int) 0-255, pixels darker than this are "dark"
+    bckg      | (int) 0-255 brightness of the background
+    returns   | (np.ndarray) (h, w) of bools, True where there is foreground
+    """
+    dark = np.asarray(img.convert("L")) < threshold
+    if bckg < threshold:
+        return ~dark
+    return dark
+
+
+def foreground_mask(img, bckg):
+    """
+    foreground_mask() | builds a mask of every pixel that is not the
+        background color
+    img     | (PIL.Image) image to build the mask of
+    bckg    | pixel in the image format, either: int, (int,int,int),
+        (int, int, int, int)
+    returns | (np.ndarray) (h, w) of bools, True where there is foreground
+    """
+    arr = pixel_array(img)
+
+    if arr.ndim == 2:
+        return arr != bckg
+
+    bckg = np.asarray(bckg, dtype=arr.dtype)
+
+    # compare a whole RGBA pixel at once, by reading it as one 32 bit int
+    contiguous = arr.flags.c_contiguous
+    if arr.dtype == np.uint8 and arr.shape[2] == 4 and contiguous:
+        packed = arr.view(np.uint32).reshape(arr.shape[:2])
+        return packed != bckg.view(np.uint32)[0]
+
+    mask = arr[:, :, 0] != bckg[0]
+    for band in range(1, arr.shape[2]):
+        mask |= arr[:, :, band] != bckg[band]
+    return mask
+
+
+def box_occupancy(mask, size):
+    """
+    box_occupancy() | reduces a foreground mask to a grid of boxes, where
+        each box is True if any pixel inside of it is foreground. Boxes
+        on the right and bottom edges may be partial
+    mask    | (np.ndarray) (h, w) of bools
+    size    | (int) width and height of each box in pixels
+    returns | (np.ndarray) (ceil(h/size), ceil(w/size)) of bools
+    """
+    # or together every size-th row, then every size-th column, the last
+    # strided slice can be shorter than the first, which is a partial box
+    rows = mask[0::size].copy()
+    for offset in range(1, size):
+        part = mask[offset::size]
+        rows[:part.shape[0]] |= part
+
+    boxes = rows[:, 0::size].copy()
+    for offset in range(1, size):
+        part = rows[:, offset::size]
+        boxes[:, :part.shape[1]] |= part
+
+    return boxes
+
+
+def count_boxes(mask, size):
+    """
+    count_boxes() | counts the number of boxes that contain at least one
+        foreground pixel
+    mask    | (np.ndarray) (h, w) of bools
+    size    | (int) width and height of each box in pixels
+    returns | (int)
+    """
+    return int(np.count_nonzero(box_occupancy(mask, size)))
+
+
+def count_boxes_parallel(mask, size, executor, bands):
+    """
+    count_boxes_parallel() | counts the same boxes as count_boxes(), with
+        the mask split into bands of whole box rows that are counted at the
+        same time. NumPy releases the GIL while it works on the bands, so
+        threads can count them in parallel
+    mask     | (np.ndarray) (h, w) of bools
+    size     | (int) width and height of each box in pixels
+    executor | (concurrent.futures.Executor) runs the bands
+    bands    | (int) number of bands to split the mask into
+    returns  | (int)
+    """
+    h = mask.shape[0]
+    rows = math.ceil(math.ceil(h / bands) / size) * size
+
+    counts = executor.map(lambda y0: count_boxes(mask[y0:y0 + rows], size),
+                          range(0, h, rows))
+    return sum(counts)
+
+
+def occupancy_pyramid(mask):
+    """
+    occupancy_pyramid() | builds the box grids of a foreground mask for every
+        power of two box size, each level is the 2x2 OR of the level below
+        it, so the whole pyramid costs about 4/3 of one pass over the mask
+    mask    | (np.ndarray) (h, w) of bools
+    returns | list( (np.ndarray) ) level k is box_occupancy(mask, 2**k),
+        down to a single box
+    """
+    levels = [mask]
+    while levels[-1].shape[0] > 1 or levels[-1].shape[1] > 1:
+        levels.append(box_occupancy(levels[-1], 2))
+
+    return levels
+
+
+def pyramid_occupancy(pyramid, size):
+    """
+    pyramid_occupancy() | gets box_occupancy(mask, size) from the pyramid of
+        the mask, starting from the largest level whose box size divides
+        size, so power of two sizes are free
+    pyramid | list( (np.ndarray) ) from occupancy_pyramid()
+    size    | (int) width and height of each box in pixels, at least 1
+    returns | (np.ndarray) (ceil(h/size), ceil(w/size)) of bools
+    """
+    if size < 1:
+        raise ValueError(f"box size must be at least 1 pixel, got {size}")
+
+    # the largest power of two that divides size
+    level = min((size & -size).bit_length() - 1, len(pyramid) - 1)
+    rest = size >> level
+
+    if rest == 1:
+        return pyramid[level]
+    return box_occupancy(pyramid[level], rest)
+
+
+def foreground_coords(mask):
+    """
+    foreground_coords() | gets the position of every foreground pixel, for
+        masks that are mostly background this is far smaller than the mask
+    mask    | (np.ndarray) (h, w) of bools
+    returns | (np.ndarray, np.ndarray) ys, xs of ints in row major order
+    """
+    return np.divmod(np.flatnonzero(mask), mask.shape[1])
+
+
+def count_boxes_sparse(ys, xs, shape, size):
+    """
+    count_boxes_sparse() | counts the number of boxes that contain at least
+        one foreground pixel from the positions of the foreground pixels, so
+        the cost depends on the number of foreground pixels, not the area
+    ys      | (np.ndarray) rows of the foreground pixels
+    xs      | (np.ndarray) columns of the foreground pixels
+    shape   | (int, int) (h, w) of the mask the positions came from
+    size    | (int) (float) width and height of each box in pixels, at least
+        1, boxes are laid out the same as count_boxes_integral()
+    returns | (int)
+    """
+    if size < 1:
+        raise ValueError(f"box size must be at least 1 pixel, got {size}")
+    if len(ys) == 0:
+        return 0
+
+    col_edges = box_edges(shape[1], size)
+    if size == int(size):
+        rows = ys // int(size)
+        cols = xs // int(size)
+    else:
+        rows = np.searchsorted(box_edges(shape[0], size), ys, "right") - 1
+        cols = np.searchsorted(col_edges, xs, "right") - 1
+
+    cells = rows.astype(np.int64) * (len(col_edges) - 1) + cols
+    return int(np.unique(cells).size)
+
+
+def integral_image(mask):
+    """
+    integral_image() | builds the summed-area table of a foreground mask,
+        entry [y, x] is the number of foreground pixels above and to the
+        left of (x, y)
+    mask    | (np.ndarray) (h, w) of bools
+    returns | (np.ndarray) (h+1, w+1) of ints
+    """
+    h, w = mask.shape
+    dtype = np.int32 if h * w < 2**31 else np.int64
+
+    table = np.zeros((h + 1, w + 1), dtype=dtype)
+    np.cumsum(mask, axis=0, dtype=dtype, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def box_edges(length, size):
+    """
+    box_edges() | gets the pixel edges of a row of boxes, the last box is
+        partial when size does not divide length
+    length  | (int) number of pixels to cover
+    size    | (int) (float) width of each box in pixels, at least 1
+    returns | (np.ndarray) of ints, [0, ..., length]
+    """
+    n = math.ceil(length / size)
+    edges = np.floor(np.arange(n + 1) * size).astype(np.int64)
+    edges[-1] = length
+    return edges
+
+
+def count_boxes_integral(table, size):
+    """
+    count_boxes_integral() | counts the number of boxes that contain at least
+        one foreground pixel, using a summed-area table so each box costs
+        four lookups no matter how large it is
+    table   | (np.ndarray) summed-area table from integral_image()
+    size    | (int) (float) width and height of each box in pixels,
+        must be at least 1
+    returns | (int)
+    """
+    if size < 1:
+        raise ValueError(f"box size must be at least 1 pixel, got {size}")
+
+    h = table.shape[0] - 1
+    w = table.shape[1] - 1
+    ys = box_edges(h, size)[:, None]
+    xs = box_edges(w, size)[None, :]
+
+    sums = (table[ys[1:], xs[:, 1:]] - table[ys[:-1], xs[:, 1:]] -
+            table[ys[1:], xs[:, :-1]] + table[ys[:-1], xs[:, :-1]])
+    return int(np.count_nonzero(sums))
+
+
+def band_background(bands, strategy):
+    """
+    band_background() | detects the background of an image that is read a
+        band of rows at a time, giving the same result as most_frequent_color,
+        border_color or most_frequent_luminance on the whole image
+    bands    | iterable of (int, PIL.Image) (first row, band) from
+        ImageTools.read_bands()
+    strategy | (str) "frequent", "border" or "luminance"
+    returns  | see Fractal._get_background_color()
+    """
+    colors = {}
+    histogram = np.zeros(256, dtype=np.int64)
+    top = bottom = None
+    left = []
+    right = []
+
+    for y0, band in bands:
+        if strategy == "frequent":
+            pairs = band.getcolors(maxcolors=band.width * band.height)
+            for count, pixel in pairs:
+                colors[pixel] = colors.get(pixel, 0) + count
+        elif strategy == "luminance":
+            histogram += band.convert("L").histogram()
+        else:
+            arr = _pixel_rows(band)
+            if top is None:
+                top = arr[0]
+            bottom = arr[-1]
+            left.append(arr[:, 0])
+            right.append(arr[:, -1])
+
+    if strategy == "frequent":
+        return max(colors.items(), key=lambda pair: pair[1])[0]
+    if strategy == "luminance":
+        return int(np.argmax(histogram))
+
+    # the corners are already part of the top and bottom rows
+    left = np.concatenate(left)[1:-1]
+    right = np.concatenate(right)[1:-1]
+    return _most_frequent_pixel(np.concatenate([top, bottom, left, right]))
+
+
+def count_boxes_bands(bands, shape, sizes, to_mask):
+    """
+    count_boxes_bands() | counts the boxes that contain a foreground pixel
+        for many box sizes at once, reading the image a band of rows at a
+        time. A box that straddles two bands is carried over to the next
+        band, so it is only counted once
+    bands   | iterable of (int, PIL.Image) (first row, band) in order, from
+        ImageTools.read_bands()
+    shape   | (int, int) (h, w) of the whole image
+    sizes   | list( (int) (float) ) box sizes in pixels, at least 1
+    to_mask | function(PIL.Image) -> (np.ndarray) foreground mask of a band
+    returns | list( (int) ) number of boxes for each size, the same as
+        count_boxes_integral()
+    """
+    h, w = shape
+    row_edges = [box_edges(h, size) for size in sizes]
+    col_starts = [box_edges(w, size)[:-1] for size in sizes]
+    counts = [0] * len(sizes)
+
+    # the last (unfinished) row of boxes for each size, and its index
+    carry = [None] * len(sizes)
+    carry_row = [-1] * len(sizes)
+
+    for y0, band in bands:
+        mask = to_mask(band)
+        ys = np.arange(y0, y0 + mask.shape[0])
+
+        for i in range(len(sizes)):
+            cols = np.logical_or.reduceat(mask, col_starts[i], axis=1)
+
+            # or together the rows that fall in the same row of boxes
+            box_rows = np.searchsorted(row_edges[i], ys, side="right") - 1
+            starts = np.flatnonzero(np.diff(box_rows, prepend=-1))
+            boxes = np.logical_or.reduceat(cols, starts, axis=0)
+            box_rows = box_rows[starts]
+
+            if carry[i] is not None:
+                if box_rows[0] == carry_row[i]:
+                    boxes[0] |= carry[i]
+                else:
+                    counts[i] += int(np.count_nonzero(carry[i]))
+
+            counts[i] += int(np.count_nonzero(boxes[:-1]))
+            carry[i] = boxes[-1]
+            carry_row[i] = box_rows[-1]
+
+    for i in range(len(sizes)):
+        if carry[i] is not None:
+            counts[i] += int(np.count_nonzero(carry[i]))
+
+    return counts
+
+
+def segment_cells(starts, ends, size):
+    """
+    segment_cells() | finds every grid cell each line segment passes
+        through, by walking the segment from one grid line crossing to the
+        next (a DDA grid traversal), for all of the segments at once. Cells
+        a segment only touches at a corner are not included
+    starts  | (np.ndarray) (n, 2) x, y of the start of each segment
+    ends    | (np.ndarray) (n, 2) x, y of the end of each segment
+    size    | (float) width and height of each cell, cells are laid out
+        from (0, 0)
+    returns | (np.ndarray, np.ndarray) columns, rows of int64, a cell is
+        repeated once for each segment that passes through it
+    """
+    if size <= 0:
+        raise ValueError(f"cell size must be positive, got {size}")
+
+    starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=float).reshape(-1, 2)
+    deltas = ends - starts
+    n = len(starts)
+
+    # the position along each segment, from 0 to 1, of every grid line it
+    # crosses, each axis separately
+    segments = [np.arange(n), np.arange(n)]
+    ts = [np.zeros(n), np.ones(n)]
+    for axis in range(2):
+        first = np.floor(starts[:, axis] / size)
+        last = np.floor(ends[:, axis] / size)
+        crossings = np.abs(last - first).astype(np.int64)
+
+        segment = np.repeat(np.arange(n), crossings)
+        offsets = np.arange(crossings.sum()) - np.repeat(
+            np.cumsum(crossings) - crossings, crossings)
+        lines = np.minimum(first, last)[segment] + 1 + offsets
+        t = (lines * size - starts[segment, axis]) / deltas[segment, axis]
+
+        segments.append(segment)
+        ts.append(t)
+
+    # in order along each segment, each gap between two crossings is in one
+    # cell, found from the middle of the gap
+    segments = np.concatenate(segments)
+    ts = np.concatenate(ts)
+    order = np.lexsort((ts, segments))
+    segments = segments[order]
+    ts = ts[order]
+
+    gaps = (segments[1:] == segments[:-1]) & (ts[1:] > ts[:-1])
+    segment = segments[:-1][gaps]
+    middle = (ts[:-1][gaps] + ts[1:][gaps]) / 2
+    points = starts[segment] + deltas[segment] * middle[:, np.newaxis]
+
+    # a segment of length 0 has no gaps, it is in the cell of its start
+    still = ~np.any(deltas, axis=1)
+    points = np.concatenate([points, starts[still]])
+
+    cells = np.floor(points / size).astype(np.int64)
+    return cells[:, 0], cells[:, 1]
+
+
+def count_boxes_segments(starts, ends, size):
+    """
+    count_boxes_segments() | counts the number of boxes that a set of line
+        segments, such as the edges of a polygon, pass through, without
+        drawing them
+    starts  | (np.ndarray) (n, 2) x, y of the start of each segment, which
+        must not be negative
+    ends    | (np.ndarray) (n, 2) x, y of the end of each segment
+    size    | (float) width and height of each box, boxes are laid out from
+        (0, 0)
+    returns | (int)
+    """
+    cols, rows = segment_cells(starts, ends, size)
+    if len(cols) == 0:
+        return 0
+
+    cells = rows * (int(cols.max()) + 1) + cols
+    return int(np.unique(cells).size)
@@ -0,0 +1,217 @@
+"""
+Ethan Armstrong
+Section AD
+
+This module classifies images from their box counting signature, the box
+count at each scale and the line fit to the log-log counts, with a logistic
+regression written in NumPy. It is a much cheaper alternative to the CNN in
+ml.py for telling hand drawn and generated images apart
+
+    python3 BoxSignature.py [--jobs N]
+"""
+
+import math
+import time
+import argparse
+import numpy as np
+from Fractal import analyze_many, fit_line
+from ResultCache import ResultCache
+from TensorCache import TensorCache, split_indices
+
+# the scales each image is counted at, "integral" counts boxes on the
+# original image, so no image is resized
+SCALES = (0.1, 1, 0.1)
+METHOD = "integral"
+
+
+def signature(data):
+    """
+    signature() | gets the feature vector of an image from its counts
+    data    | list( (float, int) ) [(factor, count), ...] from
+        Fractal.get_last_scaling_data()
+    returns | (np.ndarray) log count at each scale, then the slope,
+        intercept and r squared of the line fit to the log-log counts, then
+        the residual of each count from the line
+    """
+    logs = [(math.log(factor), math.log(max(count, 1)))
+            for factor, count in data]
+    fit = fit_line(logs)
+
+    x = np.array([point[0] for point in logs])
+    y = np.array([point[1] for point in logs])
+    residuals = y - (fit.slope * x + fit.intercept)
+
+    return np.concatenate([y, [fit.slope, fit.intercept, fit.r_squared],
+                           residuals])
+
+
+def get_signatures(paths, jobs=None, cache=None):
+    """
+    get_signatures() | counts every image and gets its signature
+    paths   | list( (str) ) paths to the images
+    jobs    | (int) (default = one per cpu) images counted at the same time
+    cache   | (ResultCache) (default = None) cache of previous counts
+    returns | (np.ndarray) (n, features) one row per path, a row of NaN if
+        the image could not be counted
+    """
+    rows = {}
+    for path, power, diagnostics in analyze_many(
+            paths, jobs, start=SCALES[0], stop=SCALES[1], inc=SCALES[2],
+            method=METHOD, cache=cache):
+        if diagnostics["data"] is None:
+            print(path, diagnostics["error"])
+            continue
+        rows[path] = signature(diagnostics["data"])
+
+    width = len(next(iter(rows.values()))) if rows else 0
+    features = np.full((len(paths), width), np.nan)
+    for i, path in enumerate(paths):
+        if path in rows:
+            features[i] = rows[path]
+    return features
+
+
+class LogisticRegression:
+    """
+    A binary logistic regression with an L2 penalty, fit with Newton's
+    method. Features are standardized with the mean and standard deviation
+    of the training data
+    """
+    def __init__(self, l2=1.0, iterations=25, tolerance=1e-8) -> None:
+        """
+        LogisticRegression() | creates an unfit model
+        l2         | (float) (default = 1.0) penalty on the squared weights,
+            the intercept is not penalized
+        iterations | (int) (default = 25) most Newton steps to take
+        tolerance  | (float) (default = 1e-8) stop once no weight changes by
+            more than this
+        """
+        self._l2 = l2
+        self._iterations = iterations
+        self._tolerance = tolerance
+        self._mean = None
+        self._std = None
+        self._weights = None
+
+    def _design(self, features):
+        """
+        _design() | standardizes features and adds a column of ones for the
+            intercept
+        features | (np.ndarray) (n, features)
+        returns  | (np.ndarray) (n, features + 1)
+        """
+        scaled = (np.asarray(features, dtype=float) - self._mean) / self._std
+        return np.hstack([np.ones((len(scaled), 1)), scaled])
+
+    def fit(self, features, labels):
+        """
+        fit() | fits the model
+        features | (np.ndarray) (n, features)
+        labels   | (np.ndarray) (n) of 0 or 1
+        returns  | (LogisticRegression) this model
+        """
+        features = np.asarray(features, dtype=float)
+        labels = np.asarray(labels, dtype=float)
+        self._mean = features.mean(axis=0)
+        # a constant feature is left at 0 instead of dividing by 0
+        self._std = features.std(axis=0)
+        self._std[self._std == 0] = 1
+
+        x = self._design(features)
+        penalty = np.full(x.shape[1], self._l2)
+        penalty[0] = 0
+        weights = np.zeros(x.shape[1])
+
+        for _ in range(self._iterations):
+            p = 1 / (1 + np.exp(-(x @ weights)))
+            gradient = x.T @ (p - labels) + penalty * weights
+            hessian = (x.T * (p * (1 - p))) @ x + np.diag(penalty)
+            step = np.linalg.lstsq(hessian, gradient, rcond=None)[0]
+            weights -= step
+            if np.abs(step).max() < self._tolerance:
+                break
+
+        self._weights = weights
+        return self
+
+    def predict_proba(self, features):
+        """
+        predict_proba() | gets the probability of label 1 for each row
+        features | (np.ndarray) (n, features)
+        returns  | (np.ndarray) (n) of floats
+        """
+        if self._weights is None:
+            raise ValueError("the model has not been fit")
+        return 1 / (1 + np.exp(-(self._design(features) @ self._weights)))
+
+    def predict(self, features):
+        """
+        predict() | gets the most likely label of each row
+        features | (np.ndarray) (n, features)
+        returns  | (np.ndarray) (n) of 0 or 1
+        """
+        return (self.predict_proba(features) >= 0.5).astype(np.int64)
+
+
+def evaluate(source="images", jobs=None, cache=None, validation_split=0.2,
+             seed=123):
+    """
+    evaluate() | trains and validates the signature classifier on the same
+        split of the images as ml.py
+    source           | (str) (default = "images") directory of images, one
+        sub directory per label
+    jobs             | (int) (default = one per cpu) images counted at once
+    cache            | (ResultCache) (default = None) cache of counts
+    validation_split | (float) (default = 0.2) see split_indices()
+    seed             | (int) (default = 123) see split_indices()
+    returns | (dict) "accuracy" on the validation images, "train_seconds"
+        to count the training images and fit, "inference_seconds" to count
+        and classify the validation images (only cache lookups for images
+        already in the cache), "images" validated, "skipped" images that
+        could not be counted
+    """
+    paths, labels, classes = TensorCache(source, None).get_images()
+    if len(classes) != 2:
+        raise ValueError(f"expected 2 labels, got {classes}")
+    train, validate = split_indices(len(paths), validation_split, seed)
+
+    start = time.perf_counter()
+    train_features = get_signatures([paths[i] for i in train], jobs, cache)
+    counted = ~np.isnan(train_features).any(axis=1)
+    if not counted.any():
+        raise ValueError("none of the training images could be counted")
+    model = LogisticRegression().fit(train_features[counted],
+                                     labels[train][counted])
+    train_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    features = get_signatures([paths[i] for i in validate], jobs, cache)
+    valid = ~np.isnan(features).any(axis=1)
+    if not valid.any():
+        raise ValueError("none of the validation images could be counted")
+    predictions = model.predict(features[valid])
+    inference_seconds = time.perf_counter() - start
+
+    return {
+        "accuracy": float(np.mean(predictions == labels[validate][valid])),
+        "train_seconds": train_seconds,
+        "inference_seconds": inference_seconds,
+        "images": int(valid.sum()),
+        "skipped": int((~counted).sum() + (~valid).sum()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--jobs", type=int, default=None)
+    args = parser.parse_args()
+
+    result = evaluate(jobs=args.jobs,
+                      cache=ResultCache("results_cache.sqlite"))
+    print(f"accuracy {result['accuracy']:.1%} on {result['images']} images")
+    print(f"train {result['train_seconds']:.2f} s, "
+          f"inference {result['inference_seconds']:.2f} s")
+
+
+if "__main__" in __name__:
+    main()
@@ -0,0 +1,129 @@
+"""
+Ethan Armstrong
+Section AD
+
+This module contains the DedupeIndex class, an index of perceptual hashes
+that finds near-duplicate images without comparing every pair, so duplicates
+in a dataset can be skipped before they are analyzed
+"""
+
+from PIL import Image
+from ImageTools import perceptual_hash, hash_distance
+
+# the most bits two perceptual hashes can differ by for their images to be
+# near-duplicates
+MAX_DISTANCE = 5
+
+
+class DedupeIndex:
+    """
+    A BK-tree of perceptual hashes. Each child of a node is stored under
+    its distance to the node, so a search only visits the children whose
+    distance could be within range of the hash it is looking for
+    """
+    def __init__(self) -> None:
+        """
+        DedupeIndex() | creates an empty index
+        """
+        # each node is [key, hash, {distance: node}]
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key, image_hash):
+        """
+        add() | adds a hash to the index
+        key        | the value returned by find() for this hash, such as a
+            path
+        image_hash | (int) hash from ImageTools.perceptual_hash()
+        returns    | None
+        """
+        self._size += 1
+        node = [key, image_hash, {}]
+        if self._root is None:
+            self._root = node
+            return
+
+        parent = self._root
+        while True:
+            distance = hash_distance(image_hash, parent[1])
+            if distance not in parent[2]:
+                parent[2][distance] = node
+                return
+            parent = parent[2][distance]
+
+    def find(self, image_hash, max_distance=MAX_DISTANCE):
+        """
+        find() | finds every hash in the index within max_distance bits of
+            image_hash
+        image_hash   | (int) hash from ImageTools.perceptual_hash()
+        max_distance | (int) (default = MAX_DISTANCE) most bits that may
+            differ
+        returns | list( (int, key) ) (distance, key), closest first
+        """
+        found = []
+        nodes = [self._root] if self._root is not None else []
+
+        while nodes:
+            key, node_hash, children = nodes.pop()
+            distance = hash_distance(image_hash, node_hash)
+            if distance <= max_distance:
+                found.append((distance, key))
+
+            # by the triangle inequality, any match is under a child whose
+            # distance is within max_distance of this node's distance
+            for child_distance, child in children.items():
+                if abs(child_distance - distance) <= max_distance:
+                    nodes.append(child)
+
+        return sorted(found, key=lambda pair: pair[0])
+
+    def add_if_new(self, key, image_hash, max_distance=MAX_DISTANCE):
+        """
+        add_if_new() | adds a hash to the index, unless it is a
+            near-duplicate of a hash already in it
+        key          | the value returned by find() for this hash
+        image_hash   | (int) hash from ImageTools.perceptual_hash()
+        max_distance | (int) (default = MAX_DISTANCE) most bits that may
+            differ for a near-duplicate
+        returns | key of the closest near-duplicate, None if it was added
+        """
+        found = self.find(image_hash, max_distance)
+        if found:
+            return found[0][1]
+
+        self.add(key, image_hash)
+        return None
+
+
+def find_duplicates(paths, max_distance=MAX_DISTANCE, group=None):
+    """
+    find_duplicates() | finds the images that are near-duplicates of an
+        earlier image in paths, each image is only hashed once and looked up
+        in a DedupeIndex, instead of being compared to every other image
+    paths        | list( (str) ) paths to the images, in order of preference
+    max_distance | (int) (default = MAX_DISTANCE) most bits that may differ
+        between the perceptual hashes of near-duplicates
+    group        | function(str) (default = None) gets the group of a path,
+        images are only duplicates of images in the same group, None puts
+        every image in one group
+    returns | (dict) path of each duplicate -> path of the image it
+        duplicates
+    """
+    indexes = {}
+    duplicates = {}
+
+    for path in paths:
+        with Image.open(path) as img:
+            image_hash = perceptual_hash(img)
+
+        key = None if group is None else group(path)
+        index = indexes.setdefault(key, DedupeIndex())
+
+        original = index.add_if_new(path, image_hash, max_distance)
+        if original is not None:
+            duplicates[path] = original
+
+    return duplicates
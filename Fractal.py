@@ -12,10 +12,29 @@ our various datasets through the Fractal Algorithim
 import io
 import os
 import math
+import time
+import atexit
+import weakref
 from PIL import Image
-from multiprocessing import Process, Array
+import numpy as np
+from collections import namedtuple
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, Process, Pipe, connection, shared_memory
 from matplotlib import pyplot as plt
-from ImageTools import scaleImage
+from ImageTools import scaleImage, read_bands
+from ResultCache import ResultCache, hash_file
+from Metrics import PhaseTimer, image_bytes
+from PackedMask import PackedMask
+from DedupeIndex import find_duplicates
+from BoxCounting import (foreground_mask, box_occupancy, count_boxes,
+                         count_boxes_parallel,
+                         integral_image, count_boxes_integral,
+                         occupancy_pyramid, pyramid_occupancy,
+                         foreground_coords, count_boxes_sparse,
+                         most_frequent_color, border_color,
+                         most_frequent_luminance, luminance_mask,
+                         band_background, count_boxes_bands)
 
 
 class Fractal:
@@ -28,36 +47,149 @@ class Fractal:
         Fractal() | creates a new Fractal object
         path | (str) full path to image this object will represent
         """
-        self._img = Image.open(path)
+        self._path = path
+        # decoded on first use, see Fractal._img
+        self._image = None
+        self._header = None
+        self._reduced = None
+        self._reduction = 1
         self._sample_size = 2
+        self._engine = "auto"
+        self._mask = None
+        self._density = None
+        self._coords = None
+        self._integral = None
+        self._pyramid = None
+        self._pyramid_counts = {}
+        self._memory_budget = 256 * 1024**2
+
+        self._background_strategy = "frequent"
+        self._luminance_threshold = 128
+        self._background = None
+
+        self._shared = None
+        self._shared_free = None
+        self._hash = None
 
         self._vis_img = None
         self._power_vis = None
+        self._last_fit = None
+        self._last_data = None
+        self._last_metrics = None
 
         self._OVERLAY_COLOR = (255, 255, 0, 100)
 
+    @property
+    def _img(self):
+        """
+        _img | (PIL.Image) the original image, it is decoded the first time
+            it is used, and the file is closed once it is decoded
+        """
+        if self._image is None:
+            self._image = self._decode()
+
+        return self._image
+
+    @_img.setter
+    def _img(self, img):
+        self._image = img
+
+    def _decode(self, reduction=1):
+        """
+        _decode() | decodes the image file, optionally at a reduced size.
+            JPEGs are decoded straight to 1/2, 1/4 or 1/8 size (Image.draft)
+            and any reduction left is done with Image.reduce(), "1" and "P"
+            images can not be reduced and are always decoded whole
+        reduction | (int) (default = 1) divide the width and height by this
+        returns   | (PIL.Image)
+        """
+        img = Image.open(self._path)
+        if reduction == 1 or img.mode in ("1", "P"):
+            img.load()
+            return img
+
+        w = img.width
+        img.draft(img.mode, (w // reduction, img.height // reduction))
+        img.load()
+
+        rest = img.width * reduction // w
+        if rest > 1:
+            img = img.reduce(rest)
+        return img
+
+    def _get_header(self):
+        """
+        _get_header() | gets the size and mode of the original image from
+            the file header, without decoding it
+        returns | ((int, int), str) (w, h), mode
+        """
+        if self._header is None:
+            with Image.open(self._path) as img:
+                self._header = (img.size, img.mode)
+
+        return self._header
+
+    def release(self):
+        """
+        release() | frees the decoded pixels of the image, its copy in
+            shared memory, and every image sized array made from it (the
+            mask, foreground coordinates, integral image and pyramid),
+            called at the end of Fractal.calculate_power(release=True). They
+            are made again if they are needed, only the background, foreground
+            density and pyramid counts are kept
+        returns | None
+        """
+        self._image = None
+        self._reduced = None
+        self._reduction = 1
+        self._mask = None
+        self._coords = None
+        self._integral = None
+        self._pyramid = None
+        self._free_shared_image()
+
     def _get_background_color(self, img):
         """
         _get_background_color() | gets the background color of an image
-            using the assumption that the background color is the most
-            occuring color
+            using the current background strategy:
+            "frequent"  | the most occuring color
+            "border"    | the most occuring color along the image edges
+            "luminance" | the most occuring brightness
         return | pixel in the image format, either: int, (int,int,int),
-            (int, int, int, int) from 0-255
+            (int, int, int, int) from 0-255, or (int) brightness 0-255
+            for "luminance"
         """
-        data = list(img.getdata())
-        pixels = {}
+        if self._background_strategy == "border":
+            return border_color(img)
+        if self._background_strategy == "luminance":
+            return most_frequent_luminance(img)
+        return most_frequent_color(img)
 
-        for pixel in data:
-            if pixel not in pixels:
-                pixels[pixel] = 0
-            pixels[pixel] += 1
+    def _get_background(self):
+        """
+        _get_background() | gets the background of the original image (or
+            its reduced decode, if scaled copies are made from one), it is
+            only detected once and reused for every scaled copy
+        return | see _get_background_color()
+        """
+        if self._background is None:
+            img = self._get_scale_source()
+            self._background = self._get_background_color(img)
 
-        pixel_freq = None
-        for pixel, count in pixels.items():
-            if pixel_freq is None or count > pixels[pixel]:
-                pixel_freq = pixel
+        return self._background
 
-        return pixel_freq
+    def _get_foreground_mask(self, img):
+        """
+        _get_foreground_mask() | builds a mask of every pixel in img that is
+            not part of the background of the original image
+        img     | (PIL.Image) the original image, or a scaled copy of it
+        returns | (np.ndarray) (h, w) of bools, True where there is foreground
+        """
+        bckg = self._get_background()
+
+        if self._background_strategy == "luminance":
+            return luminance_mask(img, self._luminance_threshold, bckg)
+        return foreground_mask(img, bckg)
 
     def _get_square_indicies(self, img, x, y):
         """
@@ -88,12 +220,124 @@ class Fractal:
             the counting algorithim
         returns | (int) | saves visualzation in Fractal._vis_image
         """
-        bckg = self._get_background_color(img)
+        # compared with _image, reading _img would decode the original
+        engine = self._get_engine(img is self._image)
+        if engine == "python":
+            return self._count_non_background_pixels_loop(img, generate_image)
+
+        if engine == "sparse" and not generate_image:
+            if img is self._image:
+                ys, xs = self._get_foreground_coords()
+            else:
+                ys, xs = foreground_coords(self._get_foreground_mask(img))
+            return count_boxes_sparse(ys, xs, (img.height, img.width),
+                                      self._sample_size)
+
+        # the original image is counted from its cached pyramid
+        if img is self._image:
+            if not generate_image:
+                return self._count_pyramid(self._sample_size)
+            boxes = self._get_occupancy(self._sample_size)
+            self._vis_img = self._draw_boxes(img, boxes)
+            return int(np.count_nonzero(boxes))
+
+        mask = self._get_foreground_mask(img)
+        if not generate_image:
+            threads = _get_thread_count()
+            if threads == 1 or mask.size < _MIN_THREAD_PIXELS:
+                return count_boxes(mask, self._sample_size)
+            return count_boxes_parallel(mask, self._sample_size,
+                                        _get_thread_pool(), threads)
+
+        boxes = box_occupancy(mask, self._sample_size)
+        self._vis_img = self._draw_boxes(img, boxes)
+        return int(np.count_nonzero(boxes))
+
+    def _get_engine(self, original=False):
+        """
+        _get_engine() | gets the counting engine to use, "auto" picks
+            "sparse" for the original image when less than _SPARSE_DENSITY
+            of it is foreground, and "numpy" otherwise. Scaled copies are
+            always "numpy", their foreground would have to be found from a
+            full mask for every copy, so "sparse" is only faster on the
+            original, whose positions are found once for every box size
+        original | (bool) (default = False) if the original image is counted
+        returns  | (str) "numpy", "python" or "sparse"
+        """
+        if self._engine != "auto":
+            return self._engine
+        if not original:
+            return "numpy"
+
+        if self._density is None:
+            mask = self._get_packed_mask()
+            h, w = mask.get_shape()
+            self._density = mask.count() / (h * w)
+
+        return "sparse" if self._density < _SPARSE_DENSITY else "numpy"
+
+    def _get_packed_mask(self):
+        """
+        _get_packed_mask() | gets the foreground mask of the original image
+            packed one bit per pixel, it is only built once per Fractal and
+            every other view of the original image is built from it
+        returns | (PackedMask)
+        """
+        if self._mask is None:
+            self._mask = PackedMask.pack(self._get_foreground_mask(self._img))
+
+        return self._mask
+
+    def _get_foreground_coords(self):
+        """
+        _get_foreground_coords() | gets the position of every foreground
+            pixel in the original image, they are only found once per Fractal
+        returns | (np.ndarray, np.ndarray) ys, xs
+        """
+        if self._coords is None:
+            self._coords = self._get_packed_mask().nonzero()
+
+        return self._coords
+
+    def _draw_boxes(self, img, boxes):
+        """
+        _draw_boxes() | blends the overlay color into every pixel of every
+            box that contains a non background pixel
+        img     | (PIL.Image) Image that was counted
+        boxes   | (np.ndarray) grid of bools from box_occupancy()
+        returns | (PIL.Image) RGBA
+        """
+        size = self._sample_size
+
+        # expand each box back to the pixels it covers
+        covered = boxes.repeat(size, axis=0).repeat(size, axis=1)
+        covered = covered[:img.height, :img.width]
+
+        pixels = np.array(img.convert("RGBA"))
+        alpha = self._OVERLAY_COLOR[3]
+        color = np.array(self._OVERLAY_COLOR[:3], dtype=np.int32)
+
+        # mix overlay color with image base color
+        base = pixels[covered][:, :3].astype(np.int32)
+        mixed = (base*(255-alpha) + color*alpha) // 255
+        pixels[covered] = np.column_stack([mixed, np.full(len(mixed), 255)])
+
+        return Image.fromarray(pixels, "RGBA")
 
+    def _count_non_background_pixels_loop(self, img, generate_image=False):
+        """
+        _count_non_background_pixels_loop() | counts the number of regions
+            that contain a non background pixel one square at a time,
+            this is the original (slow) counting engine
+        img            | (PIL.Image) Image to count pixels of
+        generate_image | (bool) (default = False), whether or not to visualize
+            the counting algorithim
+        returns | (int) | saves visualzation in Fractal._vis_image
+        """
         if generate_image:
             self._vis_img = img.copy().convert("RGBA")
 
-        data = list(img.getdata())
+        data = self._get_foreground_mask(img).ravel().tolist()
         w = img.width
         h = img.height
 
@@ -107,8 +351,7 @@ class Fractal:
                 # non-bckg pixel
                 containsPixel = False
                 for index in indexes:
-                    pixel = data[index]
-                    if pixel != bckg:
+                    if data[index]:
                         containsPixel = True
 
                 if containsPixel:
@@ -165,6 +408,41 @@ class Fractal:
             if start >= stop:
                 return out
 
+    def _range_geometric(self, start, stop, count):
+        """
+        _range_geometric() | gets count numbers from start to stop, each a
+            constant ratio larger than the last
+        start | (float) starting value (inclusive)
+        stop  | (float) ending value   (exclusive)
+        count | (int) number of values
+        returns | list( (float) )
+        """
+        ratio = (stop / start) ** (1 / count)
+        return [start * ratio**i for i in range(count)]
+
+    def _scale_count(self, factor, timer=None):
+        """
+        _scale_count() | performs one step in the Hausdorff algorithm
+            by scaling an image by a factor then counting the number of pixels
+        factor  | (float) factor to scale by
+        timer   | (PhaseTimer) (default = None) measures the "resize" and
+            "count" phases
+        returns | (float, int) factor, count
+        """
+        phase = _no_phase if timer is None else timer.phase
+
+        # factors are relative to the original size, even when the image
+        # was decoded at a reduced size
+        w, h = self._get_header()[0]
+        with phase("resize"):
+            scaledImg = scaleImage(self._get_scale_source(),
+                                   (w*factor, h*factor))
+            if timer is not None:
+                timer.allocated(image_bytes(scaledImg))
+        with phase("count"):
+            count = self._count_non_background_pixels(scaledImg)
+        return factor, count
+
     def _scale_count_process(self, factor, array):
         """
         _scale_count_process() | performs one step in the Hausdorff algorithm
@@ -174,113 +452,384 @@ class Fractal:
         array   | (multiprocessing.Array) shared memory to act as output
         returns | None | adds data to array [(float) factor, (float), count]
         """
-        w, h = self._img.size
-        scaledImg = scaleImage(self._img, (w*factor, h*factor))
-        count = self._count_non_background_pixels(scaledImg)
-
-        array[0] = factor
-        array[1] = count
+        array[0], array[1] = self._scale_count(factor)
         return None
 
-    def _get_scaling_data_process(self, start, stop, inc, verbose=False):
+    def _get_settings(self):
+        """
+        _get_settings() | gets everything a worker process needs to count
+            a scaled copy of the image, other than the image itself
+        returns | (dict) attribute name -> value
+        """
+        self._get_header()
+        settings = {name: getattr(self, name) for name in _WORKER_SETTINGS}
+
+        # decide on the engine here, so each worker does not have to
+        settings["_engine"] = self._get_engine()
+        return settings
+
+    def _get_scale_source(self):
+        """
+        _get_scale_source() | gets the image scaled copies are made from
+        returns | (PIL.Image) the original image, or a reduced decode of it
+            (see _set_scale_reduction())
+        """
+        if self._reduced is None:
+            return self._img
+        return self._reduced
+
+    def _set_scale_reduction(self, reduction):
+        """
+        _set_scale_reduction() | decodes the image at a reduced size for
+            making scaled copies from, when no factor is larger than
+            1 / reduction the full size is not needed
+        reduction | (int) divide the width and height by this, 1 uses the
+            original image
+        returns   | None
+        """
+        if reduction == self._reduction:
+            return
+
+        self._free_shared_image()
+        self._reduction = reduction
+        self._reduced = None if reduction == 1 else self._decode(reduction)
+
+    def _get_shared_image(self):
+        """
+        _get_shared_image() | copies the pixels scaled copies are made from
+            into shared memory, only done once until the image is released.
+            The memory is freed when the Fractal is released or garbage
+            collected
+        returns | (tuple) handle to pass to _attach_shared_image()
+        """
+        if self._shared is None:
+            img = self._get_scale_source()
+            arr = np.asarray(img)
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[...] = arr
+
+            self._shared = (shm.name, arr.shape, arr.dtype.str, img.mode)
+            self._shared_free = weakref.finalize(self, _free_shared_memory,
+                                                 shm)
+
+        return self._shared
+
+    def _free_shared_image(self):
+        """
+        _free_shared_image() | frees the copy of the image in shared memory
+        returns | None
+        """
+        if self._shared_free is not None:
+            self._shared_free()
+        self._shared = None
+        self._shared_free = None
+
+    def _get_scaling_data_process(self, start, stop, inc, verbose=False,
+                                  timer=None):
         """
         _get_scaling_data_process() | gets the scaling data for the fractal
-            in a bunch of background processes. Scaling from start to stop,
-            with an increment of inc
+            using the shared pool of worker processes. Scaling from start to
+            stop, with an increment of inc. The workers read the image from
+            shared memory, and are only sent the factor and a handle to it
         start | (float) starting scale (inclusive)
         stop  | (float) ending scale   (exclusive)
         inc   | (float) amount to increment by
+        timer | (PhaseTimer) (default = None) measures the "background",
+            "pool", "resize" and "count" phases, phases run by the workers
+            add up their time
+        returns | list( (float, int) ) [(factor, count), ...]
         """
+        phase = _no_phase if timer is None else timer.phase
         factors = self._range_float(start, stop, inc)
-        procs = []
-        for factor in factors:
-            arr = Array('d', range(2))
-            p = Process(target=self._scale_count_process, args=(factor, arr))
-            p.start()
 
-            procs.append((p, arr))
+        # detect the background once, so every worker reuses it
+        with phase("background"):
+            self._get_background()
+
+        workers = _get_worker_count()
+        if timer is not None:
+            timer.set_workers(workers)
+
+        if workers == 1:
+            points = (self._scale_count(factor, timer) for factor in factors)
+        else:
+            # the shared memory is created before the pool starts, so the
+            # workers share this process's resource tracker
+            with phase("pool"):
+                shared = self._get_shared_image()
+                pool = _get_pool()
+            settings = self._get_settings()
+            timed = timer is not None
+            jobs = [(shared, settings, factor, timed) for factor in factors]
+            points = pool.imap(_scale_count_worker, jobs)
 
         if verbose:
-            print("All Processes Started")
-        i = 0
+            print("All Jobs Submitted")
         data = []
-        for proc in procs:
-            proc[0].join()
-            arr = proc[1]
-            data.append((arr[0], arr[1]))
-            i += 1
+        for point in points:
+            if len(point) == 3:
+                for name, times in point[2].items():
+                    timer.add(name, times["seconds"])
+            data.append(point[:2])
             if verbose:
-                print(f"    {i}/{len(procs)}")
+                print(f"    {len(data)}/{len(factors)}")
 
         return data
 
-    def _get_mean_squared_error(self, points, slope, intercept):
+    def _get_integral_image(self):
         """
-        _get_mean_squared_error() | gets the mean squared error of a given
-            set of points and the equation for a 2D line
-        slope     | the slope of the line
-        intercept | y_intercept of the line
-            y = slope*x + intercept
-        returns | (float) mean squared error
+        _get_integral_image() | gets the summed-area table of the foreground
+            of the original image, it is only computed once per Fractal
+        returns | (np.ndarray) (h+1, w+1) of ints
         """
-        total = 0
-        for point in points:
-            y1 = slope*point[0] + intercept
-            y2 = point[1]
+        if self._integral is None:
+            mask = self._get_packed_mask().unpack()
+            self._integral = integral_image(mask)
+
+        return self._integral
+
+    def _get_scaling_data_integral(self, start, stop, inc):
+        """
+        _get_scaling_data_integral() | gets the scaling data for the fractal
+            without resizing the image. Scaling the image by a factor and
+            counting boxes of sample_size is the same as counting boxes of
+            sample_size / factor, so the factors are counted relative to the
+            largest one, which uses boxes of sample_size on the original
+        start | (float) starting scale (inclusive)
+        stop  | (float) ending scale   (exclusive)
+        inc   | (float) amount to increment by
+        returns | list( (float, int) ) [(factor, count), ...]
+        """
+        factors = self._range_float(start, stop, inc)
+        largest = max(factors)
+
+        data = []
+        for factor in factors:
+            size = self._sample_size * largest / factor
+            data.append((factor, self._count_original(size)))
+
+        return data
+
+    def _count_original(self, size):
+        """
+        _count_original() | counts the boxes of the original image that
+            contain a non background pixel, from its foreground positions
+            with the "sparse" engine, or its summed-area table otherwise
+        size    | (int) (float) width and height of each box in pixels
+        returns | (int)
+        """
+        if self._get_engine(original=True) == "sparse":
+            ys, xs = self._get_foreground_coords()
+            (w, h), mode = self._get_header()
+            return count_boxes_sparse(ys, xs, (h, w), size)
+
+        return count_boxes_integral(self._get_integral_image(), size)
+
+    def _get_scaling_data_adaptive(self, start, stop, method, estimator,
+                                   tolerance, max_scales, timer=None):
+        """
+        _get_scaling_data_adaptive() | gets scaling data one factor at a
+            time, coarse to fine over the whole range. The factors are spaced
+            geometrically, a few spread from start to stop are counted
+            first, smallest first, then the factors halfway (in log space)
+            between those already counted, see _coarse_to_fine(). Once the
+            whole range is covered, the line is refit after every factor,
+            and no more factors are counted once the 95% confidence interval
+            of the slope is narrower than +/- tolerance
+        start      | (float) starting scale (inclusive)
+        stop       | (float) ending scale   (exclusive)
+        method     | (str) "scale" or "integral", see calculate_power()
+        estimator  | (str) see calculate_power()
+        tolerance  | (float) half width of the confidence interval to stop at
+        max_scales | (int) most factors to count
+        timer      | (PhaseTimer) (default = None) measures the phases
+        returns | list( (float, int) ) [(factor, count), ...] sorted by factor
+        """
+        phase = _no_phase if timer is None else timer.phase
+
+        factors = self._range_geometric(start, stop, max_scales)
+        largest = factors[-1]
+        fit_args = _ESTIMATORS[estimator]
+
+        passes = _coarse_to_fine(len(factors))
+        data = []
+        for i in [i for indices in passes for i in indices]:
+            factor = factors[i]
+            if method == "scale":
+                data.append(self._scale_count(factor, timer))
+            else:
+                size = self._sample_size * largest / factor
+                with phase("count"):
+                    data.append((factor, self._count_original(size)))
+
+            if data[-1][1] == 0:
+                break
+            # the fit is only trusted once it spans the whole range
+            if len(data) < len(passes[0]):
+                continue
+
+            logs = [(math.log(x), math.log(y)) for x, y in data]
+            with phase("fit"):
+                fit = fit_line(logs, **fit_args)
+            if _slope_confidence(fit, len(logs), **fit_args) < tolerance:
+                break
+
+        return sorted(data)
+
+    def _get_pyramid(self):
+        """
+        _get_pyramid() | gets the box grids of the original image for every
+            power of two box size from 2 up, it is only built once per
+            Fractal. It starts from boxes of 2 made from the packed mask, so
+            the mask is never unpacked whole
+        returns | list( (np.ndarray) ) see BoxCounting.occupancy_pyramid(),
+            level 0 is None, odd box sizes are counted with _get_occupancy()
+        """
+        if self._pyramid is None:
+            boxes = self._get_packed_mask().occupancy(2)
+            self._pyramid = [None] + occupancy_pyramid(boxes)
+
+        return self._pyramid
+
+    def _get_occupancy(self, size):
+        """
+        _get_occupancy() | gets the box grid of the original image, from the
+            pyramid for even sizes, or the packed mask for odd sizes
+        size    | (int) width and height of each box in pixels
+        returns | (np.ndarray) see BoxCounting.box_occupancy()
+        """
+        if size % 2:
+            return self._get_packed_mask().occupancy(size)
+        return pyramid_occupancy(self._get_pyramid(), size)
+
+    def _count_pyramid(self, size):
+        """
+        _count_pyramid() | counts the boxes of the original image that
+            contain a non background pixel, each size is only counted once
+        size    | (int) width and height of each box in pixels
+        returns | (int)
+        """
+        if size not in self._pyramid_counts and size % 2:
+            # the pyramid starts at boxes of 2
+            count = self._get_packed_mask().count_boxes(size)
+            self._pyramid_counts[size] = count
+        elif size not in self._pyramid_counts:
+            boxes = pyramid_occupancy(self._get_pyramid(), size)
+            self._pyramid_counts[size] = int(np.count_nonzero(boxes))
+
+        return self._pyramid_counts[size]
+
+    def _get_scaling_data_pyramid(self, start, stop):
+        """
+        _get_scaling_data_pyramid() | gets the scaling data for the power of
+            two factors between start and stop, each is the count of boxes of
+            sample_size * largest / factor on the original image, which is
+            one level of the pyramid
+        start | (float) starting scale (inclusive)
+        stop  | (float) ending scale   (exclusive)
+        returns | list( (float, int) ) [(factor, count), ...]
+        """
+        first = math.ceil(math.log2(start))
+        factors = []
+        while 2.0**(first + len(factors)) < stop:
+            factors.append(2.0**(first + len(factors)))
+        if not factors:
+            raise ValueError(f"no power of two scale in [{start}, {stop})")
+
+        largest = factors[-1]
+        data = []
+        for factor in factors:
+            size = self._sample_size * int(largest / factor)
+            data.append((factor, self._count_pyramid(size)))
+
+        return data
+
+    def _read_bands(self):
+        """
+        _read_bands() | reads the original image a band of rows at a time,
+            with each band (and its foreground mask) fitting in the memory
+            budget
+        returns | generator of (int, PIL.Image) (first row, band)
+        """
+        # each pixel costs its own bytes, plus a bool in the mask and the
+        # two partial reductions of it
+        (w, h), mode = self._get_header()
+        pixel_bytes = Image.getmodebands(mode) + 3
+        rows = max(1, self._memory_budget // (w * pixel_bytes))
+
+        return read_bands(self._path, rows, max_bytes=self._memory_budget)
+
+    def _get_scaling_data_tiled(self, start, stop, inc):
+        """
+        _get_scaling_data_tiled() | gets the same scaling data as
+            _get_scaling_data_integral(), but reads the image a band of rows
+            at a time so images larger than memory can be counted
+        start | (float) starting scale (inclusive)
+        stop  | (float) ending scale   (exclusive)
+        inc   | (float) amount to increment by
+        returns | list( (float, int) ) [(factor, count), ...]
+        """
+        if self._background is None:
+            self._background = band_background(self._read_bands(),
+                                               self._background_strategy)
 
-            total += (y2-y1)**2
+        factors = self._range_float(start, stop, inc)
+        largest = max(factors)
+        sizes = [self._sample_size * largest / factor for factor in factors]
+
+        (w, h), mode = self._get_header()
+        counts = count_boxes_bands(self._read_bands(), (h, w), sizes,
+                                   self._get_foreground_mask)
 
-        return total / len(points)
+        return list(zip(factors, counts))
 
     def _calculate_best_slope(self, points):
         """
         _calculate_best_slope() | calculates the slope of the lOBF using
-            linear regression, for more accurate results the point (0, y)
-            should be included
+            least squares linear regression
         points | list((float, float)) a set of linear points to
             calculate the slope of
-        returns | (int)
+        returns | (float)
+        """
+        return fit_line(points).slope
+
+    def _get_cache_key(self, start, stop, inc, method, scales=None,
+                       reduce=False):
         """
-        yint = 0
-        slope = 0
-
-        # repeat regression 250 times
-        for i in range(250):
-            # calculate best slope with the given intercept
-            max_error = self._get_mean_squared_error(points, slope, yint)
-            while True:
-                error = self._get_mean_squared_error(points, slope+0.001, yint)
-                if error > max_error:
-                    break
-                slope += 0.001
-                max_error = error
-
-            while True:
-                error = self._get_mean_squared_error(points, slope-0.001, yint)
-                if error > max_error:
-                    break
-                slope -= 0.0001
-                max_error = error
-
-            # calculate best intercept with current slope
-            max_error = self._get_mean_squared_error(points, slope, yint)
-            while True:
-                error = self._get_mean_squared_error(points, slope, yint+0.001)
-                if error > max_error:
-                    break
-                yint += 0.0001
-                max_error = error
-            while True:
-                error = self._get_mean_squared_error(points,
-                                                     slope, yint-0.0001)
-                if error > max_error:
-                    break
-                yint -= 0.0001
-                max_error = error
-
-        return slope
-
-    def calculate_power(self, start=1, stop=5, inc=0.2, log=False, vis=False):
+        _get_cache_key() | gets the key the scaling data of this Fractal is
+            stored under in a ResultCache, the hash of the image bytes and
+            every setting that changes the counts
+        scales  | (float, int) (default = None) tolerance, max_scales of an
+            adaptive calculation
+        reduce  | (bool) (default = False) whether the image was scaled from
+            a reduced decode
+        returns | (str, dict) image hash, parameters
+        """
+        if self._hash is None:
+            self._hash = hash_file(self._path)
+
+        params = {
+            "start": start,
+            "stop": stop,
+            "inc": inc,
+            "method": method,
+            "sample_size": self._sample_size,
+            "background": self._background_strategy,
+        }
+        if self._background_strategy == "luminance":
+            params["threshold"] = self._luminance_threshold
+        if scales is not None:
+            params["tolerance"], params["max_scales"] = scales
+        if reduce:
+            params["reduce"] = True
+
+        return self._hash, params
+
+    def calculate_power(self, start=1, stop=5, inc=0.2, log=False, vis=False,
+                        method="scale", estimator="ols", cache=None,
+                        adaptive=False, tolerance=0.05, max_scales=20,
+                        reduce=False, metrics=None, release=False):
         """
         calculate_power() | calculates the power of the Fractal using
             Hausdorff's method
@@ -289,9 +838,145 @@ class Fractal:
         number_of_times | the number of times to scale the fractal and count
         log             | (bool) verbose console output
         vis             | (bool) produces visualization of process
+        method          | (str) how each scale is measured, one of:
+            "scale"    | (default) resize the image and count the boxes
+            "integral" | count larger boxes on the original image using a
+                summed-area table, no image is ever resized
+            "tiled"    | the same counts as "integral", but the image is
+                read a band of rows at a time within the memory budget
+                (see set_memory_budget())
+            "pyramid"  | like "integral", but only the power of two
+                factors in [start, stop) are counted (inc is not used),
+                every count is read from one cached pyramid of box grids
+        estimator       | (str) how the line is fit to the log-log data,
+            one of "ols" (default), "origin", "theil-sen", "huber"
+            (see fit_line()), the full fit is kept in get_last_fit()
+        cache           | (ResultCache) (default = None) where the scaling
+            data and power are stored, if this image has already been
+            counted with the same parameters the stored counts are reused
+        adaptive        | (bool) (default = False), if True up to max_scales
+            factors are spaced geometrically from start to stop and counted
+            coarse to fine (a few spread over the whole range, then the
+            factors between them, each pass smallest first), stopping once
+            the slope is known to within +/- tolerance (95% confidence), inc
+            is not used. Only for the "scale" and "integral" methods, the
+            number of factors counted is get_last_scale_count()
+        tolerance       | (float) (default = 0.05) see adaptive
+        max_scales      | (int) (default = 20) see adaptive, at least 2
+        reduce          | (bool) (default = False), if True and no factor
+            is larger than 1/4, the "scale" method decodes the image at a
+            reduced size and scales that instead, which is faster and uses
+            less memory, but the counts can differ slightly. Bilevel ("1")
+            and palette ("P") images are always decoded whole, their scaled
+            copies are made without antialiasing, so a reduced decode would
+            change the counts
+        metrics         | (bool) (str) (function) (default = None) if set,
+            the time and peak memory of each phase ("decode", "background",
+            "pool", "resize", "count", "fit", ...) are measured and kept in
+            get_last_metrics(), a function is also called with them once
+            the analysis ends. Measuring memory slows down the analysis,
+            "time" measures only the time of each phase
+        release         | (bool) (default = False), if True the decoded
+            pixels and everything made from them are freed once the power
+            is calculated (see release()), for when many images are
+            analyzed one after another. Otherwise they are kept, so the
+            next calculation reuses the mask, pyramid and summed-area table
+        returns | (float) power of the Fractal, a ValueError is raised if
+            fewer than 2 scale factors are counted, a line can not be fit
+        """
+        if estimator not in _ESTIMATORS:
+            raise ValueError(f"unknown estimator: {estimator}")
+        if method not in ("scale", "integral", "tiled", "pyramid"):
+            raise ValueError(f"unknown scaling method: {method}")
+        if adaptive and method not in ("scale", "integral"):
+            raise ValueError(f"adaptive scales can not use method {method}")
+        if adaptive and max_scales < 2:
+            raise ValueError(f"max_scales must be at least 2 to fit a line, "
+                             f"got {max_scales}")
+
+        # how the factors are picked, None for every factor in the range
+        scales = (tolerance, max_scales) if adaptive else None
+
+        timer = None
+        if metrics:
+            timer = PhaseTimer(trace_memory=metrics != "time")
+        try:
+            return self._calculate_power(start, stop, inc, log, vis, method,
+                                         estimator, cache, scales, reduce,
+                                         timer)
+        finally:
+            # the pixels are decoded again if they are needed again
+            if release:
+                self.release()
+
+            # also measured when the calculation fails, to see where
+            self._last_metrics = None
+            if timer is not None:
+                self._last_metrics = timer.get_metrics()
+                if callable(metrics):
+                    metrics(self._last_metrics)
+
+    def _calculate_power(self, start, stop, inc, log, vis, method,
+                         estimator, cache, scales, reduce, timer):
+        """
+        _calculate_power() | calculate_power() after its arguments are
+            checked
+        scales  | (float, int) tolerance, max_scales of an adaptive
+            calculation, None to count every factor in the range
+        reduce  | (bool) decode at a reduced size for the "scale" method
+        timer   | (PhaseTimer) measures each phase, None to not measure
         returns | (float) power of the Fractal
         """
-        data = self._get_scaling_data_process(start, stop, inc, log)
+        phase = _no_phase if timer is None else timer.phase
+
+        data = None
+        if cache is not None:
+            with phase("cache"):
+                key = self._get_cache_key(start, stop, inc, method, scales,
+                                          reduce and method == "scale")
+                data = cache.get_counts(*key)
+
+        if data is None:
+            # a tiled image is never decoded whole
+            if method != "tiled":
+                with phase("decode"):
+                    # the reduction is kept between calls, so it is set on
+                    # every call
+                    reduction = 1
+                    if reduce and method == "scale":
+                        if scales is None:
+                            factors = self._range_float(start, stop, inc)
+                        else:
+                            factors = self._range_geometric(start, stop,
+                                                            scales[1])
+                        reduction = _get_reduction(factors)
+                    self._set_scale_reduction(reduction)
+                    source = self._get_scale_source()
+                    source.load()
+                    if timer is not None:
+                        timer.allocated(image_bytes(source))
+                with phase("background"):
+                    self._get_background()
+
+            if scales is not None:
+                data = self._get_scaling_data_adaptive(
+                    start, stop, method, estimator, *scales, timer)
+            elif method == "scale":
+                data = self._get_scaling_data_process(start, stop, inc, log,
+                                                      timer)
+            else:
+                with phase("count"):
+                    if method == "integral":
+                        data = self._get_scaling_data_integral(start, stop,
+                                                               inc)
+                    elif method == "pyramid":
+                        data = self._get_scaling_data_pyramid(start, stop)
+                    else:
+                        data = self._get_scaling_data_tiled(start, stop, inc)
+
+            if cache is not None:
+                cache.put_counts(*key, data)
+        self._last_data = data
 
         logs = []
         for point in data:
@@ -306,33 +991,55 @@ class Fractal:
             print(logs)
             print("="*12)
 
-        power = self._calculate_best_slope(logs)
+        # the old hill climbing fit returned a meaningless slope here
+        if len(logs) < 2:
+            raise ValueError(f"a power needs at least 2 scale factors, "
+                             f"[{start}, {stop}) by {inc} has {len(logs)}")
+
+        with phase("fit"):
+            self._last_fit = fit_line(logs, **_ESTIMATORS[estimator])
+        power = self._last_fit.slope
+
+        if cache is not None:
+            cache.put_power(*key, estimator, power)
 
         if vis:
-            fig, (ax1, ax2) = plt.subplots(2, figsize=(11, 7))
-            fig.tight_layout(pad=3.0)
+            with phase("visualize"):
+                self._plot_power(data, logs, power)
+
+        return power
 
-            data_x = [x[0] for x in data]
-            data_y = [x[1] for x in data]
-            logs_x = [x[0] for x in logs]
-            logs_y = [x[0] for x in logs]
+    def _plot_power(self, data, logs, power):
+        """
+        _plot_power() | plots the scaling data, and the log-log data it was
+            fit from, saves the plot in Fractal._power_vis
+        data    | list( (float, int) ) [(factor, count), ...]
+        logs    | list( (float, float) ) the log of each point in data
+        power   | (float) slope of the fit line
+        returns | None
+        """
+        fig, (ax1, ax2) = plt.subplots(2, figsize=(11, 7))
+        fig.tight_layout(pad=3.0)
 
-            ax1.plot(data_x, data_y, "o", color="black")
-            ax2.plot(logs_x, logs_y, "o", color="black")
-            ax2.plot(logs_x, logs_y)
+        data_x = [x[0] for x in data]
+        data_y = [x[1] for x in data]
+        logs_x = [x[0] for x in logs]
+        logs_y = [x[0] for x in logs]
 
-            ax1.set_title("\"mass\" vs. scaling factor")
-            ax2.set_title((
-                f"log(\"mass\") vs. log(scaling factor)"
-                f" | slope={round(power, 3)}"
-            ))
+        ax1.plot(data_x, data_y, "o", color="black")
+        ax2.plot(logs_x, logs_y, "o", color="black")
+        ax2.plot(logs_x, logs_y)
 
-            img_buf = io.BytesIO()
-            plt.savefig(img_buf, format='png')
+        ax1.set_title("\"mass\" vs. scaling factor")
+        ax2.set_title((
+            f"log(\"mass\") vs. log(scaling factor)"
+            f" | slope={round(power, 3)}"
+        ))
 
-            self._power_vis = Image.open(img_buf)
+        img_buf = io.BytesIO()
+        plt.savefig(img_buf, format='png')
 
-        return power
+        self._power_vis = Image.open(img_buf)
 
     def visualize_counting(self):
         """
@@ -352,20 +1059,614 @@ class Fractal:
 
         return self._power_vis
 
+    def get_last_fit(self):
+        """
+        get_last_fit() | gets the line fit to the log-log data by the last
+            call to Fractal.calculate_power()
+        returns | (LineFit) if a power has been calculated, None if not
+        """
+        return self._last_fit
+
+    def get_last_metrics(self):
+        """
+        get_last_metrics() | gets the time and memory of each phase of the
+            last call to Fractal.calculate_power(metrics=...)
+        returns | (PowerMetrics) if metrics were measured, None if not
+        """
+        return self._last_metrics
+
+    def get_last_scale_count(self):
+        """
+        get_last_scale_count() | gets the number of scale factors counted
+            by the last call to Fractal.calculate_power()
+        returns | (int) if a power has been calculated, None if not
+        """
+        if self._last_data is None:
+            return None
+        return len(self._last_data)
+
+    def get_last_scaling_data(self):
+        """
+        get_last_scaling_data() | gets the counts measured at each scale by
+            the last call to Fractal.calculate_power()
+        returns | list( (float, int) ) [(factor, count), ...] if a power has
+            been calculated, None if not
+        """
+        return self._last_data
+
     def set_sample_size(self, size):
         """
-        set_sample_size() | changes the grid size used for counting
+        set_sample_size() | changes the grid size used for counting, counts
+            of the original image are still read from the same pyramid
         size | (int) new grid size
         returns | None
         """
         self._sample_size = size
 
+    def set_counting_engine(self, engine):
+        """
+        set_counting_engine() | changes the engine used to count the regions
+            that contain a non background pixel
+        engine | (str) one of:
+            "auto"   | (default) "sparse" for original images that are
+                almost all background, "numpy" for the rest and for every
+                scaled copy
+            "numpy"  | vectorized counting over a foreground mask
+            "sparse" | counting from the positions of the foreground
+                pixels, the cost depends on the number of foreground pixels
+                instead of the size of the image
+            "python" | the original pixel by pixel loop
+        returns | None
+        """
+        if engine not in ("auto", "numpy", "sparse", "python"):
+            raise ValueError(f"unknown counting engine: {engine}")
+        self._engine = engine
+
+    def set_background_strategy(self, strategy, threshold=128):
+        """
+        set_background_strategy() | changes how the background of the image
+            is detected, the detected background is kept until this is
+            called again
+        strategy  | (str) one of:
+            "frequent"  | (default) the most occuring color is background
+            "border"    | the most occuring color along the image edges
+                is background
+            "luminance" | pixels on the same side of a brightness threshold
+                as the most occuring brightness are background
+        threshold | (int) 0-255 (default = 128), brightness threshold used
+            by "luminance"
+        returns | None
+        """
+        if strategy not in ("frequent", "border", "luminance"):
+            raise ValueError(f"unknown background strategy: {strategy}")
+
+        self._background_strategy = strategy
+        self._luminance_threshold = threshold
+        self._background = None
+        self._integral = None
+        self._pyramid = None
+        self._pyramid_counts = {}
+        self._mask = None
+        self._density = None
+        self._coords = None
+
+    def set_memory_budget(self, budget):
+        """
+        set_memory_budget() | changes the memory used by
+            calculate_power(method="tiled") to hold a band of the image.
+            Only uncompressed images (PPM, BMP, uncompressed TIFF) can be
+            read in bands, other formats are decoded whole, and fail if
+            that does not fit in the budget
+        budget  | (int) bytes (default = 256MB)
+        returns | None
+        """
+        if budget < 1:
+            raise ValueError(f"memory budget must be positive, got {budget}")
+        self._memory_budget = budget
+
+
+# the highest fraction of foreground pixels the "auto" engine counts with
+# the "sparse" engine
+_SPARSE_DENSITY = 0.05
+
+# the Fractal attributes a worker process needs, see Fractal._get_settings()
+_WORKER_SETTINGS = ("_sample_size", "_engine", "_background_strategy",
+                    "_luminance_threshold", "_background", "_OVERLAY_COLOR",
+                    "_header")
+
+# worker processes shared by every Fractal, started on first use
+_pool = None
+# the number of processes in the pool, None uses one per cpu
+_pool_processes = None
+
+# threads that count bands of one mask, created on first use in each process
+_thread_pool = None
+_thread_pool_pid = None
+# the number of counting threads, None splits the cpus between the
+# processes that are counting at the same time
+_threads = None
+# the number of processes counting at the same time as this one
+_cpu_share = 1
+# masks smaller than this are not worth splitting between threads
+_MIN_THREAD_PIXELS = 1 << 20
+
+
+def _get_worker_count():
+    """
+    _get_worker_count() | gets the number of processes used to count scale
+        factors, 1 means they are counted in the calling process
+    returns | (int)
+    """
+    return _pool_processes or os.cpu_count() or 1
+
+
+def _get_pool():
+    """
+    _get_pool() | gets the pool of worker processes used for counting, it is
+        created once and reused by every Fractal
+    returns | (multiprocessing.Pool)
+    """
+    global _pool
+    if _pool is None:
+        workers = _get_worker_count()
+        _pool = Pool(workers, initializer=_share_cpus, initargs=(workers,))
+        atexit.register(_pool.terminate)
+    return _pool
+
+
+def _share_cpus(processes):
+    """
+    _share_cpus() | tells this process how many processes are counting at
+        the same time as it, so together they use one thread per cpu
+    processes | (int) number of processes, including this one
+    returns   | None
+    """
+    global _cpu_share
+    _cpu_share = processes
+
+
+def _get_thread_count():
+    """
+    _get_thread_count() | gets the number of threads used to count one mask
+    returns | (int)
+    """
+    return _threads or max(1, (os.cpu_count() or 1) // _cpu_share)
+
 
-def get_error_per_fractal(dir):
+def _get_thread_pool():
+    """
+    _get_thread_pool() | gets the threads used to count bands of a mask,
+        a forked process does not have its parent's threads, so it starts
+        its own
+    returns | (ThreadPoolExecutor)
+    """
+    global _thread_pool, _thread_pool_pid
+    if _thread_pool is None or _thread_pool_pid != os.getpid():
+        _thread_pool = ThreadPoolExecutor(_get_thread_count())
+        _thread_pool_pid = os.getpid()
+    return _thread_pool
+
+
+def set_counting_threads(threads):
+    """
+    set_counting_threads() | changes the number of threads used to count
+        each mask, shared by every Fractal
+    threads | (int) number of threads, 1 counts in the calling thread, None
+        (default) splits the cpus between the processes that are counting
+    returns | None
+    """
+    global _thread_pool, _threads
+    if threads is not None and threads < 1:
+        raise ValueError(f"thread count must be at least 1, got {threads}")
+    if _thread_pool is not None and _thread_pool_pid == os.getpid():
+        _thread_pool.shutdown()
+    _thread_pool = None
+    _threads = threads
+
+
+def set_worker_processes(processes):
+    """
+    set_worker_processes() | changes the number of worker processes used to
+        count scale factors, shared by every Fractal
+    processes | (int) number of processes, 1 counts in the calling process,
+        None uses one per cpu
+    returns | None
+    """
+    global _pool, _pool_processes
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+    _pool_processes = processes
+
+
+def _attach_shared_image(shared):
+    """
+    _attach_shared_image() | rebuilds an image from a handle returned by
+        Fractal._get_shared_image()
+    shared  | (tuple) (shared memory name, shape, dtype, image mode)
+    returns | (PIL.Image, SharedMemory) the image is only valid until the
+        shared memory is closed
+    """
+    name, shape, dtype, mode = shared
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+
+    # "1" images are stored one byte per pixel, which PIL infers from bools
+    img = Image.fromarray(arr) if mode == "1" else Image.fromarray(arr, mode)
+    return img, shm
+
+
+def _free_shared_memory(shm):
+    """
+    _free_shared_memory() | closes and removes a block of shared memory
+    shm     | (SharedMemory) memory created by Fractal._get_shared_image()
+    returns | None
+    """
+    shm.close()
+    shm.unlink()
+
+
+def _scale_count_worker(job):
+    """
+    _scale_count_worker() | runs Fractal._scale_count() in a worker process
+        against an image in shared memory
+    job     | (tuple) (shared image handle, Fractal settings, factor), and
+        optionally (bool) whether to time the phases
+    returns | (float, int) factor, count, plus the phases from
+        PowerMetrics.phases if they were timed
+    """
+    shared, settings, factor = job[:3]
+    timed = len(job) > 3 and job[3]
+    img, shm = _attach_shared_image(shared)
+
+    fractal = Fractal.__new__(Fractal)
+    fractal.__dict__.update(settings)
+    fractal._img = img
+    fractal._reduced = None
+    try:
+        if not timed:
+            return fractal._scale_count(factor)
+
+        timer = PhaseTimer(trace_memory=False)
+        point = fractal._scale_count(factor, timer)
+        return point + (timer.get_metrics().phases,)
+    finally:
+        # drop every view of the shared buffer before closing it
+        del fractal, img
+        shm.close()
+
+
+def _get_reduction(factors):
+    """
+    _get_reduction() | gets how much an image can be reduced before it is
+        scaled by factors. The reduced image is kept at least twice the size
+        of the largest scaled copy, so every copy is still resized with
+        antialiasing, which keeps the counts close to the original's
+    factors | list( (float) ) the factors the image is scaled by
+    returns | (int) divide the width and height by this, at least 1
+    """
+    return max(1, int(1 / (2 * max(factors))))
+
+
+def _no_phase(name):
+    """
+    _no_phase() | stands in for PhaseTimer.phase() when nothing is measured
+    name    | (str) name of the phase
+    returns | context manager that does nothing
+    """
+    return nullcontext()
+
+
+# the result of fit_line(), slope_error is the standard error of the slope
+LineFit = namedtuple("LineFit", ["slope", "intercept", "r_squared",
+                                 "slope_error"])
+
+# keyword arguments to fit_line() for each estimator name
+_ESTIMATORS = {
+    "ols": {},
+    "origin": {"through_origin": True},
+    "theil-sen": {"robust": "theil-sen"},
+    "huber": {"robust": "huber"},
+}
+
+
+def fit_line(points, through_origin=False, robust=None):
+    """
+    fit_line() | fits a line to a set of points in closed form
+    points         | list((float, float)) the points to fit
+    through_origin | (bool) (default = False), if True the intercept is fixed
+        at 0
+    robust         | (str) (default = None) ordinary least squares, or:
+        "theil-sen" | the median of the slopes between every pair of points
+        "huber"     | least squares that down-weights outliers
+    returns | (LineFit) r_squared is measured around 0 instead of the mean
+        when through_origin is True
+    """
+    xy = np.asarray(points, dtype=float).reshape(-1, 2)
+    x = xy[:, 0]
+    y = xy[:, 1]
+
+    if through_origin:
+        if not np.any(x):
+            raise ValueError("at least one non-zero x value is needed")
+    elif np.ptp(x) == 0:
+        raise ValueError("at least two distinct x values are needed")
+
+    if robust is None:
+        slope, intercept = _least_squares(x, y, np.ones_like(x),
+                                          through_origin)
+    elif robust == "theil-sen":
+        slope, intercept = _theil_sen(x, y, through_origin)
+    elif robust == "huber":
+        slope, intercept = _huber(x, y, through_origin)
+    else:
+        raise ValueError(f"unknown robust fit: {robust}")
+
+    residuals = y - (slope*x + intercept)
+    ss_res = float(np.sum(residuals**2))
+
+    if through_origin:
+        ss_tot = float(np.sum(y**2))
+        sxx = float(np.sum(x**2))
+        dof = len(x) - 1
+    else:
+        ss_tot = float(np.sum((y - y.mean())**2))
+        sxx = float(np.sum((x - x.mean())**2))
+        dof = len(x) - 2
+
+    r_squared = 1 - ss_res/ss_tot if ss_tot > 0 else 1.0
+    slope_error = math.sqrt(ss_res/dof/sxx) if dof > 0 else math.nan
+
+    return LineFit(float(slope), float(intercept), r_squared, slope_error)
+
+
+# two sided 95% critical values of Student's t distribution, by degrees of
+# freedom from 1 to 30, above that the normal distribution's 1.96 is used
+_T_975 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+          2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101,
+          2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052,
+          2.048, 2.045, 2.042)
+
+
+def _slope_confidence(fit, n, through_origin=False, robust=None):
+    """
+    _slope_confidence() | gets the half width of the 95% confidence
+        interval of a slope from fit_line()
+    fit     | (LineFit) the fit
+    n       | (int) number of points fit
+    through_origin, robust | the arguments the line was fit with
+    returns | (float) inf if there are too few points to know
+    """
+    dof = n - 1 if through_origin else n - 2
+    if dof < 1 or math.isnan(fit.slope_error):
+        return math.inf
+
+    t = _T_975[dof - 1] if dof <= len(_T_975) else 1.96
+    return t * fit.slope_error
+
+
+# fewest factors spread over the whole range an adaptive calculation counts
+# before it can stop
+_COARSE_SCALES = 5
+
+
+def _coarse_to_fine(count, coarse=_COARSE_SCALES):
+    """
+    _coarse_to_fine() | splits the indices of a list into passes, the first
+        pass is spread over the whole list, with both ends, and each pass
+        after it takes the indices halfway between those already taken.
+        Every pass is in increasing order, so when the list is of scale
+        factors the resizes grow gradually within a pass
+    count   | (int) length of the list
+    coarse  | (int) (default = _COARSE_SCALES) about how many indices the
+        first pass takes
+    returns | list( list( (int) ) ) every index from 0 to count - 1 once
+    """
+    # the largest power of two step that still takes coarse indices
+    step = 1
+    while (count - 1) // (step * 2) >= coarse - 1:
+        step *= 2
+
+    first = list(range(0, count, step))
+    if first[-1] != count - 1:
+        first.append(count - 1)
+    passes = [first]
+    while step > 1:
+        step //= 2
+        passes.append(list(range(step, count - 1, step * 2)))
+    return passes
+
+
+def _least_squares(x, y, weights, through_origin):
+    """
+    _least_squares() | weighted least squares line fit
+    returns | (float, float) slope, intercept
+    """
+    if through_origin:
+        return np.sum(weights*x*y) / np.sum(weights*x*x), 0.0
+
+    total = np.sum(weights)
+    mean_x = np.sum(weights*x) / total
+    mean_y = np.sum(weights*y) / total
+    dx = x - mean_x
+
+    slope = np.sum(weights*dx*(y - mean_y)) / np.sum(weights*dx*dx)
+    return slope, mean_y - slope*mean_x
+
+
+def _theil_sen(x, y, through_origin):
+    """
+    _theil_sen() | Theil-Sen line fit, the median slope between every pair
+        of points (or between every point and the origin)
+    returns | (float, float) slope, intercept
+    """
+    if through_origin:
+        nonzero = x != 0
+        return np.median(y[nonzero] / x[nonzero]), 0.0
+
+    i, j = np.triu_indices(len(x), k=1)
+    dx = x[j] - x[i]
+    valid = dx != 0
+    slope = np.median((y[j] - y[i])[valid] / dx[valid])
+
+    return slope, np.median(y - slope*x)
+
+
+def _huber(x, y, through_origin, k=1.345, iterations=50):
+    """
+    _huber() | Huber line fit using iteratively reweighted least squares,
+        residuals larger than k robust standard deviations are down-weighted
+    returns | (float, float) slope, intercept
+    """
+    # start from a robust fit, least squares can already be pulled far
+    # enough by an outlier to hide it
+    slope, intercept = _theil_sen(x, y, through_origin)
+
+    for i in range(iterations):
+        residuals = y - (slope*x + intercept)
+        # median absolute deviation, scaled to match a standard deviation
+        scale = np.median(np.abs(residuals - np.median(residuals))) / 0.6745
+        if scale == 0:
+            break
+
+        r = np.abs(residuals) / (k*scale)
+        weights = 1 / np.maximum(r, 1)
+
+        new_slope, new_intercept = _least_squares(x, y, weights,
+                                                  through_origin)
+        converged = (abs(new_slope - slope) < 1e-12 and
+                     abs(new_intercept - intercept) < 1e-12)
+        slope, intercept = new_slope, new_intercept
+        if converged:
+            break
+
+    return slope, intercept
+
+
+def analyze_many(paths, jobs=None, timeout=None, **kwargs):
+    """
+    analyze_many() | calculates the power of many images at once, one
+        process per image, yielding each result as soon as it is done.
+        A corrupt image, a crash, or an image that takes too long only
+        affects its own result
+    paths   | list( (str) ) paths to the images to analyze
+    jobs    | (int) (default = one per cpu) images analyzed at the same time
+    timeout | (float) (default = None) seconds before an image is stopped
+    kwargs  | arguments passed on to Fractal.calculate_power()
+    returns | generator of (str, float, dict) (path, power, diagnostics) in
+        the order they finish, power is None if the image failed, and
+        diagnostics has:
+            "seconds" | (float) time spent on the image
+            "error"   | (str) why the image failed, None if it did not
+            "fit"     | (LineFit) the fit from Fractal.get_last_fit()
+            "data"    | list( (float, int) ) the counts at each scale
+            "metrics" | (PowerMetrics) the phases of the analysis, from
+                Fractal.get_last_metrics(), also when the image failed
+                part way. Only times are measured unless kwargs sets
+                metrics (see Fractal.calculate_power()), None if its
+                process died or timed out
+    """
+    jobs = jobs or os.cpu_count() or 1
+    kwargs.setdefault("metrics", "time")
+    pending = list(paths)
+    running = {}
+
+    while pending or running:
+        # keep up to jobs images running
+        while pending and len(running) < jobs:
+            path = pending.pop(0)
+            recv, send = Pipe(duplex=False)
+            proc = Process(target=_analyze_process,
+                           args=(path, kwargs, send, jobs))
+            proc.start()
+            send.close()
+            running[recv] = (path, proc, time.monotonic())
+
+        wait_for = None
+        if timeout is not None:
+            started = min(start for path, proc, start in running.values())
+            wait_for = max(0, started + timeout - time.monotonic())
+
+        # a pipe is ready when its process sends a result, or exits
+        for recv in connection.wait(list(running), wait_for):
+            path, proc, start = running.pop(recv)
+            try:
+                power, diagnostics = recv.recv()
+            except EOFError:
+                proc.join()
+                power = None
+                diagnostics = {
+                    "seconds": time.monotonic() - start,
+                    "error": f"process exited with code {proc.exitcode}",
+                    "fit": None,
+                    "data": None,
+                    "metrics": None,
+                }
+            recv.close()
+            proc.join()
+            yield path, power, diagnostics
+
+        if timeout is not None:
+            now = time.monotonic()
+            for recv, (path, proc, start) in list(running.items()):
+                if now - start >= timeout:
+                    del running[recv]
+                    proc.terminate()
+                    proc.join()
+                    recv.close()
+                    yield path, None, {
+                        "seconds": now - start,
+                        "error": f"timed out after {timeout} seconds",
+                        "fit": None,
+                        "data": None,
+                        "metrics": None,
+                    }
+
+
+def _analyze_process(path, kwargs, conn, jobs):
+    """
+    _analyze_process() | analyzes one image for analyze_many(), sending
+        (power, diagnostics) back through conn
+    jobs    | (int) number of images analyzed at the same time
+    returns | None
+    """
+    global _pool, _pool_processes
+    # the pool belongs to the parent, and analyze_many() already uses every
+    # cpu, so scale factors are counted in this process
+    _pool = None
+    _pool_processes = 1
+    _share_cpus(jobs)
+
+    start = time.monotonic()
+    f = None
+    try:
+        f = Fractal(path)
+        power = f.calculate_power(**kwargs)
+        diagnostics = {"error": None, "fit": f.get_last_fit(),
+                       "data": f.get_last_scaling_data(),
+                       "metrics": f.get_last_metrics()}
+    except Exception as e:
+        power = None
+        diagnostics = {"error": f"{type(e).__name__}: {e}", "fit": None,
+                       "data": None,
+                       "metrics": None if f is None else f.get_last_metrics()}
+
+    diagnostics["seconds"] = time.monotonic() - start
+    conn.send((power, diagnostics))
+    conn.close()
+
+
+def get_error_per_fractal(dir, jobs=None, cache=None, dedupe=False):
     """
     get_error_per_fractal() | computes the error for each Fractal and
         returns a list of the best data points for each Fractal in imgs.
         A Fractal is considered the same if it has the same name
+    dir    | (str) directory of images named "(power)name.png"
+    jobs   | (int) (default = one per cpu) images analyzed at the same time
+    cache  | (ResultCache) (default = None) cache of previous results, only
+        new or modified images are analyzed
+    dedupe | (bool) (default = False), if True only the largest of the
+        near-duplicate images of each Fractal is analyzed
     returns | list( (float, float | str) )
     """
     vals = []
@@ -373,6 +1674,17 @@ def get_error_per_fractal(dir):
 
     currentName = None
     files = os.listdir(dir)
+
+    # analyze every image up front, spread across every cpu
+    paths = [dir + "/" + file for file in files]
+    if dedupe:
+        paths = _skip_duplicates(paths)
+    powers = {}
+    for path, p, diagnostics in analyze_many(paths, jobs, cache=cache):
+        if p is None:
+            print(path, diagnostics["error"])
+        powers[path] = p
+
     files.append(os.listdir(dir)[0])
     for file in files:
         power, path = file.split(")")
@@ -383,7 +1695,7 @@ def get_error_per_fractal(dir):
             name = name[:-2]
 
         if name != currentName:
-            if currentName is not None:
+            if currentName is not None and currSet:
                 min = 0
                 p = currSet[0][1]
                 for i in range(1, len(currSet)):
@@ -401,9 +1713,9 @@ def get_error_per_fractal(dir):
 
         print(power, path, currentName)
 
-        f = Fractal(dir + "/" + file)
-
-        p = f.calculate_power()
+        p = powers.get(dir + "/" + file)
+        if p is None:
+            continue
 
         currSet.append((p, power, name))
         print(p, power, name)
@@ -411,6 +1723,32 @@ def get_error_per_fractal(dir):
     return vals
 
 
+def _skip_duplicates(paths):
+    """
+    _skip_duplicates() | removes the near-duplicate images of each Fractal,
+        keeping the copy with the most pixels
+    paths   | list( (str) ) paths to images named "(power)name_i.png"
+    returns | list( (str) ) paths that are not duplicates, in order
+    """
+    def get_pixels(path):
+        with Image.open(path) as img:
+            return img.width * img.height
+
+    def get_fractal(path):
+        file = os.path.basename(path)
+        name = " ".join(file.split(".")[:-1])
+        if name[-2] == "_":
+            name = name[:-2]
+        return name
+
+    largest = sorted(paths, key=get_pixels, reverse=True)
+    duplicates = find_duplicates(largest, group=get_fractal)
+    for path, original in duplicates.items():
+        print(f"skipping {path}, a duplicate of {original}")
+
+    return [path for path in paths if path not in duplicates]
+
+
 def plot_percent_error_scatter(vals, path):
     """
     plot_percent_error_per_Fractal_scatter() | plots the percent error
@@ -489,8 +1827,11 @@ def plot_percent_error_bar(vals, path):
 
 
 def main():
+    # previous results are reused for images that have not changed
+    cache = ResultCache("results_cache.sqlite")
+
     # will take ~2.5 hours
-    vals = get_error_per_fractal("imgs")
+    vals = get_error_per_fractal("imgs", cache=cache, dedupe=True)
     print("="*12)
     print(vals)
     print("="*12)
@@ -498,7 +1839,8 @@ def main():
     plot_percent_error_scatter(vals, "plts/scraped_data_PIL_error.png")
 
     # will take ~45 min
-    vals = get_error_per_fractal("images/basic_shapes/generated")
+    vals = get_error_per_fractal("images/basic_shapes/generated",
+                                 cache=cache)
     print("="*12)
     print(vals)
     print("="*12)
@@ -0,0 +1,177 @@
+"""
+Ethan Armstrong
+Section AD
+
+This module contains the HttpStore class, an on-disk store of downloaded
+responses (web pages, search results, images), so a scrape can be rerun
+without downloading anything that has not expired, or fully offline
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+
+class HttpStore:
+    """
+    Records the body of each response under a key for its request. Bodies
+    are stored once per sha256 of their contents, so the same image found
+    at several urls is only stored once, and an index maps each key to the
+    body it last returned and when it was stored
+    """
+    def __init__(self, dir, offline=False, refresh=False) -> None:
+        """
+        HttpStore() | opens (or creates) a store
+        dir     | (str) directory to store the responses in
+        offline | (bool) (default = False) only replay stored responses,
+            even expired ones, and never fetch
+        refresh | (bool) (default = False) always fetch, and record the
+            new response
+        """
+        if offline and refresh:
+            raise ValueError("a store can not be both offline and refreshed")
+
+        self._dir = dir
+        self._offline = offline
+        self._refresh = refresh
+        # the store is used by several download threads at once
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.join(dir, "objects"), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(dir, "index.sqlite"),
+                                     timeout=60, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, url TEXT, body TEXT, stored REAL)"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _object_path(self, digest):
+        """
+        _object_path() | gets the file a body is stored in
+        digest  | (str) hex sha256 of the body
+        returns | (str)
+        """
+        return os.path.join(self._dir, "objects", digest[:2], digest)
+
+    def get(self, key, ttl=None):
+        """
+        get() | gets a stored body
+        key     | (str) key of the request, from request_key()
+        ttl     | (float) (default = None) seconds a body can be used for
+            after it was stored, None never expires. Ignored offline
+        returns | (bytes) if stored and not expired, None if not
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body, stored FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+        if row is None:
+            return None
+        digest, stored = row
+        if not self._offline and ttl is not None \
+                and time.time() - stored > ttl:
+            return None
+
+        try:
+            with open(self._object_path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, url, body):
+        """
+        put() | stores a body
+        key  | (str) key of the request, from request_key()
+        url  | (str) url of the request, kept to make the index readable
+        body | (bytes) body of the response
+        returns | None
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        path = self._object_path(digest)
+
+        if not os.path.exists(path):
+            # written to a temporary file first, so a body is never seen
+            # half written
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.replace(temp, path)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, url, digest, time.time())
+            )
+
+    def load(self, key, url, fetch, ttl=None):
+        """
+        load() | gets a body from the store, or fetches and stores it if it
+            is not stored or has expired
+        key     | (str) key of the request, from request_key()
+        url     | (str) url of the request
+        fetch   | function() -> (bytes) fetches the body, returning None if
+            it could not be fetched, which is not stored
+        ttl     | (float) (default = None) see HttpStore.get()
+        returns | (bytes) None if it could not be fetched, or is not stored
+            and the store is offline
+        """
+        if not self._refresh:
+            body = self.get(key, ttl)
+            if body is not None or self._offline:
+                return body
+
+        body = fetch()
+        if body is not None:
+            self.put(key, url, body)
+        return body
+
+    def prune(self):
+        """
+        prune() | deletes stored bodies that no key returns anymore
+        returns | (int) number of bodies deleted
+        """
+        with self._lock:
+            used = {row[0] for row in
+                    self._conn.execute("SELECT body FROM responses")}
+
+        deleted = 0
+        objects = os.path.join(self._dir, "objects")
+        for prefix in os.listdir(objects):
+            for digest in os.listdir(os.path.join(objects, prefix)):
+                if digest not in used:
+                    os.remove(os.path.join(objects, prefix, digest))
+                    deleted += 1
+        return deleted
+
+    def close(self):
+        """
+        close() | closes the index of the store
+        returns | None
+        """
+        self._conn.close()
+
+
+def request_key(url, params=None):
+    """
+    request_key() | gets the key of a request, the same request always gets
+        the same key
+    url     | (str) url of the request
+    params  | (dict) (default = None) parameters of the request, leave out
+        secrets such as api keys, so the key does not change with them
+    returns | (str) hex sha256 digest
+    """
+    request = json.dumps([url, params or {}], sort_keys=True)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
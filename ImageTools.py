@@ -1,4 +1,9 @@
+import numpy as np
 from PIL import Image
+from BoxCounting import pixel_array
+
+# pixels compared at a time by check_similarity() with a threshold
+_SIMILARITY_CHUNK = 1 << 16
 
 
 def scaleImage(img, new_size, keep_aspect_ratio=False):
@@ -26,17 +31,20 @@ def scaleImage(img, new_size, keep_aspect_ratio=False):
     return img.resize((w, newH), Image.ANTIALIAS)
 
 
-def check_similarity(img1, img2):
+def check_similarity(img1, img2, threshold=None):
     """
     check_similarity() | checks the similarity between two PIL images
     img1 | first PIL Image object
     img2 | second PIL Image object
+    threshold | (float) (default = None) if set, stops comparing as soon as
+        the similarity is known to be below threshold, the value returned
+        is then only guaranteed to be below threshold
 
     returns | (float) 0 to 1, 1 being a 100% match and 0 being a 0% match
     """
-    # get raw pixel data of each image
-    d1 = list(img1.getdata())
-    d2 = list(img2.getdata())
+    # get raw pixel data of each image, one row per pixel
+    d1 = _pixel_rows(img1)
+    d2 = _pixel_rows(img2)
 
     # find the large of the two images
     large = d1 if len(d1) > len(d2) else d2
@@ -46,16 +54,164 @@ def check_similarity(img1, img2):
     total = len(large)
     error = len(large) - len(small)  # error based on dimensions
 
-    for i in range(len(small)):
-        p1 = large[i]
-        p2 = small[i]
+    # pixels with a different number of bands never match
+    if large.shape[1] != small.shape[1]:
+        return 0.0
+
+    # compare in chunks, so a threshold can stop early
+    step = len(small) if threshold is None else _SIMILARITY_CHUNK
+    for start in range(0, len(small), step):
+        end = min(start + step, len(small))
+        p1 = large[start:end]
+        p2 = small[start:end]
+        error += int(np.count_nonzero((p1 != p2).any(axis=1)))
 
-        if p1 != p2:
-            error += 1
+        if threshold is not None and 1 - (error / total) < threshold:
+            break
 
     return 1 - (error / total)
 
 
+def _pixel_rows(img):
+    """
+    _pixel_rows() | gets the pixels of an image in the order getdata() gives
+    img     | PIL image object
+    returns | (np.ndarray) (w*h, bands)
+    """
+    arr = pixel_array(img)
+    return arr.reshape(img.width * img.height, -1)
+
+
+def perceptual_hash(img):
+    """
+    perceptual_hash() | hashes what an image looks like, so resized,
+        recompressed or slightly edited copies of an image get hashes that
+        differ in only a few bits. Each bit is whether a pixel of a 9x8
+        grayscale thumbnail is brighter than the pixel to its right
+        (a difference hash)
+    img     | PIL image object
+    returns | (int) 64 bit hash
+    """
+    small = np.asarray(img.convert("L").resize((9, 8), Image.ANTIALIAS),
+                       dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hash_distance(hash1, hash2):
+    """
+    hash_distance() | counts the bits that differ between two hashes from
+        perceptual_hash()
+    hash1   | (int) first hash
+    hash2   | (int) second hash
+    returns | (int) 0 to 64, 0 being the same
+    """
+    return bin(hash1 ^ hash2).count("1")
+
+
+def read_bands(path, rows, max_bytes=None):
+    """
+    read_bands() | reads an image a band of rows at a time, without decoding
+        the whole image when the file allows it (uncompressed TIFF, BMP,
+        PPM). Other files can only be decoded whole
+    path      | (str) full path to the image
+    rows      | (int) number of rows in each band
+    max_bytes | (int) (default = None) the largest image that may be decoded
+        whole, raises ValueError if a larger one has to be
+    returns   | generator of (int, PIL.Image) (first row, band)
+    """
+    with Image.open(path) as img, open(path, "rb") as f:
+        w, h = img.size
+        pixel_bytes = max(1, len(Image.new(img.mode, (1, 1)).tobytes()))
+
+        if any(tile[0] != "raw" for tile in img.tile):
+            size = w * h * pixel_bytes
+            if max_bytes is not None and size > max_bytes:
+                raise ValueError(
+                    f"{path} can only be decoded whole, {size} bytes, "
+                    f"which is over the limit of {max_bytes}, save it as "
+                    "an uncompressed TIFF, BMP or PPM to read it in bands"
+                )
+            img.load()
+            for y0 in range(0, h, rows):
+                yield y0, img.crop((0, y0, w, min(h, y0 + rows)))
+            return
+
+        for y0 in range(0, h, rows):
+            y1 = min(h, y0 + rows)
+            band = Image.new(img.mode, (w, y1 - y0))
+            if img.mode == "P":
+                band.putpalette(img.getpalette())
+
+            for tile in img.tile:
+                tx0, ty0, tx1, ty1 = tile[1]
+                r0 = max(ty0, y0)
+                r1 = min(ty1, y1)
+                if r0 >= r1:
+                    continue
+
+                sub = _split_raw_tile(tile, img.mode, r0, r1)
+                if sub is None:
+                    raise ValueError(f"{path} has a raw tile PIL can not "
+                                     "read in bands")
+                band.paste(_decode_raw(f, img.mode, sub), (tx0, r0 - y0))
+
+            yield y0, band
+
+
+def _split_raw_tile(tile, mode, r0, r1):
+    """
+    _split_raw_tile() | gets the part of an uncompressed tile holding rows
+        r0 to r1, by moving its offset to the first of those rows
+    tile    | (tuple) PIL tile (decoder, extents, offset, args)
+    mode    | (str) mode of the image
+    r0      | (int) first row (inclusive)
+    r1      | (int) last row (exclusive)
+    returns | (tuple) tile covering only those rows, None if the tile is
+        compressed and can only be decoded whole
+    """
+    name, (tx0, ty0, tx1, ty1), offset, args = tile
+    if name != "raw":
+        return None
+
+    if isinstance(args, str):
+        args = (args,)
+    rawmode, stride, ystep = (tuple(args) + (0, 1))[:3]
+
+    if not stride:
+        try:
+            stride = len(Image.new(mode, (tx1 - tx0, 1)).tobytes("raw",
+                                                                 rawmode))
+        except (ValueError, OSError):
+            return None
+
+    # rows are stored bottom to top when ystep is negative
+    if ystep < 0:
+        offset += (ty1 - r1) * stride
+    else:
+        offset += (r0 - ty0) * stride
+
+    return (name, (0, 0, tx1 - tx0, r1 - r0), offset,
+            (rawmode, stride, ystep))
+
+
+def _decode_raw(f, mode, tile):
+    """
+    _decode_raw() | decodes the rows of an uncompressed tile, reading only
+        those rows from the file
+    f       | (file) the image file, opened in binary
+    mode    | (str) mode of the image
+    tile    | (tuple) PIL tile from _split_raw_tile()
+    returns | (PIL.Image) the decoded rows
+    """
+    name, (x0, y0, x1, y1), offset, (rawmode, stride, ystep) = tile
+    f.seek(offset)
+    data = f.read(stride * (y1 - y0))
+    return Image.frombytes(mode, (x1 - x0, y1 - y0), data, "raw", rawmode,
+                           stride, ystep)
+
+
 def to_mono(img):
     return img.convert("1")
 
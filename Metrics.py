@@ -0,0 +1,137 @@
+"""
+Ethan Armstrong
+Section AD
+
+This module contains the PhaseTimer class, which measures the wall time and
+peak memory of each phase of a Fractal analysis, and PowerMetrics, the
+structured result it produces
+"""
+
+import time
+import tracemalloc
+from collections import namedtuple
+from functools import lru_cache
+from contextlib import contextmanager
+from PIL import Image
+
+# the result of PhaseTimer.get_metrics()
+#   phases  | (dict) phase name -> {"seconds": (float),
+#       "peak_bytes": (int) most memory allocated by this process at once
+#       during the phase, None if memory was not measured or the phase ran
+#       in other processes. This is what tracemalloc sees (Python and
+#       NumPy), plus the pixel buffers of any PIL images recorded with
+#       PhaseTimer.allocated(), since PIL allocates them in C where
+#       tracemalloc can not see them}
+#   workers | (int) number of processes that counted the scales
+#   seconds | (float) wall time of the whole analysis
+PowerMetrics = namedtuple("PowerMetrics", ["phases", "workers", "seconds"])
+
+
+class PhaseTimer:
+    """
+    Measures each phase of an analysis, phases with the same name add up
+    """
+    def __init__(self, trace_memory=True) -> None:
+        """
+        PhaseTimer() | starts timing an analysis
+        trace_memory | (bool) (default = True), measure peak memory with
+            tracemalloc, which slows down python code while it runs
+        """
+        self._phases = {}
+        self._workers = 1
+        self._start = time.perf_counter()
+        self._trace_memory = trace_memory
+        self._started_tracing = False
+        # bytes allocated outside of tracemalloc in the current phase
+        self._untraced = 0
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    @contextmanager
+    def phase(self, name):
+        """
+        phase() | measures the code run inside of a with block as a phase
+        name    | (str) name of the phase
+        returns | context manager
+        """
+        if self._trace_memory:
+            tracemalloc.reset_peak()
+        self._untraced = 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = None
+            if self._trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] + self._untraced
+            self.add(name, seconds, peak)
+
+    def allocated(self, nbytes):
+        """
+        allocated() | records memory allocated in the current phase that
+            tracemalloc can not see, such as the pixels of a PIL image
+        nbytes  | (int) bytes allocated, see image_bytes()
+        returns | None
+        """
+        self._untraced += nbytes
+
+    def add(self, name, seconds, peak_bytes=None):
+        """
+        add() | records time spent on a phase that was measured elsewhere,
+            such as in a worker process
+        name       | (str) name of the phase
+        seconds    | (float) time spent
+        peak_bytes | (int) (default = None) peak memory, if known
+        returns    | None
+        """
+        phase = self._phases.setdefault(name, {"seconds": 0.0,
+                                               "peak_bytes": None})
+        phase["seconds"] += seconds
+        if peak_bytes is not None:
+            phase["peak_bytes"] = max(phase["peak_bytes"] or 0, peak_bytes)
+
+    def set_workers(self, workers):
+        """
+        set_workers() | records the number of processes used to count
+        workers | (int)
+        returns | None
+        """
+        self._workers = workers
+
+    def get_metrics(self):
+        """
+        get_metrics() | stops timing, memory is no longer traced if this
+            timer started tracing it
+        returns | (PowerMetrics)
+        """
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+        return PowerMetrics(self._phases, self._workers,
+                            time.perf_counter() - self._start)
+
+
+def image_bytes(img):
+    """
+    image_bytes() | gets the size of the pixel buffer PIL allocates for an
+        image, the bytes of each pixel times the number of pixels, so a
+        16 bit ("I;16") image counts 2 bytes a pixel and an "I" or "F"
+        image 4
+    img     | (PIL.Image) a loaded image
+    returns | (int)
+    """
+    return img.width * img.height * _pixel_bytes(img.mode)
+
+
+@lru_cache(maxsize=None)
+def _pixel_bytes(mode):
+    """
+    _pixel_bytes() | gets the bytes of one pixel of an image mode
+    mode    | (str) PIL image mode
+    returns | (int)
+    """
+    return len(Image.new(mode, (1, 1)).tobytes())
@@ -0,0 +1,181 @@
+"""
+Ethan Armstrong
+Section AD
+
+This module contains the PackedMask class, a foreground mask stored one bit
+per pixel, which boxes can be counted on without unpacking it, and which can
+be saved to disk
+"""
+
+import numpy as np
+
+# number of set bits in each possible byte
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# the first bit of each group of 2 or 4 pixels in a byte, packbits stores the
+# first pixel in the highest bit
+_GROUP_BITS = {2: 0b10101010, 4: 0b10001000}
+
+
+class PackedMask:
+    """
+    A foreground mask packed 8 pixels to a byte, in np.packbits() layout,
+    each row starts on a new byte
+    """
+    def __init__(self, bits, shape) -> None:
+        """
+        PackedMask() | wraps packed bits, use PackedMask.pack() to build one
+            from a mask
+        bits  | (np.ndarray) (h, ceil(w/8)) of uint8, from np.packbits()
+            along the rows
+        shape | (int, int) (h, w) of the unpacked mask
+        """
+        self._bits = bits
+        self._shape = tuple(shape)
+
+    @classmethod
+    def pack(cls, mask):
+        """
+        pack() | packs a foreground mask
+        mask    | (np.ndarray) (h, w) of bools
+        returns | (PackedMask)
+        """
+        return cls(np.packbits(mask, axis=1), mask.shape)
+
+    def unpack(self):
+        """
+        unpack() | gets the foreground mask back
+        returns | (np.ndarray) (h, w) of bools
+        """
+        mask = np.unpackbits(self._bits, axis=1, count=self._shape[1])
+        return mask.view(bool)
+
+    def get_shape(self):
+        """
+        get_shape() | gets the shape of the unpacked mask
+        returns | (int, int) (h, w)
+        """
+        return self._shape
+
+    def get_bits(self):
+        """
+        get_bits() | gets the packed bits
+        returns | (np.ndarray) (h, ceil(w/8)) of uint8
+        """
+        return self._bits
+
+    def count(self):
+        """
+        count() | counts the foreground pixels
+        returns | (int)
+        """
+        return int(_POPCOUNT[self._bits].sum(dtype=np.int64))
+
+    def count_boxes(self, size):
+        """
+        count_boxes() | counts the number of boxes that contain at least one
+            foreground pixel, the same as BoxCounting.count_boxes() on the
+            unpacked mask. Rows are or-ed together while packed, then boxes
+            of 2, 4 or a multiple of 8 pixels wide are counted with bitwise
+            operations, other sizes unpack the or-ed rows
+        size    | (int) width and height of each box in pixels
+        returns | (int)
+        """
+        if size < 1:
+            raise ValueError(f"box size must be at least 1 pixel, got {size}")
+
+        rows = self._or_rows(size)
+
+        if size == 1:
+            return int(_POPCOUNT[rows].sum(dtype=np.int64))
+
+        if size in _GROUP_BITS:
+            # spread each pixel over the bits of its group, then keep one
+            # bit per group
+            spread = rows.copy()
+            for shift in range(1, size):
+                spread |= rows << shift
+            spread &= _GROUP_BITS[size]
+            return int(_POPCOUNT[spread].sum(dtype=np.int64))
+
+        if size % 8 == 0:
+            # each box is a group of whole bytes, the padding is never set
+            step = size // 8
+            boxes = rows[:, 0::step].copy()
+            for offset in range(1, step):
+                part = rows[:, offset::step]
+                boxes[:, :part.shape[1]] |= part
+            return int(np.count_nonzero(boxes))
+
+        return int(np.count_nonzero(self._occupancy_columns(rows, size)))
+
+    def occupancy(self, size):
+        """
+        occupancy() | reduces the mask to a grid of boxes, the same as
+            BoxCounting.box_occupancy() on the unpacked mask, but only the
+            rows or-ed together are ever unpacked
+        size    | (int) width and height of each box in pixels
+        returns | (np.ndarray) (ceil(h/size), ceil(w/size)) of bools
+        """
+        if size < 1:
+            raise ValueError(f"box size must be at least 1 pixel, got {size}")
+
+        return self._occupancy_columns(self._or_rows(size), size)
+
+    def _or_rows(self, size):
+        """
+        _or_rows() | or-s every size-th row together while packed
+        size    | (int) height of each box in pixels
+        returns | (np.ndarray) (ceil(h/size), ceil(w/8)) of uint8
+        """
+        # the last slice can be shorter than the first, a partial box
+        rows = self._bits[0::size].copy()
+        for offset in range(1, size):
+            part = self._bits[offset::size]
+            rows[:part.shape[0]] |= part
+        return rows
+
+    def _occupancy_columns(self, rows, size):
+        """
+        _occupancy_columns() | or-s every size-th column of packed rows that
+            are already or-ed together
+        rows    | (np.ndarray) (ceil(h/size), ceil(w/8)) of uint8
+        size    | (int) width of each box in pixels
+        returns | (np.ndarray) (ceil(h/size), ceil(w/size)) of bools
+        """
+        rows = np.unpackbits(rows, axis=1, count=self._shape[1]).view(bool)
+        boxes = rows[:, 0::size].copy()
+        for offset in range(1, size):
+            part = rows[:, offset::size]
+            boxes[:, :part.shape[1]] |= part
+        return boxes
+
+    def nonzero(self):
+        """
+        nonzero() | gets the position of every foreground pixel, the same as
+            BoxCounting.foreground_coords() on the unpacked mask, only the
+            bytes with a foreground pixel are unpacked
+        returns | (np.ndarray, np.ndarray) ys, xs of ints in row major order
+        """
+        rows, cols = np.nonzero(self._bits)
+        bits = np.unpackbits(self._bits[rows, cols][:, None], axis=1)
+        index, bit = np.nonzero(bits)
+        return rows[index], cols[index] * 8 + bit
+
+    def save(self, path):
+        """
+        save() | saves the mask to a .npz file
+        path    | (str) file to write
+        returns | None
+        """
+        np.savez(path, bits=self._bits, shape=np.array(self._shape))
+
+    @classmethod
+    def load(cls, path):
+        """
+        load() | loads a mask saved by PackedMask.save()
+        path    | (str) file to read
+        returns | (PackedMask)
+        """
+        with np.load(path) as data:
+            return cls(data["bits"], tuple(int(x) for x in data["shape"]))
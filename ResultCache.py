@@ -0,0 +1,152 @@
+"""
+Ethan Armstrong
+Section AD
+
+This module contains the ResultCache class, an on-disk SQLite cache of
+Fractal analysis results, so images that have not changed are never
+analyzed twice
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+
+
+class ResultCache:
+    """
+    A cache of the scaling data and powers computed for each image, keyed by
+    a hash of the image bytes and the parameters of the analysis
+    """
+    def __init__(self, path) -> None:
+        """
+        ResultCache() | opens (or creates) a cache file
+        path | (str) full path to the SQLite file
+        """
+        self._path = path
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        """
+        __getstate__() | the connection can not be sent to other processes,
+            they open their own
+        """
+        return {"_path": self._path, "_conn": None, "_pid": None}
+
+    def _connect(self):
+        """
+        _connect() | gets the connection for this process, a forked process
+            opens its own instead of using its parent's
+        returns | (sqlite3.Connection)
+        """
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self._path, timeout=60)
+            self._pid = os.getpid()
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS counts ("
+                    "image TEXT, params TEXT, data TEXT, "
+                    "PRIMARY KEY (image, params))"
+                )
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS powers ("
+                    "image TEXT, params TEXT, estimator TEXT, power REAL, "
+                    "PRIMARY KEY (image, params, estimator))"
+                )
+        return self._conn
+
+    def get_counts(self, image, params):
+        """
+        get_counts() | gets the stored scaling data of an image
+        image   | (str) hash of the image, from hash_file()
+        params  | (dict) parameters the data was counted with
+        returns | list( (float, int) ) [(factor, count), ...] if stored,
+            None if not
+        """
+        row = self._connect().execute(
+            "SELECT data FROM counts WHERE image = ? AND params = ?",
+            (image, _format_params(params))
+        ).fetchone()
+
+        if row is None:
+            return None
+        return [tuple(point) for point in json.loads(row[0])]
+
+    def put_counts(self, image, params, data):
+        """
+        put_counts() | stores the scaling data of an image
+        image  | (str) hash of the image, from hash_file()
+        params | (dict) parameters the data was counted with
+        data   | list( (float, int) ) [(factor, count), ...]
+        returns | None
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO counts VALUES (?, ?, ?)",
+                (image, _format_params(params), json.dumps(data))
+            )
+
+    def get_power(self, image, params, estimator):
+        """
+        get_power() | gets the stored power of an image
+        image     | (str) hash of the image, from hash_file()
+        params    | (dict) parameters the data was counted with
+        estimator | (str) how the line was fit to the data
+        returns   | (float) if stored, None if not
+        """
+        row = self._connect().execute(
+            "SELECT power FROM powers "
+            "WHERE image = ? AND params = ? AND estimator = ?",
+            (image, _format_params(params), estimator)
+        ).fetchone()
+
+        return None if row is None else row[0]
+
+    def put_power(self, image, params, estimator, power):
+        """
+        put_power() | stores the power of an image
+        image     | (str) hash of the image, from hash_file()
+        params    | (dict) parameters the data was counted with
+        estimator | (str) how the line was fit to the data
+        power     | (float) power of the image
+        returns   | None
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO powers VALUES (?, ?, ?, ?)",
+                (image, _format_params(params), estimator, power)
+            )
+
+    def close(self):
+        """
+        close() | closes the connection to the cache file
+        returns | None
+        """
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+def hash_file(path):
+    """
+    hash_file() | hashes the bytes of a file, so a file is recognized no
+        matter its name, and a modified file is not
+    path    | (str) path to the file
+    returns | (str) hex sha256 digest
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _format_params(params):
+    """
+    _format_params() | formats parameters so the same parameters always give
+        the same key
+    params  | (dict)
+    returns | (str)
+    """
+    return json.dumps(params, sort_keys=True)
@@ -0,0 +1,224 @@
+"""
+Ethan Armstrong
+Section AD
+
+This module contains the TensorCache class, which decodes a directory of
+labeled images once into a memory-mapped array file, so training can read
+the pixels straight from disk instead of decoding every image every epoch
+"""
+
+import os
+import json
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+# bumped whenever the way images are decoded changes, so old caches are
+# rebuilt
+_VERSION = 1
+_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+
+
+class TensorCache:
+    """
+    A cache of the images in a directory with one sub directory per label,
+    the same layout as tf.keras.utils.image_dataset_from_directory(). The
+    pixels are stored in images.npy, and index.json stores the label names,
+    the label of each image, and the size and modification time of each
+    source file, so the cache is rebuilt when any of them change
+    """
+    def __init__(self, source, dir, image_size=(50, 50)) -> None:
+        """
+        TensorCache() | opens a cache, it is only built once it is loaded
+        source     | (str) directory of images, one sub directory per label
+        dir        | (str) directory to store the cache in
+        image_size | (int, int) (default = (50, 50)) (h, w) images are
+            resized to
+        """
+        self._source = source
+        self._dir = dir
+        self._image_size = tuple(image_size)
+
+    def _scan(self):
+        """
+        _scan() | lists the source images, without decoding them
+        returns | (dict) the index the cache should have, see TensorCache
+        """
+        classes = sorted(name for name in os.listdir(self._source)
+                         if os.path.isdir(os.path.join(self._source, name)))
+
+        files = []
+        labels = []
+        stamps = []
+        for label, name in enumerate(classes):
+            for file in sorted(os.listdir(os.path.join(self._source, name))):
+                if not file.lower().endswith(_EXTENSIONS):
+                    continue
+                path = os.path.join(name, file)
+                stat = os.stat(os.path.join(self._source, path))
+                files.append(path)
+                labels.append(label)
+                stamps.append([stat.st_size, stat.st_mtime_ns])
+
+        return {
+            "version": _VERSION,
+            "image_size": list(self._image_size),
+            "classes": classes,
+            "files": files,
+            "labels": labels,
+            "stamps": stamps,
+        }
+
+    def get_images(self):
+        """
+        get_images() | lists the source images in the order they are
+            cached, without decoding them
+        returns | (list( (str) ), np.ndarray, list( (str) )) path of each
+            image, (n) int64 label of each image, name of each label
+        """
+        index = self._scan()
+        paths = [os.path.join(self._source, path) for path in index["files"]]
+        return (paths, np.array(index["labels"], dtype=np.int64),
+                index["classes"])
+
+    def _read_index(self):
+        """
+        _read_index() | reads the index of the stored cache
+        returns | (dict) None if there is no cache
+        """
+        try:
+            with open(os.path.join(self._dir, "index.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def is_valid(self):
+        """
+        is_valid() | checks whether the stored cache matches the source
+            images
+        returns | (bool)
+        """
+        return self._read_index() == self._scan()
+
+    def build(self):
+        """
+        build() | decodes every source image as grayscale, resizes it, and
+            stores it, replacing any stored cache
+        returns | (dict) the index of the new cache
+        """
+        index = self._scan()
+        os.makedirs(self._dir, exist_ok=True)
+        h, w = self._image_size
+
+        # written under temporary names first, so a cache that was stopped
+        # part way through is never loaded
+        temp = os.path.join(self._dir, "images.tmp.npy")
+        images = np.lib.format.open_memmap(
+            temp, mode="w+", dtype=np.uint8,
+            shape=(len(index["files"]), h, w, 1))
+        for i, path in enumerate(index["files"]):
+            images[i] = decode_image(os.path.join(self._source, path),
+                                     self._image_size)
+        images.flush()
+        del images
+        os.replace(temp, os.path.join(self._dir, "images.npy"))
+
+        temp = os.path.join(self._dir, "index.tmp.json")
+        with open(temp, "w") as f:
+            json.dump(index, f)
+        os.replace(temp, os.path.join(self._dir, "index.json"))
+
+        return index
+
+    def load(self):
+        """
+        load() | loads the cache, building it first if the source images
+            have changed since it was stored
+        returns | (np.ndarray, np.ndarray, list( (str) )) read only memory
+            map (n, h, w, 1) of uint8 pixels, (n) int64 label of each image,
+            name of each label
+        """
+        index = self._read_index()
+        if index != self._scan():
+            index = self.build()
+
+        images = np.load(os.path.join(self._dir, "images.npy"),
+                         mmap_mode="r")
+        labels = np.array(index["labels"], dtype=np.int64)
+        return images, labels, index["classes"]
+
+
+def decode_image(path, image_size):
+    """
+    decode_image() | decodes an image the way it is stored in a cache, so
+        images classified later match the images a model was trained on
+    path       | (str) path to the image
+    image_size | (int, int) (h, w) to resize the image to
+    returns    | (np.ndarray) (h, w, 1) of uint8 grayscale pixels
+    """
+    h, w = image_size
+    with Image.open(path) as img:
+        img = img.convert("L").resize((w, h), Image.BILINEAR)
+        return np.asarray(img)[:, :, np.newaxis]
+
+
+def find_images(dir):
+    """
+    find_images() | lists the images in a directory and its sub directories
+    dir     | (str) the directory
+    returns | list( (str) ) paths, sorted
+    """
+    paths = []
+    for root, _, files in os.walk(dir):
+        for file in files:
+            if file.lower().endswith(_EXTENSIONS):
+                paths.append(os.path.join(root, file))
+    return sorted(paths)
+
+
+def decode_batches(paths, batch_size, image_size, threads=None):
+    """
+    decode_batches() | decodes images in batches with decode_image(), each
+        batch is decoded on a pool of threads while the last one is used
+    paths      | list( (str) ) paths of the images
+    batch_size | (int) images per batch
+    image_size | (int, int) (h, w) to resize the images to
+    threads    | (int) (default = None) threads to decode with, None uses
+        one per cpu
+    returns    | generator of (list( (str) ), np.ndarray) the paths in the
+        batch, and (batch_size, h, w, 1) uint8 pixels, the last batch is
+        padded with zeros to the full batch size
+    """
+    def decode(batch_paths):
+        batch = np.zeros((batch_size, *image_size, 1), dtype=np.uint8)
+        for i, pixels in enumerate(executor.map(
+                lambda path: decode_image(path, image_size), batch_paths)):
+            batch[i] = pixels
+        return batch
+
+    batches = [paths[i:i + batch_size]
+               for i in range(0, len(paths), batch_size)]
+    with ThreadPoolExecutor(threads or os.cpu_count()) as executor, \
+            ThreadPoolExecutor(1) as prefetch:
+        next_batch = prefetch.submit(decode, batches[0]) if batches else None
+        for i, batch_paths in enumerate(batches):
+            batch = next_batch.result()
+            if i + 1 < len(batches):
+                next_batch = prefetch.submit(decode, batches[i + 1])
+            yield batch_paths, batch
+
+
+def split_indices(n, validation_split=0.2, seed=123):
+    """
+    split_indices() | randomly splits the images of a cache into training
+        and validation images, the same seed always gives the same split
+    n                | (int) number of images
+    validation_split | (float) (default = 0.2) fraction of the images to
+        validate with
+    seed             | (int) (default = 123) seed of the split
+    returns | (np.ndarray, np.ndarray) indices of the training images, and
+        of the validation images
+    """
+    order = np.random.default_rng(seed).permutation(n)
+    validation = int(n * validation_split)
+    return np.sort(order[validation:]), np.sort(order[:validation])
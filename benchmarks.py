@@ -0,0 +1,215 @@
+"""
+Ethan Armstrong
+Section AD
+
+This module times the hot paths of the Fractal algorithm on representative
+images at several resolutions, writes the results to a JSON file, and
+compares a set of results against a stored baseline to flag regressions
+
+    python3 benchmarks.py run [--output FILE] [--repeat N]
+    python3 benchmarks.py compare [BASELINE] [RESULTS] [--threshold T]
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import tempfile
+import numpy as np
+import PIL
+from PIL import Image
+from Fractal import Fractal
+from ImageTools import scaleImage
+
+# a dense shape, a sparse dust-like fractal, and a state border
+INPUTS = {
+    "circle": "test_imgs/circle.png",
+    "cantor": "imgs/(1.0)SmithVolterraCantor_set_1.png",
+    "border": "state_borders/Colorado-Outline-Map.png",
+}
+# widths each input is scaled to, keeping its aspect ratio
+RESOLUTIONS = [256, 512, 1024]
+# the scales used by calculate_power(), the same as roughness.py
+SCALES = (0.5, 2.6, 0.3)
+
+RESULTS_FILE = "benchmark_results.json"
+BASELINE_FILE = "benchmark_baseline.json"
+
+
+def time_call(func, repeat=5):
+    """
+    time_call() | times a function, calling it enough times per sample that
+        short calls can still be measured
+    func    | function() to time
+    repeat  | (int) (default = 5) number of samples to take
+    returns | (dict) "median" and "min" seconds per call, "repeat",
+        "number" of calls per sample
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    samples = [t / number for t in timer.repeat(repeat, number)]
+
+    return {
+        "median": float(np.median(samples)),
+        "min": min(samples),
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def get_cases(dir):
+    """
+    get_cases() | gets every benchmark, one per function, input and
+        resolution. The scaled inputs are saved to dir, since a Fractal reads
+        its image from a file
+    dir     | (str) directory to save the scaled inputs to
+    returns | list( (str, function()) ) name, function to time
+    """
+    cases = []
+    points = [(np.log(x), 1.6 * np.log(x) + 3) for x in np.arange(0.5, 2.6,
+                                                                  0.3)]
+    cases.append(("_calculate_best_slope",
+                  lambda: Fractal.__new__(Fractal)._calculate_best_slope(
+                      points)))
+
+    for name, path in INPUTS.items():
+        original = Image.open(path)
+
+        for width in RESOLUTIONS:
+            img = scaleImage(original, (width, 0), keep_aspect_ratio=True)
+            scaled_path = os.path.join(dir, f"{name}_{width}.png")
+            img.save(scaled_path)
+            label = f"[{name}@{width}]"
+
+            f = Fractal(scaled_path)
+            # a copy is counted, so nothing cached on the original is used
+            copy = f._img.copy()
+
+            cases.append(("_get_background_color" + label,
+                          lambda f=f, img=copy: f._get_background_color(img)))
+            cases.append(("_count_non_background_pixels" + label,
+                          lambda f=f, img=copy:
+                          f._count_non_background_pixels(img)))
+            cases.append(("scaleImage" + label,
+                          lambda img=copy, width=width: scaleImage(
+                              img, (width * 2, 0), keep_aspect_ratio=True)))
+            cases.append(("_get_scaling_data_process" + label,
+                          lambda f=f: f._get_scaling_data_process(*SCALES)))
+            # a new Fractal each call, so no cached work is reused
+            cases.append(("calculate_power" + label,
+                          lambda path=scaled_path: Fractal(
+                              path).calculate_power(*SCALES)))
+
+    return cases
+
+
+def run(output=RESULTS_FILE, repeat=5, verbose=True):
+    """
+    run() | runs every benchmark and writes the results to a JSON file
+    output  | (str) (default = RESULTS_FILE) file to write
+    repeat  | (int) (default = 5) samples to take of each benchmark
+    verbose | (bool) (default = True) print each result as it finishes
+    returns | (dict) the results that were written
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as dir:
+        for name, func in get_cases(dir):
+            results[name] = time_call(func, repeat)
+            if verbose:
+                print(f"{results[name]['median']*1000:10.3f} ms  {name}")
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    return report
+
+
+def find_regressions(baseline, current, threshold=0.25):
+    """
+    find_regressions() | compares two sets of benchmark results
+    baseline  | (dict) results from run(), to compare against
+    current   | (dict) results from run()
+    threshold | (float) (default = 0.25) fraction a benchmark's median can
+        slow down by before it is a regression
+    returns   | list( (str, float) ) name, current / baseline median of
+        every regression, worst first
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+
+        ratio = result["median"] / baseline["results"][name]["median"]
+        if ratio > 1 + threshold:
+            regressions.append((name, ratio))
+
+    return sorted(regressions, key=lambda pair: pair[1], reverse=True)
+
+
+def compare(baseline_path=BASELINE_FILE, results_path=RESULTS_FILE,
+            threshold=0.25):
+    """
+    compare() | prints how each benchmark changed from the baseline
+    baseline_path | (str) (default = BASELINE_FILE) stored baseline
+    results_path  | (str) (default = RESULTS_FILE) results to check
+    threshold     | (float) (default = 0.25) see find_regressions()
+    returns | (int) number of regressions
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(results_path) as f:
+        current = json.load(f)
+
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            print(f"{'new':>8}  {name}")
+            continue
+        ratio = result["median"] / baseline["results"][name]["median"]
+        print(f"{ratio:7.2f}x  {name}")
+
+    regressions = find_regressions(baseline, current, threshold)
+    print("="*12)
+    for name, ratio in regressions:
+        print(f"REGRESSION {ratio:.2f}x slower: {name}")
+    print(f"{len(regressions)} regression(s) over {threshold:.0%}")
+
+    return len(regressions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--output", default=RESULTS_FILE)
+    run_parser.add_argument("--repeat", type=int, default=5)
+
+    compare_parser = commands.add_parser(
+        "compare", help="flag regressions against a baseline")
+    compare_parser.add_argument("baseline", nargs="?", default=BASELINE_FILE)
+    compare_parser.add_argument("results", nargs="?", default=RESULTS_FILE)
+    compare_parser.add_argument("--threshold", type=float, default=0.25)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args.output, args.repeat)
+    elif compare(args.baseline, args.results, args.threshold) > 0:
+        sys.exit(1)
+
+
+if "__main__" in __name__:
+    main()
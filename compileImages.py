@@ -10,11 +10,20 @@ This module provides a variety of functions for
     downloading and saving images
 """
 
-import requests
+import io
 import re
+import json
+import time
+import argparse
+import requests
 import ImageTools
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from DedupeIndex import DedupeIndex
+from HttpStore import HttpStore, request_key
 from serpapi import GoogleSearch
-from PIL import Image, UnidentifiedImageError
+from PIL import Image
 
 
 def normalize_html(text):
@@ -73,43 +82,309 @@ def parse_image_html(s):
     return "https:" + match.group(1)
 
 
-def get_image_from_url(url):
+# disguise as actual user to avoid Forbidden response
+HEADERS = {
+    "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:100.0)"
+                   "Gecko/20100101 Firefox/100.0")
+}
+# (connect, read) seconds before a request to a stalled host gives up
+TIMEOUT = (5, 30)
+# number of times a failed request is retried, waiting
+# BACKOFF * 2^(retry - 1) seconds before each retry
+RETRIES = 3
+BACKOFF = 0.5
+# most images downloaded at once, and most connections kept open per host
+MAX_WORKERS = 8
+# downloads are abandoned past MAX_BYTES or MAX_SECONDS, and images with
+# more than MAX_PIXELS are rejected from their header before being decoded
+MAX_BYTES = 32 * 2**20
+MAX_SECONDS = 60
+MAX_PIXELS = 40_000_000
+# images are reduced while decoding until their longest side is at most
+# MAX_SIDE pixels
+MAX_SIDE = 2048
+# seconds a stored response is replayed for before it is downloaded again,
+# None never expires
+WIKI_TTL = 24 * 60 * 60
+SEARCH_TTL = 30 * 24 * 60 * 60
+IMAGE_TTL = None
+# directory responses are recorded in
+STORE_DIR = "http_store"
+# bytes read from a download at a time
+_CHUNK = 1 << 16
+# an image whose header can not be read in this many bytes is malformed
+_HEADER_BYTES = 1 << 20
+
+
+def make_session(max_workers=MAX_WORKERS, retries=RETRIES, backoff=BACKOFF):
     """
-    get_image_from_url() | downloads an image from the internet given its url
-    url | the url of the iamge to be downloaded
-    returns | (PIL.Image) if the Image could be downloaded, None if not
+    make_session() | creates a session that keeps connections to each host
+        open between requests, and retries failed requests
+    max_workers | (int) (default = MAX_WORKERS) most connections kept open
+        to each host, should be at least the number of threads using it
+    retries     | (int) (default = RETRIES) times a request is retried after
+        a connection error, timeout, or 429 / 5xx response
+    backoff     | (float) (default = BACKOFF) seconds waited before the first
+        retry, doubling for each retry after it
+    returns | (requests.Session) which the caller should close
     """
-    if url is None:
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=max_workers,
+                          pool_maxsize=max_workers, max_retries=retry)
+
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _open_header(data):
+    """
+    _open_header() | reads the header of a possibly incomplete image file,
+        without decoding its pixels
+    data    | (bytes) the start of the file
+    returns | (PIL.Image) the unloaded image, None if the header is not all
+        there or is not an image
+    """
+    try:
+        return Image.open(io.BytesIO(data))
+    # a cut off header can fail in many ways, depending on the format
+    except(Exception):
         return None
 
-    # disguise as actual user to avoid Forbidden response
-    headers = {
-        "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:100.0)"
-                       "Gecko/20100101 Firefox/100.0")
-    }
+
+def _read_capped(res, url, max_bytes, max_pixels):
+    """
+    _read_capped() | reads a streamed image download, giving up as soon as
+        it is too large, too slow, or its header shows it is not an image or
+        has too many pixels
+    res        | (requests.Response) a response made with stream=True
+    url        | (str) the url, for the messages printed when giving up
+    max_bytes  | (int) most bytes to read
+    max_pixels | (int) most pixels the image can have
+    returns    | (bytes) the whole file, None if it was rejected
+    """
+    length = res.headers.get("Content-Length")
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        print("too large", url)
+        return None
+    if res.headers.get("Content-Type", "").startswith("text/"):
+        print("not an image", url)
+        return None
+
+    deadline = time.monotonic() + MAX_SECONDS
+    data = bytearray()
+    checked = False
+
+    for chunk in res.iter_content(_CHUNK):
+        data += chunk
+        if len(data) > max_bytes:
+            print("too large", url)
+            return None
+        if time.monotonic() > deadline:
+            print("too slow", url)
+            return None
+
+        if not checked:
+            header = _open_header(bytes(data))
+            if header is not None:
+                checked = True
+                if header.width * header.height > max_pixels:
+                    print("too many pixels", header.size, url)
+                    return None
+            elif len(data) >= _HEADER_BYTES:
+                print("not an image", url)
+                return None
+
+    return bytes(data)
+
+
+def _decode_image(data, max_pixels, max_side):
+    """
+    _decode_image() | decodes a downloaded image, reducing it to fit in
+        max_side while it is decoded, JPEGs are decoded straight to 1/2, 1/4
+        or 1/8 size (Image.draft)
+    data       | (bytes) the image file
+    max_pixels | (int) most pixels the image can have
+    max_side   | (int) most pixels on the longest side of the decoded image
+    returns    | (PIL.Image) None if the image is too large or malformed
+    """
+    img = _open_header(data)
+    if img is None or img.width * img.height > max_pixels:
+        return None
+
+    try:
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side))
+        else:
+            img.load()
+    except(OSError, ValueError, SyntaxError):
+        return None
+    return img
+
+
+def _download_image(url, session, timeout, max_bytes, max_pixels):
+    """
+    _download_image() | downloads the bytes of an image, the download is
+        streamed and abandoned as soon as it is too large
+    url        | (str) the url of the image
+    session    | (requests.Session) session to download with, None makes a
+        single request without retries
+    timeout    | (float, float) connect and read timeouts
+    max_bytes  | (int) most bytes to download
+    max_pixels | (int) most pixels the image can have
+    returns    | (bytes) None if it could not be downloaded
+    """
+    get = requests.get if session is None else session.get
 
     # get a response via https, if that fails
     # (the site it http, or invalid cert), try without verifying
-    res = None
     try:
-        res = requests.get(url, stream=True, headers=headers)
-    except(requests.Timeout):
-        res = requests.get(url, stream=True, verify=False, headers=headers)
-
-    if res.status_code == 200:
         try:
-            return Image.open(res.raw)
-        except(UnidentifiedImageError):
-            return None
+            res = get(url, stream=True, headers=HEADERS, timeout=timeout)
+        except(requests.exceptions.SSLError):
+            res = get(url, stream=True, verify=False, headers=HEADERS,
+                      timeout=timeout)
+
+        with res:
+            if res.status_code != 200:
+                print(res.status_code, url)
+                return None
+            return _read_capped(res, url, max_bytes, max_pixels)
+    except(requests.RequestException) as e:
+        print(type(e).__name__, url)
+        return None
+
+
+def get_image_from_url(url, session=None, timeout=TIMEOUT,
+                       max_bytes=MAX_BYTES, max_pixels=MAX_PIXELS,
+                       max_side=MAX_SIDE, store=None):
+    """
+    get_image_from_url() | downloads an image from the internet given its
+        url, the download is streamed and abandoned as soon as it is too
+        large
+    url        | the url of the iamge to be downloaded
+    session    | (requests.Session) (default = None) session to download
+        with, from make_session(), None makes a single request without
+        retries
+    timeout    | (float, float) (default = TIMEOUT) connect and read timeouts
+    max_bytes  | (int) (default = MAX_BYTES) most bytes to download
+    max_pixels | (int) (default = MAX_PIXELS) most pixels the image can have
+    max_side   | (int) (default = MAX_SIDE) the image is reduced while it is
+        decoded, until its longest side is at most this many pixels
+    store      | (HttpStore) (default = None) replays the image if it is
+        stored, and records it if it is downloaded
+    returns    | (PIL.Image) if the Image could be downloaded, None if not
+    """
+    if url is None:
+        return None
 
-    print(res.status_code, url)
-    return None
+    def download():
+        return _download_image(url, session, timeout, max_bytes, max_pixels)
 
+    if store is None:
+        data = download()
+    else:
+        data = store.load(request_key(url), url, download, IMAGE_TTL)
 
-def get_alternative_images(name):
+    if data is None:
+        return None
+
+    img = _decode_image(data, max_pixels, max_side)
+    if img is None:
+        print("not an image", url)
+    return img
+
+
+def _download_mono(url, session, timeout, store):
+    """
+    _download_mono() | downloads an image and converts it to black and white
+    url     | (str) the url of the image
+    session | (requests.Session) session to download with
+    timeout | (float, float) connect and read timeouts
+    store   | (HttpStore) store to replay and record the image with, or None
+    returns | (PIL.Image) "1" mode image, None if it could not be downloaded
+    """
+    img = get_image_from_url(url, session, timeout, store=store)
+    if img is None:
+        return None
+    return ImageTools.to_mono(img)
+
+
+def download_images(urls, session=None, max_workers=MAX_WORKERS,
+                    timeout=TIMEOUT, store=None):
+    """
+    download_images() | downloads images on a pool of threads, and converts
+        each to black and white as soon as it is downloaded
+    urls        | list( (str) ) urls of the images
+    session     | (requests.Session) (default = None) session to download
+        with, None creates one with make_session() for these downloads
+    max_workers | (int) (default = MAX_WORKERS) most downloads at once
+    timeout     | (float, float) (default = TIMEOUT) connect and read
+        timeouts of each request
+    store       | (HttpStore) (default = None) replays the images that are
+        stored, and records the images that are downloaded
+    returns | list( (str, PIL.Image) ) url, "1" mode image or None if it
+        could not be downloaded, in the same order as urls
+    """
+    own_session = session is None
+    if own_session:
+        session = make_session(max_workers)
+
+    try:
+        with ThreadPoolExecutor(max_workers) as executor:
+            imgs = executor.map(
+                lambda url: _download_mono(url, session, timeout, store),
+                urls)
+            return list(zip(urls, imgs))
+    finally:
+        if own_session:
+            session.close()
+
+
+def save_images(name, power, images, dir="imgs"):
+    """
+    save_images() | saves the downloaded images of a fractal, skipping
+        alternatives that are near-duplicates of an image already saved
+    name   | (str) file name of the fractal, from format_file_name()
+    power  | (float) dimension of the fractal
+    images | list( (str, PIL.Image) ) from download_images(), the first is
+        the main image and the rest are alternatives
+    dir    | (str) (default = "imgs") directory to save to
+    returns | list( (str) ) paths of the saved images
+    """
+    index = DedupeIndex()
+    saved = []
+
+    # alternatives are numbered from 1, in the order they are saved
+    i = 1
+    for j, (url, img) in enumerate(images):
+        if img is None:
+            continue
+        if index.add_if_new(url, ImageTools.perceptual_hash(img)) is not None:
+            continue
+
+        if j == 0:
+            path = f"{dir}/({power}){name}.png"
+        else:
+            path = f"{dir}/({power}){name}_{i}.png"
+            i += 1
+        img.save(path)
+        saved.append(path)
+
+    return saved
+
+
+def get_alternative_images(name, store=None):
     """
     get_alternative_images() | gets alternative images from google given
         the image name
+    name    | (str) name of the fractal
+    store   | (HttpStore) (default = None) replays the search results if
+        they are stored, and records them if they are searched
     returns | list( (str) ) list of links to the alternative images
     """
     name += " HD fractal"
@@ -125,13 +400,28 @@ def get_alternative_images(name):
         "q": name,
         "google_domain": "google.com",
         "tbm": "isch",
-        "api_key": API
     }
 
-    search = GoogleSearch(params)
-    results = search.get_dict()
+    def search():
+        results = GoogleSearch(dict(params, api_key=API)).get_dict()
+        # errors (out of searches, bad key, ...) are not stored, so the
+        # search is tried again next time
+        if "error" in results or "images_results" not in results:
+            print(results.get("error", "no images found"))
+            return None
+        return json.dumps(results).encode("utf-8")
+
+    if store is None:
+        body = search()
+    else:
+        url = "https://serpapi.com/search"
+        body = store.load(request_key(url, params), url, search, SEARCH_TTL)
 
-    first8 = results["images_results"][:8]
+    if body is None:
+        return []
+
+    results = json.loads(body)
+    first8 = results.get("images_results", [])[:8]
     return [image["original"] for image in first8 if "original" in image]
 
 
@@ -146,27 +436,70 @@ def format_file_name(name):
     return name
 
 
-def main():
-    res = requests.get(WIKI_URL)
+def parse_fractals(html):
+    """
+    parse_fractals() | gets the fractals listed in the html of the wikipedia
+        list of fractals by hausdorff dimension
+    html    | (str) html of the page
+    returns | list( (str, float, str) ) name, power, link to the image
+    """
+    # matches the fractal name, power and image list
+    pat = r'<tr>\n[\s\S\n]*?<\/td>\n.*?>(.*)<\/td>\n<td>(.*)<.*\n(.*)'
+    match = re.findall(pat, html)
+
+    # gets data and normalizes text
+    fractals = []
+    for i in range(len(match)):
+        m = match[i]
+
+        power = normalize_float(m[0])
+
+        if power is not None:
+            name = normalize_html(m[1])
+            image = parse_image_html(m[2])
+            fractals.append((name, power, image))
+
+    return fractals
 
-    if res.status_code == 200:
-        html = res.text
 
-        # matches the fractal name, power and image list
-        pat = r'<tr>\n[\s\S\n]*?<\/td>\n.*?>(.*)<\/td>\n<td>(.*)<.*\n(.*)'
-        match = re.findall(pat, html)
+def get_page(url, session, store=None):
+    """
+    get_page() | downloads the html of a page
+    url     | (str) url of the page
+    session | (requests.Session) session to download with
+    store   | (HttpStore) (default = None) replays the page if it is
+        stored, and records it if it is downloaded
+    returns | (str) None if the page could not be downloaded
+    """
+    def download():
+        # once the retries run out the page is skipped, like an image
+        try:
+            res = session.get(url, timeout=TIMEOUT)
+        except(requests.RequestException) as e:
+            print(type(e).__name__, url)
+            return None
+        if res.status_code != 200:
+            print(res.status_code, url)
+            return None
+        return res.content
 
-        # gets data and normalizes text
-        fractals = []
-        for i in range(len(match)):
-            m = match[i]
+    if store is None:
+        body = download()
+    else:
+        body = store.load(request_key(url), url, download, WIKI_TTL)
 
-            power = normalize_float(m[0])
+    return None if body is None else body.decode("utf-8")
 
-            if power is not None:
-                name = normalize_html(m[1])
-                image = parse_image_html(m[2])
-                fractals.append((name, power, image))
+
+def main(store=None):
+    # one session, so connections to each host are reused between
+    # fractals
+    with make_session() as session:
+        html = get_page(WIKI_URL, session, store)
+        if html is None:
+            return
+
+        fractals = parse_fractals(html)
 
         with open("results.txt", "w", encoding="utf-8") as f:
             for fractal in fractals:
@@ -176,7 +509,7 @@ def main():
                 f.write("\n")
 
                 # write alt links to file
-                alts = get_alternative_images(fractal[0])
+                alts = get_alternative_images(fractal[0], store)
                 for alt in alts:
                     f.write("\t")
                     f.write(alt)
@@ -184,21 +517,11 @@ def main():
 
                 # save to folder
                 name, power, link = fractal
-
                 name = format_file_name(name)
 
-                img = get_image_from_url(link)
-                if img is not None:
-                    img = ImageTools.to_mono(img)
-                    img.save("imgs/(" + str(power) + ")" + name + ".png")
-
-                i = 1
-                for link in alts:
-                    img = get_image_from_url(link)
-                    if img is not None:
-                        img = ImageTools.to_mono(img)
-                        img.save(f"imgs/({power}){name}_{i}.png")
-                        i += 1
+                images = download_images([link] + alts, session,
+                                         store=store)
+                save_images(name, power, images)
 
 
 if "__main__" in __name__:
@@ -206,4 +529,16 @@ if "__main__" in __name__:
         "https://en.wikipedia.org/"
         "wiki/List_of_fractals_by_Hausdorff_dimension"
     )
-    main()
+
+    parser = argparse.ArgumentParser(
+        description="downloads the fractal images into imgs")
+    parser.add_argument("--store", default=STORE_DIR,
+                        help="directory responses are recorded in")
+    parser.add_argument("--offline", action="store_true",
+                        help="only replay recorded responses")
+    parser.add_argument("--refresh", action="store_true",
+                        help="download everything again, and record it")
+    args = parser.parse_args()
+
+    with HttpStore(args.store, args.offline, args.refresh) as store:
+        main(store)
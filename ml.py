@@ -1,84 +1,376 @@
-"""
-Jerry Gao
-Section AD
-
-This program takes two folders of images and trains a machine learning
-algorithm to determine whether a given image is hand-drawn or
-computer-generated.
-"""
-
-import tensorflow as tf
-from tensorflow import keras
-from keras import layers
-
-
-def main():
-    tf.get_logger().setLevel('WARNING')
-
-    img_height = img_width = 50
-
-    # This generates the training dataset from our own image
-    # by splitting all images randomly.
-    ds_train = tf.keras.preprocessing.image_dataset_from_directory(
-        'images',
-        labels='inferred',
-        label_mode="categorical",
-        color_mode='grayscale',
-        batch_size=32,
-        image_size=(img_height, img_width),
-        shuffle=True,
-        seed=123,
-        validation_split=0.2,
-        subset="training"
-    )
-
-    # This generates the validating dataset with a similar process as how
-    # we have generated our training dataset.
-    ds_validate = tf.keras.preprocessing.image_dataset_from_directory(
-        'images',
-        labels='inferred',
-        label_mode="categorical",
-        color_mode='grayscale',
-        batch_size=32,
-        image_size=(img_height, img_width),
-        shuffle=True,
-        seed=123,
-        validation_split=0.2,
-        subset="validation"
-    )
-
-    # This sets up the model with specific amounts of layers, dense
-    # layers, and initial neurons. In this setup, there are 4 layers,
-    # 3 dense layers, and 32 initial neurons.
-    model = keras.Sequential(
-        [
-            keras.Input(shape=(50, 50, 1)),
-            layers.Conv2D(32, 3, activation='relu'),
-            layers.MaxPool2D(pool_size=(2, 2)),
-            layers.Conv2D(64, 3, activation='relu'),
-            layers.MaxPool2D(),
-            layers.Conv2D(128, 3, activation='relu'),
-            layers.MaxPool2D(),
-            layers.Conv2D(256, 3, activation='relu'),
-            layers.MaxPool2D(),
-            layers.Flatten(),
-            layers.Dense(32, activation='relu'),
-            layers.Dense(16, activation='relu'),
-            layers.Dense(2),
-        ]
-    )
-
-    model.compile(
-        loss=keras.losses.CategoricalCrossentropy(from_logits=True),
-        optimizer=keras.optimizers.Adam(lr=3e-4),
-        metrics=["accuracy"]
-    )
-
-    model.fit(ds_train, batch_size=32, epochs=25, verbose=2)
-    model.evaluate(ds_validate, batch_size=32, verbose=2)
-
-    print(model.summary())
-
-
-if "__main__" in __name__:
-    main()
+"""
+Jerry Gao
+Section AD
+
+This program takes two folders of images and trains a machine learning
+algorithm to determine whether a given image is hand-drawn or
+computer-generated.
+"""
+
+import os
+import csv
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from keras import layers
+from TensorCache import (TensorCache, split_indices, find_images,
+                         decode_batches)
+import BoxSignature
+
+# the decoded images are cached here, and rebuilt when images/ changes
+CACHE_DIR = "tensor_cache"
+# the trained model, its int8 export, and the name of each of its labels
+MODEL_DIR = "models"
+MODEL_FILE = "fractal_cnn.keras"
+TFLITE_FILE = "fractal_cnn_int8.tflite"
+CLASSES_FILE = "classes.json"
+IMAGE_SIZE = (50, 50)
+# images the int8 export is calibrated on
+CALIBRATION_IMAGES = 100
+
+
+def make_dataset(images, labels, indices, classes, batch_size=32,
+                 shuffle=False, seed=123):
+    """
+    make_dataset() | makes a dataset of images from a TensorCache, the
+        pixels of the images used are gathered from the memory map in one
+        vectorized copy, so no python runs per image
+    images     | (np.ndarray) (n, h, w, 1) uint8 pixels from TensorCache
+    labels     | (np.ndarray) (n) label of each image
+    indices    | (np.ndarray) indices of the images to use
+    classes    | list( (str) ) name of each label
+    batch_size | (int) (default = 32) images per batch
+    shuffle    | (bool) (default = False) shuffle the images every epoch
+    seed       | (int) (default = 123) seed of the shuffle
+    returns    | (tf.data.Dataset) batches of (float32 pixels, one hot
+        labels), the same as image_dataset_from_directory() with
+        label_mode="categorical"
+    """
+    def to_tensors(img, label):
+        return tf.cast(img, tf.float32), tf.one_hot(label, len(classes))
+
+    ds = tf.data.Dataset.from_tensor_slices((images[indices],
+                                             labels[indices]))
+    ds = ds.map(to_tensors, num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.cache()
+    if shuffle:
+        ds = ds.shuffle(len(indices), seed=seed,
+                        reshuffle_each_iteration=True)
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def build_model(num_classes=2):
+    """
+    build_model() | creates the untrained classifier
+    num_classes | (int) (default = 2) number of labels
+    returns     | (keras.Model) compiled, outputs one logit per label
+    """
+    # This sets up the model with specific amounts of layers, dense
+    # layers, and initial neurons. In this setup, there are 4 layers,
+    # 3 dense layers, and 32 initial neurons.
+    model = keras.Sequential(
+        [
+            keras.Input(shape=(*IMAGE_SIZE, 1)),
+            layers.Conv2D(32, 3, activation='relu'),
+            layers.MaxPool2D(pool_size=(2, 2)),
+            layers.Conv2D(64, 3, activation='relu'),
+            layers.MaxPool2D(),
+            layers.Conv2D(128, 3, activation='relu'),
+            layers.MaxPool2D(),
+            layers.Conv2D(256, 3, activation='relu'),
+            layers.MaxPool2D(),
+            layers.Flatten(),
+            layers.Dense(32, activation='relu'),
+            layers.Dense(16, activation='relu'),
+            layers.Dense(num_classes),
+        ]
+    )
+
+    model.compile(
+        loss=keras.losses.CategoricalCrossentropy(from_logits=True),
+        optimizer=keras.optimizers.Adam(learning_rate=3e-4),
+        metrics=["accuracy"]
+    )
+    return model
+
+
+def export_tflite(model, images, indices, path):
+    """
+    export_tflite() | exports a model to TFLite with int8 weights and
+        activations, calibrated on some of the training images. The input is
+        uint8 pixels, so images do not need to be converted to classify them
+    model   | (keras.Model) trained model
+    images  | (np.ndarray) (n, h, w, 1) uint8 pixels from TensorCache
+    indices | (np.ndarray) indices of the images to calibrate on
+    path    | (str) file to write
+    returns | (int) size of the export in bytes
+    """
+    def representative_dataset():
+        for i in indices[:CALIBRATION_IMAGES]:
+            yield [images[i:i + 1].astype(np.float32)]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.uint8
+
+    exported = converter.convert()
+    with open(path, "wb") as f:
+        f.write(exported)
+    return len(exported)
+
+
+def load_datasets():
+    """
+    load_datasets() | loads the cached images of images/, split into
+        training and validating datasets
+    returns | (np.ndarray, list( (str) ), np.ndarray, tf.data.Dataset,
+        tf.data.Dataset) the cached pixels, name of each label, indices of
+        the training images, the training and validating datasets
+    """
+    # Every image is decoded once into the cache, and only decoded again
+    # when a file in images/ is added, removed or modified.
+    cache = TensorCache('images', CACHE_DIR, IMAGE_SIZE)
+    images, labels, classes = cache.load()
+
+    # This generates the training and validating datasets from our own
+    # images by splitting all images randomly.
+    train_indices, validate_indices = split_indices(
+        len(labels), validation_split=0.2, seed=123)
+    ds_train = make_dataset(images, labels, train_indices, classes,
+                            batch_size=32, shuffle=True, seed=123)
+    ds_validate = make_dataset(images, labels, validate_indices, classes,
+                               batch_size=32)
+    return images, classes, train_indices, ds_train, ds_validate
+
+
+def train(epochs=25, dir=MODEL_DIR):
+    """
+    train() | trains the classifier on images/, then saves it and its int8
+        export to dir
+    epochs  | (int) (default = 25) passes over the training images
+    dir     | (str) (default = MODEL_DIR) directory to save the model to
+    returns | (keras.Model) the trained model
+    """
+    images, classes, train_indices, ds_train, ds_validate = load_datasets()
+
+    model = build_model(len(classes))
+    model.fit(ds_train, batch_size=32, epochs=epochs, verbose=2)
+    model.evaluate(ds_validate, batch_size=32, verbose=2)
+
+    print(model.summary())
+
+    # The model is saved with the names of its labels, so images can be
+    # classified later without training again.
+    os.makedirs(dir, exist_ok=True)
+    model.save(os.path.join(dir, MODEL_FILE))
+    with open(os.path.join(dir, CLASSES_FILE), "w") as f:
+        json.dump(classes, f)
+    size = export_tflite(model, images, train_indices,
+                         os.path.join(dir, TFLITE_FILE))
+    print(f"saved to {dir}, int8 export is {size / 1024:.1f} KB")
+
+    return model
+
+
+def compare(epochs=25, jobs=None):
+    """
+    compare() | trains and validates the CNN and the box counting signature
+        classifier (BoxSignature.py) on the same split of images/, and
+        prints their accuracy and time side by side
+    epochs  | (int) (default = 25) passes of the CNN over the training images
+    jobs    | (int) (default = one per cpu) images the signature classifier
+        counts at the same time
+    returns | (dict) "cnn" and "signature" results, each with "accuracy",
+        "train_seconds" and "inference_seconds"
+    """
+    # The signature classifier counts on forked worker processes, which
+    # can deadlock if TensorFlow has already started its threads, so it
+    # runs before anything touches TensorFlow. Nothing is cached, so its
+    # times are of counting every image, not of reading stored counts.
+    signature = BoxSignature.evaluate('images', jobs, cache=None)
+
+    images, classes, train_indices, ds_train, ds_validate = load_datasets()
+
+    start = time.perf_counter()
+    model = build_model(len(classes))
+    model.fit(ds_train, batch_size=32, epochs=epochs, verbose=0)
+    train_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, accuracy = model.evaluate(ds_validate, batch_size=32, verbose=0)
+    results = {
+        "cnn": {"accuracy": accuracy, "train_seconds": train_seconds,
+                "inference_seconds": time.perf_counter() - start},
+        "signature": signature,
+    }
+
+    # The signature times include counting the boxes of every image, the
+    # CNN times do not include decoding the images, which are cached.
+    print(f"{'model':>10} {'accuracy':>9} {'train':>9} {'inference':>10}")
+    for name, result in results.items():
+        print(f"{name:>10} {result['accuracy']:9.1%} "
+              f"{result['train_seconds']:8.2f}s "
+              f"{result['inference_seconds']:9.2f}s")
+
+    return results
+
+
+def _load_predictor(path, batch_size, threads):
+    """
+    _load_predictor() | loads a saved model for classifying batches
+    path       | (str) a .tflite export, or a saved keras model
+    batch_size | (int) images per batch
+    threads    | (int) threads to run a .tflite export on, None lets
+        TensorFlow choose, see _set_threads() for keras models
+    returns    | function(np.ndarray) (batch_size, h, w, 1) uint8 pixels ->
+        (np.ndarray) (batch_size, labels) logits
+    """
+    if not path.endswith(".tflite"):
+        model = keras.models.load_model(path)
+        return lambda batch: model.predict_on_batch(
+            batch.astype(np.float32))
+
+    interpreter = tf.lite.Interpreter(model_path=path, num_threads=threads)
+    input_details = interpreter.get_input_details()[0]
+    output = interpreter.get_output_details()[0]
+    interpreter.resize_tensor_input(input_details["index"],
+                                    [batch_size, *IMAGE_SIZE, 1])
+    interpreter.allocate_tensors()
+
+    def predict(batch):
+        # uint8 pixels are quantized to the input, which only changes them
+        # if the calibration images did not use every value from 0 to 255
+        scale, zero = input_details["quantization"]
+        if scale:
+            dtype = input_details["dtype"]
+            batch = np.round(batch / scale + zero)
+            batch = np.clip(batch, np.iinfo(dtype).min,
+                            np.iinfo(dtype).max).astype(dtype)
+        interpreter.set_tensor(input_details["index"], batch)
+        interpreter.invoke()
+        logits = interpreter.get_tensor(output["index"])
+        # an int8 output is converted back to logits
+        scale, zero = output["quantization"]
+        if scale:
+            logits = (logits.astype(np.float32) - zero) * scale
+        return logits
+
+    return predict
+
+
+def _set_threads(threads):
+    """
+    _set_threads() | sets the threads TensorFlow runs keras models on, which
+        can only be changed before TensorFlow first runs anything
+    threads | (int) threads to run on
+    returns | (bool) False if TensorFlow has already started, and kept the
+        threads it had
+    """
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    except RuntimeError:
+        print("TensorFlow has already started, using its own threads")
+        return False
+    return True
+
+
+def classify(paths, model_dir=MODEL_DIR, batch_size=256, threads=None,
+             keras_model=False):
+    """
+    classify() | classifies images in large batches on the CPU, each batch
+        is decoded on a pool of threads while the last one is classified
+    paths       | list( (str) ) paths of the images
+    model_dir   | (str) (default = MODEL_DIR) directory the model was saved
+        to by train()
+    batch_size  | (int) (default = 256) images classified at once
+    threads     | (int) (default = None) threads to decode and classify
+        with, None uses one per cpu
+    keras_model | (bool) (default = False) classify with the saved keras
+        model instead of its int8 export
+    returns     | (list( (str, str, float) ), float) path, label and
+        probability of the label for each image, images per second
+    """
+    # before anything else, so TensorFlow has not started yet
+    if keras_model and threads is not None:
+        _set_threads(threads)
+
+    with open(os.path.join(model_dir, CLASSES_FILE)) as f:
+        classes = json.load(f)
+    model_file = MODEL_FILE if keras_model else TFLITE_FILE
+    predict = _load_predictor(os.path.join(model_dir, model_file),
+                              batch_size, threads)
+
+    results = []
+    start = time.perf_counter()
+    for batch_paths, batch in decode_batches(paths, batch_size, IMAGE_SIZE,
+                                             threads):
+        # the padding at the end of the last batch is dropped
+        logits = np.asarray(predict(batch))[:len(batch_paths)]
+        probs = tf.nn.softmax(logits).numpy()
+        for path, prob in zip(batch_paths, probs):
+            label = int(np.argmax(prob))
+            results.append((path, classes[label], float(prob[label])))
+
+    seconds = time.perf_counter() - start
+    return results, len(paths) / seconds if seconds > 0 else 0.0
+
+
+def main():
+    tf.get_logger().setLevel('WARNING')
+
+    parser = argparse.ArgumentParser(
+        description="trains and runs the hand-drawn vs generated classifier")
+    commands = parser.add_subparsers(dest="command")
+
+    train_parser = commands.add_parser(
+        "train", help="train on images/ and save the model (the default)")
+    train_parser.add_argument("--epochs", type=int, default=25)
+
+    compare_parser = commands.add_parser(
+        "compare", help="compare the CNN to the box counting signature "
+                        "classifier")
+    compare_parser.add_argument("--epochs", type=int, default=25)
+    compare_parser.add_argument("--jobs", type=int, default=None)
+
+    classify_parser = commands.add_parser(
+        "classify", help="classify every image in a directory")
+    classify_parser.add_argument("dir")
+    classify_parser.add_argument("--batch-size", type=int, default=256)
+    classify_parser.add_argument("--threads", type=int, default=None)
+    classify_parser.add_argument("--keras", action="store_true",
+                                 help="use the keras model, not the int8 "
+                                      "export")
+    classify_parser.add_argument("--output", default=None,
+                                 help="CSV file to write the labels to")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        compare(args.epochs, args.jobs)
+        return
+    if args.command != "classify":
+        train(getattr(args, "epochs", 25))
+        return
+
+    paths = find_images(args.dir)
+    results, rate = classify(paths, MODEL_DIR, args.batch_size,
+                             args.threads, args.keras)
+    if args.output is None:
+        for path, label, prob in results:
+            print(f"{label:>12} {prob:6.1%}  {path}")
+    else:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["path", "label", "probability"])
+            writer.writerows(results)
+    print(f"{len(results)} images, {rate:.1f} images/second")
+
+
+if "__main__" in __name__:
+    main()
@@ -8,43 +8,152 @@ state in the continental US
 """
 
 import os
+import json
+import time
+import argparse
+import numpy as np
 from matplotlib import pyplot as plt
-from Fractal import Fractal
-import geopandas as gpd
+from Fractal import analyze_many, fit_line
+from ResultCache import ResultCache
+from BoxCounting import count_boxes_segments
 
+# the vector engine counts boxes from MIN_BOXES to MAX_BOXES across the
+# longest side of each state, at VECTOR_SCALES sizes spaced evenly in log
+MIN_BOXES = 8
+MAX_BOXES = 512
+VECTOR_SCALES = 12
 
-def get_state_roughness(dir):
+
+def get_state_roughness(dir, jobs=None, cache=None):
     """
     get_state_roughness() | compiles list of state roughness given a directory
-    dir | (str) the path to the directory containing images in the format of
+    dir   | (str) the path to the directory containing images in the format of
         "State-Name-Outline-Map.png"
+    jobs  | (int) (default = one per cpu) images analyzed at the same time
+    cache | (ResultCache) (default = None) cache of previous results, only
+        new or modified images are analyzed
     returns | list((str, float)) | [("State Name", 1.8), ...]
     """
+    paths = [dir + "/" + file for file in os.listdir(dir)]
+
     vals = []
-    for file in os.listdir(dir):
-        path = dir + "/" + file
+    results = analyze_many(paths, jobs, start=0.5, stop=2.6, inc=0.3,
+                           log=True, cache=cache)
+    for path, power, diagnostics in results:
+        name = " ".join(os.path.basename(path).split("-")[:-2])
+
+        if power is None:
+            print(name, diagnostics["error"])
+            continue
+        print(name, power)
 
-        name = " ".join(file.split("-")[:-2])
+        vals.append((name, power))
+    return vals
 
-        print(name)
 
-        f = Fractal(path)
-        power = f.calculate_power(0.5, 2.6, 0.3, log=True)
-        print(name, power)
+def read_state_borders(path):
+    """
+    read_state_borders() | reads the borders of each state from a GeoJSON
+        file of polygons and multipolygons
+    path    | (str) path to the GeoJSON file
+    returns | (dict) "State Name" -> list( (np.ndarray) ) every ring of the
+        state's polygons, outer borders and holes, as (n, 2) lon, lat
+    """
+    with open(path, encoding="latin-1") as f:
+        features = json.load(f)["features"]
+
+    borders = {}
+    for feature in features:
+        geometry = feature["geometry"]
+        polygons = geometry["coordinates"]
+        if geometry["type"] == "Polygon":
+            polygons = [polygons]
+
+        rings = [np.array(ring, dtype=float)[:, :2]
+                 for polygon in polygons for ring in polygon]
+        borders[feature["properties"]["NAME"]] = rings
+    return borders
+
+
+def border_segments(rings):
+    """
+    border_segments() | gets the edges of a state's rings as line segments,
+        projected so a degree of longitude is as long as it is at the
+        state's middle latitude, and moved so every point is positive
+    rings   | list( (np.ndarray) ) (n, 2) lon, lat of each ring
+    returns | (np.ndarray, np.ndarray) starts, ends (n, 2) x, y
+    """
+    points = np.concatenate(rings)
+    middle = (points[:, 1].min() + points[:, 1].max()) / 2
+    scale = np.array([np.cos(np.radians(middle)), 1.0])
+    low = points.min(axis=0) * scale
 
+    starts = np.concatenate([ring[:-1] for ring in rings]) * scale - low
+    ends = np.concatenate([ring[1:] for ring in rings]) * scale - low
+    return starts, ends
+
+
+def get_vector_power(rings, min_boxes=MIN_BOXES, max_boxes=MAX_BOXES,
+                     scales=VECTOR_SCALES):
+    """
+    get_vector_power() | calculates the box counting dimension of a border
+        from its exact geometry, counting the boxes its edges pass through
+        instead of drawing it to an image
+    rings     | list( (np.ndarray) ) (n, 2) lon, lat of each ring
+    min_boxes | (float) (default = MIN_BOXES) boxes across the longest side
+        at the largest box size
+    max_boxes | (float) (default = MAX_BOXES) boxes across the longest side
+        at the smallest box size
+    scales    | (int) (default = VECTOR_SCALES) number of box sizes
+    returns   | (float) slope of log(count) over log(1 / box size)
+    """
+    starts, ends = border_segments(rings)
+    extent = np.maximum(starts.max(axis=0), ends.max(axis=0)).max()
+
+    points = []
+    for boxes in np.geomspace(min_boxes, max_boxes, scales):
+        size = extent / boxes
+        count = count_boxes_segments(starts, ends, size)
+        points.append((np.log(1 / size), np.log(count)))
+
+    return fit_line(points).slope
+
+
+def get_state_roughness_vector(path, min_boxes=MIN_BOXES,
+                               max_boxes=MAX_BOXES, scales=VECTOR_SCALES):
+    """
+    get_state_roughness_vector() | compiles list of state roughness from
+        the borders in a GeoJSON file, see get_vector_power()
+    path      | (str) path to the GeoJSON file
+    min_boxes | (float) (default = MIN_BOXES) see get_vector_power()
+    max_boxes | (float) (default = MAX_BOXES) see get_vector_power()
+    scales    | (int) (default = VECTOR_SCALES) see get_vector_power()
+    returns | list((str, float)) | [("State Name", 1.1), ...]
+    """
+    vals = []
+    for name, rings in read_state_borders(path).items():
+        power = get_vector_power(rings, min_boxes, max_boxes, scales)
+        print(name, power)
         vals.append((name, power))
     return vals
 
 
-def plot_state_roughness(powers, path):
+def plot_state_roughness(powers, path, vmin=1.8, vmax=1.9):
     """
     plot_state_roughness() | plots the roughness of each state over a map of
         the continental US
     powers  | list((str, float)) power data per state in the form of
         [("State Name", 1.76), ...] (obtained from get_state_roughness)
     path    | the full path to save the resulting plot
+    vmin    | (float) (default = 1.8) power at the bottom of the color scale,
+        None uses the smallest power
+    vmax    | (float) (default = 1.9) power at the top of the color scale,
+        None uses the largest power
     returns | None | Saves image to specified path
     """
+    # only needed to draw the map, the rest of the module works without it
+    import geopandas as gpd
+
     df = gpd.read_file(USA_GEO)
 
     df["power"] = 0
@@ -59,7 +168,7 @@ def plot_state_roughness(powers, path):
 
     df = df[(df['NAME'] != 'Alaska') & (df['NAME'] != 'Hawaii') &
             (df["NAME"] != 'Puerto Rico')]
-    df.plot(column="power", vmin=1.8, vmax=1.9, legend=True)
+    df.plot(column="power", vmin=vmin, vmax=vmax, legend=True)
 
     plt.title("Border Smoothness per State")
     plt.axis("off")
@@ -67,13 +176,31 @@ def plot_state_roughness(powers, path):
 
 
 def main():
-    # takes about 40 minutes
-    vals = get_state_roughness("state_borders")
+    parser = argparse.ArgumentParser(
+        description="plots the roughness of each state's border")
+    parser.add_argument("--vector", action="store_true",
+                        help="count boxes from the GeoJSON borders instead "
+                             "of the images in state_borders")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.vector:
+        # takes a few seconds
+        vals = get_state_roughness_vector(USA_GEO)
+        path = "plts/state_roughness_vector.png"
+        vmin = vmax = None
+    else:
+        # takes about 40 minutes
+        vals = get_state_roughness("state_borders",
+                                   cache=ResultCache("results_cache.sqlite"))
+        path = "plts/state_roughness.png"
+        vmin, vmax = 1.8, 1.9
     print("="*20)
     print(vals)
+    print(f"{time.perf_counter() - start:.1f} seconds")
     print("="*20)
 
-    plot_state_roughness(vals, "plts/state_roughness.png")
+    plot_state_roughness(vals, path, vmin, vmax)
 
 
 if "__main__" in __name__:
@@ -5,15 +5,46 @@ Section AD
 This module provides tests for all .py files in this project
 """
 
+import gc
+import os
+import json
 import math
+import time
+import tempfile
+import threading
+import warnings
+from unittest import mock
 import numpy as np
 import pandas as pd
+import requests
 from PIL import Image
 from multiprocessing import Process, Array
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
-from ImageTools import check_similarity, scaleImage, to_mono
+from ImageTools import (check_similarity, scaleImage, to_mono, read_bands,
+                        perceptual_hash, hash_distance)
+from DedupeIndex import DedupeIndex, find_duplicates
 import compileImages
-from Fractal import Fractal
+from HttpStore import HttpStore, request_key
+from TensorCache import (TensorCache, split_indices, find_images,
+                         decode_batches, decode_image)
+from BoxSignature import (signature, get_signatures, LogisticRegression,
+                          evaluate)
+import Fractal as fractal_module
+from Fractal import (Fractal, fit_line, analyze_many, _scale_count_worker,
+                     set_counting_threads, _get_reduction)
+from concurrent.futures import ThreadPoolExecutor
+from ResultCache import ResultCache, hash_file
+from benchmarks import find_regressions, time_call
+from Metrics import image_bytes
+from roughness import (read_state_borders, border_segments,
+                       get_vector_power, get_state_roughness_vector)
+from PackedMask import PackedMask
+from BoxCounting import (foreground_mask, count_boxes, integral_image,
+                         count_boxes_integral, box_occupancy,
+                         occupancy_pyramid, pyramid_occupancy,
+                         count_boxes_parallel, segment_cells,
+                         count_boxes_segments, foreground_coords)
 
 # taken from CSE163 utils
 TOLERANCE = 0.001
@@ -85,6 +116,91 @@ def assert_equals(expected, received):
     assert check_approx_equals(expected, received), err_msg
 
 
+class _StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves the test images for test_downloads(), without a network
+        /<name>.png | the file test_imgs/<name>.png
+        /flaky.png  | 503 the first time, then test_imgs/circle.png
+        /slow.png   | test_imgs/circle.png after 1 second
+        /text.png   | a file that is not an image
+        /endless.png | test_imgs/circle.png followed by 8MB, with no
+            Content-Length
+        /big.png    | a Content-Length of 1GB
+        anything else is a 404
+    """
+    requests = {}
+
+    def do_GET(self):
+        _StubHandler.requests[self.path] = (
+            _StubHandler.requests.get(self.path, 0) + 1)
+
+        body = None
+        path = "test_imgs" + self.path
+        if self.path == "/flaky.png":
+            if _StubHandler.requests[self.path] == 1:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            path = "test_imgs/circle.png"
+        elif self.path == "/slow.png":
+            time.sleep(1)
+            path = "test_imgs/circle.png"
+        elif self.path == "/text.png":
+            body = b"not an image"
+        elif self.path == "/endless.png":
+            self.send_response(200)
+            self.end_headers()
+            with open("test_imgs/circle.png", "rb") as f:
+                self.wfile.write(f.read())
+            try:
+                for _ in range(128):
+                    self.wfile.write(bytes(1 << 16))
+            except OSError:
+                pass
+            return
+        elif self.path == "/big.png":
+            self.send_response(200)
+            self.send_header("Content-Length", str(1 << 30))
+            self.end_headers()
+            return
+
+        if body is None and os.path.isfile(path):
+            with open(path, "rb") as f:
+                body = f.read()
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            # the client gave up, such as after a timeout
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+# the real _analyze_process(), before test_fractal() patches it
+_analyze_process = fractal_module._analyze_process
+
+
+def _slow_analyze_process(path, kwargs, conn, jobs):
+    """
+    _slow_analyze_process() | analyze_many()'s worker, except that
+        test_imgs/circle.png never finishes
+    """
+    if path == "test_imgs/circle.png":
+        time.sleep(60)
+    _analyze_process(path, kwargs, conn, jobs)
+
+
 def test_image_tools():
     """
     tests for ImageTools.py
@@ -113,6 +229,46 @@ def test_image_tools():
 
     assert_equals(1, check_similarity(circle_mono_calc, circle_mono))
 
+    # a threshold stops comparing once the images can not be similar enough
+    counting = Image.open("test_imgs/counting_circle.png")
+    assert_equals(0.611264, check_similarity(circle, counting))
+    assert_equals(True, check_similarity(circle, counting, 0.99) < 0.99)
+    assert_equals(1, check_similarity(circle, circle_copy, 0.99))
+
+    # copies of an image have the same perceptual hash, other images do not
+    assert_equals(perceptual_hash(circle), perceptual_hash(circle_scaled))
+    assert_equals(0, hash_distance(perceptual_hash(circle),
+                                   perceptual_hash(circle_mono)))
+    assert_equals(28, hash_distance(perceptual_hash(circle),
+                                    perceptual_hash(blue)))
+
+    # bands of an uncompressed image are read without decoding the rest,
+    # compressed images are only read whole when they fit
+    with tempfile.TemporaryDirectory() as dir:
+        path = dir + "/circle.ppm"
+        circle.convert("RGB").save(path)
+        bands = list(read_bands(path, 300, max_bytes=300 * 1000 * 3))
+        assert_equals([0, 300, 600, 900], [y0 for y0, band in bands])
+        joined = np.concatenate([np.asarray(band) for y0, band in bands])
+        expected = np.asarray(circle.convert("RGB"))
+        assert_equals(True, (joined == expected).all())
+
+        try:
+            list(read_bands("test_imgs/circle.png", 300, max_bytes=1000))
+            assert False, "compressed image larger than max_bytes was read"
+        except ValueError:
+            pass
+
+        # bottom to top BMP rows, and the file is closed once read
+        path = dir + "/circle.bmp"
+        circle.convert("RGB").save(path)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", ResourceWarning)
+            bands = list(read_bands(path, 300, max_bytes=1))
+            gc.collect()
+        joined = np.concatenate([np.asarray(band) for y0, band in bands])
+        assert_equals(True, (joined == expected).all())
+
 
 def test_compile_images():
     """
@@ -145,12 +301,35 @@ def test_compile_images():
     text = compileImages.parse_image_html("""extra\n<img src="//test.com">""")
     assert_equals("https://test.com", text)
 
-    # get_image_from_url
+    # parse_fractals
+    html = ("<table>\n<tr>\n<td>0.5</td>\n<td>0.6309</td>\n"
+            "<td><a href=\"x\">Cantor set</a></td>\n"
+            "<td><img src=\"//test.com/c.png\"></td>\n</tr>\n</table>")
+    assert_equals([("Cantor set", 0.6309, "https://test.com/c.png")],
+                  compileImages.parse_fractals(html))
+
+    # get_image_from_url, replayed from a store so no network is needed
     google = Image.open("test_imgs/google.png")
     URL = "https://www.google.com/images/branding/googlelogo/2x/"
     URL += "googlelogo_light_color_272x92dp.png"
-    downloaded = compileImages.get_image_from_url(URL)
-    assert_equals(1, check_similarity(google, downloaded))
+    with tempfile.TemporaryDirectory() as dir:
+        with HttpStore(dir) as store, open("test_imgs/google.png", "rb") as f:
+            store.put(request_key(URL), URL, f.read())
+        with HttpStore(dir, offline=True) as store:
+            downloaded = compileImages.get_image_from_url(URL, store=store)
+            assert_equals(1, check_similarity(google, downloaded))
+
+            # get_page, a page that can not be downloaded is skipped
+            session = mock.Mock()
+            session.get.side_effect = requests.ConnectionError("offline")
+            assert_equals(None, compileImages.get_page(URL + "x", session))
+            assert_equals(None, compileImages.get_page(URL + "x", session,
+                                                       store))
+            session.get.side_effect = None
+            session.get.return_value = mock.Mock(status_code=200,
+                                                 content=b"<p>page</p>")
+            assert_equals("<p>page</p>",
+                          compileImages.get_page(URL + "x", session))
 
     # format_file_name
     text = compileImages.format_file_name("test\\image")
@@ -161,6 +340,327 @@ def test_compile_images():
     assert_equals("Cimportantstufftest", text)
 
 
+def test_downloads():
+    """
+    tests for the downloads in compileImages.py, against a local server
+    """
+    print("Testing Downloads")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        session = compileImages.make_session(max_workers=4, retries=1,
+                                             backoff=0)
+        urls = [url + "/circle.png", url + "/missing.png", url + "/text.png",
+                url + "/flaky.png", url + "/slow.png", url + "/fractal.png",
+                url + "/circle.png", None]
+        with session:
+            images = compileImages.download_images(urls, session, 4,
+                                                   timeout=(1, 0.2))
+
+        # in order, and converted to black and white
+        assert_equals(urls, [link for link, _ in images])
+        circle = to_mono(Image.open("test_imgs/circle.png"))
+        assert_equals(1, check_similarity(circle, images[0][1]))
+        assert_equals("1", images[5][1].mode)
+        # 404, not an image, and no url
+        assert_equals(None, images[1][1])
+        assert_equals(None, images[2][1])
+        assert_equals(None, images[7][1])
+        # a 503 is retried, a read timeout gives up after its retry
+        assert_equals(1, check_similarity(circle, images[3][1]))
+        assert_equals(2, _StubHandler.requests["/flaky.png"])
+        assert_equals(None, images[4][1])
+        assert_equals(2, _StubHandler.requests["/slow.png"])
+
+        # the second circle and the flaky circle are duplicates of the first
+        with tempfile.TemporaryDirectory() as dir:
+            saved = compileImages.save_images("test", 1.5, images, dir)
+            assert_equals([f"{dir}/(1.5)test.png", f"{dir}/(1.5)test_1.png"],
+                          saved)
+            assert_equals(1, check_similarity(images[5][1],
+                                              Image.open(saved[1])))
+
+        # rejected from their Content-Length, header, and size
+        get = compileImages.get_image_from_url
+        start = time.perf_counter()
+        assert_equals(None, get(url + "/big.png"))
+        assert_equals(None, get(url + "/endless.png", max_pixels=1000))
+        assert_equals(None, get(url + "/endless.png", max_bytes=1 << 20))
+        assert_equals(True, time.perf_counter() - start < 5)
+
+        # reduced while decoding, JPEGs and PNGs
+        img = get(url + "/circle.png", max_side=300)
+        assert_equals((300, 300), img.size)
+        img = get(url + "/red.jpg", max_side=8)
+        assert_equals(True, max(img.size) <= 8)
+        assert_equals((1000, 1000), get(url + "/circle.png").size)
+
+        # recorded, then replayed without downloading
+        with tempfile.TemporaryDirectory() as dir:
+            with HttpStore(dir) as store:
+                assert_equals((1000, 1000),
+                              get(url + "/circle.png", store=store).size)
+            count = _StubHandler.requests["/circle.png"]
+            with HttpStore(dir, offline=True) as store:
+                assert_equals((1000, 1000),
+                              get(url + "/circle.png", store=store).size)
+                assert_equals(None, get(url + "/fractal.png", store=store))
+            assert_equals(count, _StubHandler.requests["/circle.png"])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_store():
+    """
+    tests for HttpStore.py
+    """
+    print("Testing Http Store")
+    assert_equals(request_key("a", {"x": 1, "y": 2}),
+                  request_key("a", {"y": 2, "x": 1}))
+    assert_equals(False, request_key("a") == request_key("b"))
+
+    fetches = []
+
+    def fetch(body):
+        def f():
+            fetches.append(body)
+            return body
+        return f
+
+    with tempfile.TemporaryDirectory() as dir:
+        with HttpStore(dir) as store:
+            assert_equals(None, store.get("a"))
+            assert_equals(b"1", store.load("a", "url a", fetch(b"1")))
+            assert_equals(b"1", store.load("a", "url a", fetch(b"2")))
+            assert_equals([b"1"], fetches)
+            # failed fetches are not stored
+            assert_equals(None, store.load("b", "url b", fetch(None)))
+            assert_equals(None, store.get("b"))
+
+            # the same body is only stored once
+            store.put("b", "url b", b"1")
+            assert_equals(1, len(os.listdir(os.path.join(dir, "objects"))))
+            assert_equals(0, store.prune())
+
+            # expired bodies are fetched again
+            time.sleep(0.01)
+            assert_equals(None, store.get("a", ttl=0.001))
+            assert_equals(b"3", store.load("a", "url a", fetch(b"3"),
+                                           ttl=0.001))
+            store.put("b", "url b", b"3")
+            assert_equals(1, store.prune())
+
+        # offline replays expired bodies, and never fetches
+        with HttpStore(dir, offline=True) as store:
+            assert_equals(b"3", store.load("a", "url a", fetch(b"4"),
+                                           ttl=0.001))
+            assert_equals(None, store.load("c", "url c", fetch(b"4")))
+
+        with HttpStore(dir, refresh=True) as store:
+            assert_equals(b"5", store.load("a", "url a", fetch(b"5")))
+
+    assert_equals([b"1", None, b"3", b"5"], fetches)
+
+    # search errors are not stored, results are
+    images = {"images_results": [{"original": "a.png"}, {}]}
+    with tempfile.TemporaryDirectory() as dir, HttpStore(dir) as store, \
+            mock.patch("compileImages.GoogleSearch") as search:
+        search.return_value.get_dict.side_effect = [
+            {"error": "out of searches"}, images]
+        assert_equals([], compileImages.get_alternative_images("a", store))
+        assert_equals(["a.png"],
+                      compileImages.get_alternative_images("a", store))
+        assert_equals(["a.png"],
+                      compileImages.get_alternative_images("a", store))
+        assert_equals(2, search.call_count)
+
+
+def test_tensor_cache():
+    """
+    tests for TensorCache.py
+    """
+    print("Testing Tensor Cache")
+    with tempfile.TemporaryDirectory() as dir:
+        for label, files in [("b", ["circle.png", "blue.png"]),
+                             ("a", ["fractal.png"])]:
+            os.makedirs(os.path.join(dir, "images", label))
+            for file in files:
+                Image.open("test_imgs/" + file).save(
+                    os.path.join(dir, "images", label, file))
+
+        cache = TensorCache(os.path.join(dir, "images"),
+                            os.path.join(dir, "cache"), (20, 10))
+        assert_equals(False, cache.is_valid())
+        images, labels, classes = cache.load()
+        assert_equals(True, cache.is_valid())
+        assert_equals(["a", "b"], classes)
+        assert_equals([0, 1, 1], labels.tolist())
+        assert_equals((3, 20, 10, 1), images.shape)
+        assert_equals(np.dtype(np.uint8), images.dtype)
+        assert_equals(True, isinstance(images, np.memmap))
+        expected = Image.open("test_imgs/circle.png").convert("L").resize(
+            (10, 20), Image.BILINEAR)
+        assert_equals(True, (np.asarray(expected) == images[2, :, :, 0])
+                      .all())
+
+        # changing a source image invalidates the cache
+        path = os.path.join(dir, "images", "b", "blue.png")
+        Image.open("test_imgs/circle.png").save(path)
+        os.utime(path, ns=(0, 0))
+        assert_equals(False, cache.is_valid())
+        images, labels, classes = cache.load()
+        assert_equals(True, cache.is_valid())
+        assert_equals(True, (images[2] == images[1]).all())
+
+        # images to classify are found in sub directories, and decoded in
+        # batches, the last one padded with zeros
+        with open(os.path.join(dir, "images", "a", "notes.txt"), "w") as f:
+            f.write("not an image")
+        paths = find_images(os.path.join(dir, "images"))
+        assert_equals([os.path.join(dir, "images", *parts) for parts in
+                       [("a", "fractal.png"), ("b", "blue.png"),
+                        ("b", "circle.png")]], paths)
+        batches = list(decode_batches(paths, 2, (20, 10), threads=2))
+        assert_equals([paths[:2], paths[2:]], [b for b, _ in batches])
+        assert_equals([(2, 20, 10, 1)] * 2, [b.shape for _, b in batches])
+        assert_equals(True, (batches[1][1][0]
+                             == decode_image(paths[2], (20, 10))).all())
+        assert_equals(0, int(batches[1][1][1].max()))
+        assert_equals([], list(decode_batches([], 2, (20, 10))))
+
+    train, validate = split_indices(10, 0.2, seed=1)
+    assert_equals(2, len(validate))
+    assert_equals(list(range(10)), sorted(train.tolist() + validate.tolist()))
+    assert_equals(validate.tolist(), split_indices(10, 0.2, 1)[1].tolist())
+
+
+def test_ml():
+    """
+    tests for ml.py, skipped if tensorflow is not installed
+    """
+    print("Testing ML")
+    try:
+        import ml
+    except ImportError:
+        print("skipped, tensorflow is not installed")
+        return
+
+    with tempfile.TemporaryDirectory() as dir:
+        for label, files in [("b", ["circle.png", "blue.png"]),
+                             ("a", ["fractal.png"])]:
+            os.makedirs(os.path.join(dir, "images", label))
+            for file in files:
+                Image.open("test_imgs/" + file).save(
+                    os.path.join(dir, "images", label, file))
+
+        cache = TensorCache(os.path.join(dir, "images"),
+                            os.path.join(dir, "cache"), (20, 10))
+        images, labels, classes = cache.load()
+
+        ds = ml.make_dataset(images, labels, np.arange(3), classes,
+                             batch_size=2)
+        img_spec, label_spec = ds.element_spec
+        assert_equals([None, 20, 10, 1], img_spec.shape.as_list())
+        assert_equals([None, 2], label_spec.shape.as_list())
+        batches = [(img.numpy(), label.numpy()) for img, label in ds]
+        assert_equals([2, 1], [len(img) for img, _ in batches])
+        assert_equals(True, (batches[0][0] == images[:2]).all())
+        assert_equals([[1, 0], [0, 1]], batches[0][1].tolist())
+
+        # a trained model is saved, exported, loaded and classifies an image
+        cache = TensorCache(os.path.join(dir, "images"),
+                            os.path.join(dir, "cache_full"), ml.IMAGE_SIZE)
+        images, labels, classes = cache.load()
+        model = ml.build_model(len(classes))
+        model.fit(ml.make_dataset(images, labels, np.arange(3), classes),
+                  epochs=1, verbose=0)
+        models = os.path.join(dir, "models")
+        os.makedirs(models)
+        model.save(os.path.join(models, ml.MODEL_FILE))
+        with open(os.path.join(models, ml.CLASSES_FILE), "w") as f:
+            json.dump(classes, f)
+        ml.export_tflite(model, images, np.arange(3),
+                         os.path.join(models, ml.TFLITE_FILE))
+
+        path = "test_imgs/circle.png"
+        for keras_model in [False, True]:
+            results, rate = ml.classify([path], models, batch_size=4,
+                                        threads=1, keras_model=keras_model)
+            assert_equals(1, len(results))
+            assert_equals(path, results[0][0])
+            assert_equals(True, results[0][1] in classes)
+            assert_equals(True, 0 <= results[0][2] <= 1)
+        # tensorflow has started, so the threads can not change anymore
+        assert_equals(False, ml._set_threads(1))
+
+
+def test_box_signature():
+    """
+    tests for BoxSignature.py
+    """
+    print("Testing Box Signature")
+    # counts that scale exactly with the square of the factor
+    data = [(0.25, 16), (0.5, 64), (1.0, 256)]
+    features = signature(data)
+    assert_equals(9, len(features))
+    assert_equals(math.log(256), features[2])
+    assert_equals(2.0, features[3])
+    assert_equals(1.0, features[5])
+    assert_equals(True, np.allclose(features[6:], 0))
+
+    features = get_signatures(["test_imgs/circle.png", "README.md",
+                               "test_imgs/fractal.png"], jobs=2)
+    assert_equals(3, len(features))
+    assert_equals(True, np.isnan(features[1]).all())
+    assert_equals(False, np.isnan(features[[0, 2]]).any())
+
+    # separable by the first feature, the second is noise
+    rng = np.random.default_rng(0)
+    x = np.column_stack([np.r_[rng.normal(-2, 1, 50), rng.normal(2, 1, 50)],
+                         rng.normal(0, 1, 100), np.ones(100)])
+    y = np.r_[np.zeros(50), np.ones(50)]
+    model = LogisticRegression().fit(x, y)
+    assert_equals(True, np.mean(model.predict(x) == y) > 0.95)
+    assert_equals(True, model.predict_proba([[4, 0, 1]])[0] > 0.99)
+    assert_equals([0, 1], model.predict([[-4, 0, 1], [4, 0, 1]]).tolist())
+    try:
+        LogisticRegression().predict(x)
+        assert_equals(True, False)
+    except ValueError:
+        pass
+
+    with tempfile.TemporaryDirectory() as dir:
+        for label, files in [("a", ["circle.png", "circle_scaled.png",
+                                    "circle_mono.png"]),
+                             ("b", ["fractal.png", "blue.png", "red.jpg"])]:
+            os.makedirs(os.path.join(dir, label))
+            for file in files:
+                Image.open("test_imgs/" + file).save(
+                    os.path.join(dir, label, file))
+
+        result = evaluate(dir, jobs=1, validation_split=0.5)
+        assert_equals(3, result["images"])
+        assert_equals(0, result["skipped"])
+        assert_equals(True, 0 <= result["accuracy"] <= 1)
+
+        # nothing to fit or validate on is an error, not a NaN accuracy
+        counted = np.arange(27.0).reshape(3, 9)
+        uncounted = np.full((3, 9), np.nan)
+        for features, message in [([uncounted], "training"),
+                                  ([counted, uncounted], "validation")]:
+            with mock.patch("BoxSignature.get_signatures",
+                            side_effect=features):
+                try:
+                    evaluate(dir, validation_split=0.5)
+                    assert False, "expected a ValueError"
+                except ValueError as e:
+                    assert_equals(f"none of the {message} images could be "
+                                  f"counted", str(e))
+
+
 def test_fractal():
     """
     tests for Fractal.py
@@ -171,11 +671,134 @@ def test_fractal():
 
     assert_equals((0, 0, 0, 255), f._get_background_color(f._img))
 
+    f.set_background_strategy("border")
+    assert_equals((0, 0, 0, 255), f._get_background_color(f._img))
+    f.set_background_strategy("luminance", threshold=50)
+    assert_equals(0, f._get_background_color(f._img))
+    f.set_background_strategy("frequent")
+
+    # the background is detected once and kept on the Fractal
+    mono = Fractal("test_imgs/circle_mono.png")
+    mono.set_background_strategy("luminance")
+    expected = mono._count_non_background_pixels(mono._img)
+    mono.set_background_strategy("frequent")
+    assert_equals(expected, mono._count_non_background_pixels(mono._img))
+    assert_equals(0, mono._background)
+
     assert_equals([0, 1, 1000, 1001], f._get_square_indicies(f._img, 0, 0))
     assert_equals([999, 1999], f._get_square_indicies(f._img, 999, 0))
 
     assert_equals(1, f2._count_non_background_pixels(f2._img))
 
+    # the numpy engine should match the original loop, including the
+    # partial squares on the right and bottom edges
+    odd = scaleImage(f._img, (1003, 997))
+    for size in [2, 3, 30]:
+        f.set_sample_size(size)
+        f.set_counting_engine("python")
+        expected = f._count_non_background_pixels(odd)
+        f.set_counting_engine("numpy")
+        assert_equals(expected, f._count_non_background_pixels(odd))
+        f.set_counting_engine("sparse")
+        assert_equals(expected, f._count_non_background_pixels(odd))
+    f.set_sample_size(2)
+
+    # the sparse engine is picked for images that are almost all background
+    f.set_counting_engine("auto")
+    assert_equals("numpy", f._get_engine(original=True))
+    assert_equals("sparse", f2._get_engine(original=True))
+    # scaled copies are always counted with numpy
+    assert_equals("numpy", f2._get_engine())
+    assert_equals("numpy", f2._get_settings()["_engine"])
+    expected = f._get_scaling_data_integral(0.5, 2.6, 0.3)
+    f.set_counting_engine("sparse")
+    assert_equals(expected, f._get_scaling_data_integral(0.5, 2.6, 0.3))
+    f.set_counting_engine("auto")
+
+    # so auto is never slower than numpy on a sparse image, 1% foreground
+    pixels = np.zeros((1000, 1000), dtype=np.uint8)
+    pixels[np.random.default_rng(0).random(pixels.shape) < 0.01] = 255
+    with tempfile.TemporaryDirectory() as dir:
+        path = os.path.join(dir, "sparse.png")
+        Image.fromarray(pixels).convert("RGB").save(path)
+        seconds = {}
+        for engine in ["numpy", "auto"]:
+            runs = []
+            for _ in range(3):
+                sparse = Fractal(path)
+                sparse.set_counting_engine(engine)
+                start = time.perf_counter()
+                sparse.calculate_power(0.2, 1, 0.2)
+                runs.append(time.perf_counter() - start)
+            seconds[engine] = min(runs)
+    # with some room for timing noise
+    assert_equals(True, seconds["auto"] < seconds["numpy"] * 1.25)
+
+    # summed-area counts match the mask counts for whole box sizes
+    mask = foreground_mask(odd, f._get_background_color(odd))
+    table = integral_image(mask)
+    for size in [1, 2, 7, 64]:
+        assert_equals(count_boxes(mask, size),
+                      count_boxes_integral(table, size))
+    assert_equals(1, count_boxes_integral(table, 2000))
+    assert_equals([(1, 1), (2, 1)], f2._get_scaling_data_integral(1, 3, 1))
+
+    # bands of whole box rows can be counted on separate threads
+    with ThreadPoolExecutor(3) as executor:
+        for size in [1, 2, 7, 64, 2000]:
+            assert_equals(count_boxes(mask, size),
+                          count_boxes_parallel(mask, size, executor, 3))
+    big = scaleImage(f._img, (1500, 1500))
+    expected = f._count_non_background_pixels(big)
+    set_counting_threads(4)
+    assert_equals(expected, f._count_non_background_pixels(big))
+    set_counting_threads(None)
+
+    # every box size can be read from the pyramid of power of two sizes
+    pyramid = occupancy_pyramid(mask)
+    assert_equals((1, 1), pyramid[-1].shape)
+    for size in [1, 2, 3, 8, 12, 2000]:
+        expected = box_occupancy(mask, size)
+        assert_equals(True, (expected == pyramid_occupancy(pyramid, size))
+                      .all())
+    assert_equals(f._get_scaling_data_integral(1, 3, 1),
+                  f._get_scaling_data_pyramid(1, 3))
+    assert_equals([1.0, 2.0, 4.0],
+                  [x for x, y in f._get_scaling_data_pyramid(0.7, 5)])
+
+    # segments are counted from the grid lines they cross, without drawing
+    assert_equals(4, count_boxes_segments([[0.5, 0.5]], [[3.5, 0.5]], 1))
+    assert_equals(3, count_boxes_segments([[0, 0]], [[3, 3]], 1))
+    assert_equals(1, count_boxes_segments([[1, 1]], [[1, 1]], 1))
+    square = np.array([[0.5, 0.5], [3.5, 0.5], [3.5, 3.5], [0.5, 3.5],
+                       [0.5, 0.5]])
+    assert_equals(12, count_boxes_segments(square[:-1], square[1:], 1))
+    assert_equals(1, count_boxes_segments(square[:-1], square[1:], 4))
+    rng = np.random.default_rng(0)
+    starts = rng.uniform(0, 20, (30, 2))
+    ends = rng.uniform(0, 20, (30, 2))
+    for size in [0.7, 1, 3]:
+        cols, rows = segment_cells(starts, ends, size)
+        t = np.linspace(0, 1, 20000)[:, np.newaxis, np.newaxis]
+        points = (starts + (ends - starts) * t).reshape(-1, 2)
+        sampled = set(map(tuple, np.floor(points / size).astype(int)
+                          .tolist()))
+        # sampling can step over a cell the segment only clips
+        found = set(zip(cols.tolist(), rows.tolist()))
+        assert_equals(True, sampled <= found)
+        assert_equals(True, len(found - sampled) <= 2)
+
+    # reading the image in bands gives the same counts as the whole image
+    with tempfile.TemporaryDirectory() as dir:
+        for ext in ["ppm", "bmp"]:
+            odd.convert("RGB").save(f"{dir}/odd.{ext}")
+            whole = Fractal(f"{dir}/odd.{ext}")
+            tiled = Fractal(f"{dir}/odd.{ext}")
+            tiled.set_memory_budget(50000)
+            assert_equals(whole._get_scaling_data_integral(0.5, 2.6, 0.3),
+                          tiled._get_scaling_data_tiled(0.5, 2.6, 0.3))
+            assert_equals(whole._get_background(), tiled._background)
+
     assert_equals(0, f._get_num_places(10))
     assert_equals(1, f._get_num_places(0.1))
     assert_equals(2, f._get_num_places(0.01))
@@ -196,21 +819,209 @@ def test_fractal():
     p.join()
     assert_equals([1, 1], list(arr))
 
+    # workers only receive a handle to the image in shared memory
+    job = (f2._get_shared_image(), f2._get_settings(), 2)
+    assert_equals((2, 11), _scale_count_worker(job))
+    factor, count, phases = _scale_count_worker(job + (True,))
+    assert_equals((2, 11), (factor, count))
+    assert_equals(["resize", "count"], list(phases))
+
+    # the image is only decoded when it is needed, and released after if
+    # asked to
+    lazy = Fractal("test_imgs/circle.png")
+    assert_equals(((1000, 1000), "RGBA"), lazy._get_header())
+    assert_equals(None, lazy._image)
+    lazy.calculate_power(1, 3, 1, method="tiled", release=True)
+    assert_equals(None, lazy._image)
+    assert_equals((75, 75), Fractal("test_imgs/red.jpg")._decode(4).size)
+    assert_equals((500, 500), lazy._decode(2).size)
+    assert_equals(2, _get_reduction([0.1, 0.2]))
+    assert_equals(5, _get_reduction([0.05, 0.1]))
+    assert_equals(1, _get_reduction([0.2, 0.3]))
+    full = lazy.calculate_power(0.1, 0.3, 0.1, release=True)
+    reduced = lazy.calculate_power(0.1, 0.3, 0.1, reduce=True, release=True)
+    assert_equals(True, abs(full - reduced) < 0.02)
+    assert_equals(None, lazy._image)
+    # bilevel images are decoded whole even when reduced
+    bilevel = Fractal("imgs/(1.585)Sierpinski_triangle_6.png")
+    assert_equals("1", bilevel._decode(2).mode)
+    assert_equals(bilevel._get_header()[0], bilevel._decode(2).size)
+
+    # a reduced run never decodes the original, and nothing image sized is
+    # kept after it
+    lazy = Fractal("test_imgs/circle.png")
+    with mock.patch.object(Fractal, "_decode", autospec=True,
+                           side_effect=Fractal._decode) as decode:
+        lazy.calculate_power(0.1, 0.3, 0.1, reduce=True, release=True)
+    decode.assert_called_once_with(lazy, 2)
+    assert_equals([None] * 5, [lazy._image, lazy._mask, lazy._coords,
+                               lazy._integral, lazy._pyramid])
+    lazy.calculate_power(1, 3, 1, method="pyramid", release=True)
+    assert_equals(None, lazy._pyramid)
+
+    # without release the pyramid and summed-area table are reused
+    lazy = Fractal("test_imgs/circle.png")
+    lazy.calculate_power(1, 3, 1, method="pyramid")
+    pyramid = lazy._pyramid
+    lazy.calculate_power(1, 3, 1, method="integral")
+    integral = lazy._integral
+    lazy.calculate_power(1, 5, 1, method="pyramid")
+    lazy.calculate_power(1, 5, 1, method="integral")
+    assert_equals(True, lazy._pyramid is pyramid)
+    assert_equals(True, lazy._integral is integral)
+    # and a reduced decode is only used by the call that asked for it
+    reduced = lazy.calculate_power(0.1, 0.3, 0.1, reduce=True)
+    assert_equals(full, lazy.calculate_power(0.1, 0.3, 0.1))
+
+    # adaptive scales stop once the slope is known well enough, counting a
+    # few factors over the whole range first, smallest first
+    power = f.calculate_power(method="integral", adaptive=True)
+    assert_equals(6, f.get_last_scale_count())
+    assert_equals(1.983, round(power, 3))
+    assert_equals([1.0, 1.38, 1.904, 2.627, 3.624, 4.613],
+                  [round(x, 3) for x, _ in f.get_last_scaling_data()])
+    passes = fractal_module._coarse_to_fine(20)
+    assert_equals([[0, 4, 8, 12, 16, 19], [2, 6, 10, 14, 18],
+                   list(range(1, 19, 2))], passes)
+    assert_equals([[0, 1]], fractal_module._coarse_to_fine(2))
+
+    # so the resizes grow gradually, the largest one ends the first pass
+    scaled = Fractal("test_imgs/circle.png")
+    with mock.patch.object(Fractal, "_scale_count", autospec=True,
+                           side_effect=Fractal._scale_count) as scale:
+        scaled.calculate_power(0.05, 0.5, adaptive=True, max_scales=20)
+    counted = [call.args[1] for call in scale.call_args_list]
+    first = len(passes[0])
+    assert_equals(sorted(counted[:first]), counted[:first])
+    assert_equals(max(counted), counted[first - 1])
+
+    for max_scales in [0, 1]:
+        try:
+            f.calculate_power(method="integral", adaptive=True,
+                              max_scales=max_scales)
+            assert False, "a line can not be fit to less than 2 scales"
+        except ValueError as e:
+            assert_equals(f"max_scales must be at least 2 to fit a line, "
+                          f"got {max_scales}", str(e))
+    f.calculate_power(method="integral", adaptive=True, max_scales=2)
+    assert_equals(2, f.get_last_scale_count())
+
+    # on real fractals the adaptive power stays close to the full fit,
+    # instead of following the slope of only the smallest factors
+    for name in ["(1.0)SmithVolterraCantor_set_1.png",
+                 "(2.0)Boundary_of_the_Mandelbrot_set_1.png",
+                 "(1.0812)Julia_set_z_14_1.png"]:
+        full = Fractal("imgs/" + name).calculate_power(method="integral")
+        adaptive = Fractal("imgs/" + name).calculate_power(
+            method="integral", adaptive=True)
+        assert_equals(True, abs(full - adaptive) < 0.1)
+    f.calculate_power(method="integral", adaptive=True, tolerance=0)
+    assert_equals(20, f.get_last_scale_count())
+    try:
+        f.calculate_power(method="tiled", adaptive=True)
+        assert False, "adaptive scales are not supported by tiled"
+    except ValueError:
+        pass
+
+    # each phase of an analysis is measured, and sent to the hook
+    received = []
+    f2.calculate_power(1, 3, 1, method="integral", metrics=received.append)
+    metrics = f2.get_last_metrics()
+    assert_equals([metrics], received)
+    assert_equals(["decode", "background", "count", "fit"],
+                  list(metrics.phases))
+    assert_equals(True, metrics.phases["count"]["peak_bytes"] > 0)
+    assert_equals(1, metrics.workers)
+
+    # PIL's pixel buffers are counted, though tracemalloc can not see them
+    f.calculate_power(1, 1.5, 0.25, metrics=True)
+    metrics = f.get_last_metrics()
+    assert_equals(True, metrics.phases["decode"]["peak_bytes"] >= 1000 * 1000
+                  * len(Image.open("test_imgs/circle.png").getbands()))
+    if metrics.workers == 1:
+        assert_equals(True,
+                      metrics.phases["resize"]["peak_bytes"] >= 1250 * 1250)
+
+    # buffers count every byte of each pixel, not one per band
+    assert_equals(200, image_bytes(Image.new("I;16", (10, 10))))
+    assert_equals(400, image_bytes(Image.new("F", (10, 10))))
+    assert_equals(300, image_bytes(Image.new("RGB", (10, 10))))
+
+    # times alone are measured without tracing memory, a failed analysis
+    # keeps its metrics, and an unmeasured one clears them
+    f2.calculate_power(1, 3, 1, method="integral", metrics="time")
+    metrics = f2.get_last_metrics()
+    assert_equals(None, metrics.phases["count"]["peak_bytes"])
+    assert_equals(True, metrics.phases["count"]["seconds"] > 0)
+    try:
+        f2.calculate_power(1, 1.5, 1, method="integral", metrics="time")
+        assert False, "a power can not be fit to one scale factor"
+    except ValueError:
+        pass
+    assert_equals(True, "count" in f2.get_last_metrics().phases)
+    f2.calculate_power(1, 3, 1, method="integral")
+    assert_equals(None, f2.get_last_metrics())
+
     assert_equals([(2, 11)], f2._get_scaling_data_process(2, 2, 1))
     assert_equals([(1, 1)], f2._get_scaling_data_process(1, 1, 1))
 
-    assert_equals(0, f._get_mean_squared_error([(0, 0), (1, 1), (2, 2)], 1, 0))
-    assert_equals(1, f._get_mean_squared_error([(1, 1)], 0, 0))
-
     assert_equals(1.0, f._calculate_best_slope([(0, 0), (1, 1), (2, 2)]))
     assert_equals(2.0, f._calculate_best_slope([(0, 0), (1, 2), (2, 4)]))
 
+    fit = fit_line([(1, 3), (2, 5), (3, 7)])
+    assert_equals([2.0, 1.0, 1.0, 0.0], list(fit))
+    fit = fit_line([(1, 3), (2, 5), (3, 7)], through_origin=True)
+    assert_equals(0.0, fit.intercept)
+    assert_equals(34 / 14, fit.slope)
+    outlier = [(0, 0), (1, 1), (2, 2), (3, 3), (4, 40)]
+    assert_equals(1.0, fit_line(outlier, robust="theil-sen").slope)
+    # the outlier pulls the least squares slope, but not the huber slope
+    assert_equals(8.2, fit_line(outlier).slope)
+    assert_equals(1.0, fit_line(outlier, robust="huber").slope)
+
+    # one scale factor can not be fit
+    try:
+        f.calculate_power(1, 1.5, 1)
+        assert False, "a power can not be fit to one scale factor"
+    except ValueError as e:
+        assert_equals("a power needs at least 2 scale factors, [1, 1.5) "
+                      "by 1 has 1", str(e))
+
     f3 = Fractal("test_imgs/blue.png")
     assert_equals(0, f3.calculate_power())
 
+    # one bad or slow image does not stop the rest of the batch, the
+    # circle is made slow so the timeout does not depend on the machine
+    paths = ["test_imgs/fractal.png", "test_imgs/blue.png", "README.md",
+             "test_imgs/circle.png"]
+    with mock.patch("Fractal._analyze_process", _slow_analyze_process):
+        results = {path: (power, diagnostics) for path, power, diagnostics
+                   in analyze_many(paths, jobs=2, timeout=5)}
+    assert_equals(sorted(paths), sorted(results.keys()))
+    assert_equals(0, results["test_imgs/blue.png"][0])
+    assert_equals(None, results["README.md"][0])
+    assert_equals("UnidentifiedImageError",
+                  results["README.md"][1]["error"].split(":")[0])
+    assert_equals("timed out after 5 seconds",
+                  results["test_imgs/circle.png"][1]["error"])
+    # each analysis is timed, a failed one up to the phase that failed
+    metrics = results["test_imgs/fractal.png"][1]["metrics"]
+    assert_equals(True, "fit" in metrics.phases)
+    assert_equals(None, metrics.phases["fit"]["peak_bytes"])
+    assert_equals(["decode"],
+                  list(results["README.md"][1]["metrics"].phases))
+
     count = Image.open("test_imgs/counting_circle.png")
     assert_equals(1, check_similarity(count, f.visualize_counting()))
 
+    # the vectorized overlay matches the pixel by pixel one
+    f.set_sample_size(30)
+    vis = f.visualize_counting()
+    f.set_counting_engine("python")
+    assert_equals(1, check_similarity(f.visualize_counting(), vis))
+    f.set_counting_engine("numpy")
+    f.set_sample_size(2)
+
     reg_charts = Image.open("test_imgs/circle_regression.png")
     f.calculate_power(vis=True)
     vis = f.get_last_power_visualization()
@@ -220,10 +1031,181 @@ def test_fractal():
     assert_equals(1000, f._sample_size)
 
 
+def test_result_cache():
+    """
+    tests for ResultCache.py
+    """
+    print("Testing Result Cache")
+    with tempfile.TemporaryDirectory() as dir:
+        cache = ResultCache(dir + "/cache.sqlite")
+
+        f = Fractal("test_imgs/fractal.png")
+        image, params = f._get_cache_key(1, 3, 1, "integral")
+        assert_equals(hash_file("test_imgs/fractal.png"), image)
+        assert_equals(None, cache.get_counts(image, params))
+
+        f.calculate_power(1, 3, 1, method="integral", cache=cache)
+        assert_equals([(1, 1), (2, 1)], cache.get_counts(image, params))
+        assert_equals(0.0, cache.get_power(image, params, "ols"))
+
+        # stored counts are used instead of counting again, even by another
+        # Fractal of the same image, and even with a different fit
+        cache.put_counts(image, params, [(1, 1), (2, 4)])
+        f = Fractal("test_imgs/fractal.png")
+        power = f.calculate_power(1, 3, 1, method="integral",
+                                  estimator="origin", cache=cache)
+        assert_equals(2.0, power)
+        assert_equals(2.0, cache.get_power(image, params, "origin"))
+
+        params["sample_size"] = 3
+        assert_equals(None, cache.get_counts(image, params))
+        cache.close()
+
+
+def test_dedupe_index():
+    """
+    tests for DedupeIndex.py
+    """
+    print("Testing Dedupe Index")
+
+    index = DedupeIndex()
+    for i, image_hash in enumerate([0b0000, 0b0001, 0b0111, 0b1111, 0xff]):
+        index.add(i, image_hash)
+    assert_equals(5, len(index))
+    assert_equals([(0, 0), (1, 1)], index.find(0b0000, 1))
+    assert_equals([(1, 2), (2, 0), (2, 3)], sorted(index.find(0b0110, 2)))
+    assert_equals([], index.find(0xff00, 3))
+    assert_equals(4, index.add_if_new(5, 0xfe, 1))
+    assert_equals(None, index.add_if_new(5, 0xff00, 1))
+    assert_equals(6, len(index))
+
+    paths = ["test_imgs/circle.png", "test_imgs/red.jpg",
+             "test_imgs/circle_scaled.png", "test_imgs/blue.png",
+             "test_imgs/circle_mono.png"]
+    assert_equals({"test_imgs/circle_scaled.png": "test_imgs/circle.png",
+                   "test_imgs/circle_mono.png": "test_imgs/circle.png"},
+                  find_duplicates(paths))
+    # images are only duplicates within their own group
+    assert_equals({"test_imgs/circle_mono.png": "test_imgs/circle.png"},
+                  find_duplicates(paths, group=lambda path: "scaled" in path))
+
+
+def test_packed_mask():
+    """
+    tests for PackedMask.py
+    """
+    print("Testing Packed Mask")
+
+    f = Fractal("test_imgs/circle.png")
+    odd = scaleImage(f._img, (1003, 997))
+    mask = foreground_mask(odd, f._get_background_color(odd))
+    packed = PackedMask.pack(mask)
+
+    assert_equals(True, (mask == packed.unpack()).all())
+    assert_equals(int(np.count_nonzero(mask)), packed.count())
+    # 1 bit per pixel instead of 4 bytes of RGBA
+    assert_equals(True, packed.get_bits().nbytes * 30 < 1003 * 997 * 4)
+
+    for size in [1, 2, 3, 4, 8, 24, 30, 2000]:
+        assert_equals(count_boxes(mask, size), packed.count_boxes(size))
+
+    with tempfile.TemporaryDirectory() as dir:
+        packed.save(dir + "/mask.npz")
+        loaded = PackedMask.load(dir + "/mask.npz")
+        assert_equals((997, 1003), loaded.get_shape())
+        assert_equals(True, (mask == loaded.unpack()).all())
+
+    for size in [1, 2, 3, 8]:
+        assert_equals(True, (box_occupancy(mask, size)
+                             == packed.occupancy(size)).all())
+    ys, xs = packed.nonzero()
+    expected_ys, expected_xs = foreground_coords(mask)
+    assert_equals(True, (ys == expected_ys).all())
+    assert_equals(True, (xs == expected_xs).all())
+
+    # the original image is counted from its packed mask, odd sizes without
+    # the pyramid, which starts at boxes of 2
+    f.set_sample_size(3)
+    assert_equals(count_boxes(f._get_packed_mask().unpack(), 3),
+                  f._count_non_background_pixels(f._img))
+    assert_equals(None, f._pyramid)
+    f.set_sample_size(2)
+    assert_equals(count_boxes(f._get_packed_mask().unpack(), 2),
+                  f._count_non_background_pixels(f._img))
+    assert_equals([None, (500, 500)],
+                  [f._pyramid[0], f._pyramid[1].shape])
+
+
+def test_roughness():
+    """
+    tests for roughness.py, without geopandas
+    """
+    print("Testing Roughness")
+    square = [[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]]
+    features = [
+        {"properties": {"NAME": "Square"},
+         "geometry": {"type": "Polygon", "coordinates": [square]}},
+        {"properties": {"NAME": "Islands"},
+         "geometry": {"type": "MultiPolygon", "coordinates": [
+             [square], [[[x + 5, y] for x, y in square]]]}},
+    ]
+    with tempfile.TemporaryDirectory() as dir:
+        path = os.path.join(dir, "borders.json")
+        with open(path, "w") as f:
+            json.dump({"features": features}, f)
+        borders = read_state_borders(path)
+
+        assert_equals(["Islands", "Square"], sorted(borders))
+        assert_equals(2, len(borders["Islands"]))
+        assert_equals(square, borders["Square"][0].tolist())
+
+        # the edges of each ring, moved so every point is positive
+        starts, ends = border_segments(borders["Square"])
+        assert_equals((4, 2), starts.shape)
+        assert_equals(0.0, float(min(starts.min(), ends.min())))
+        assert_equals(True, np.allclose(starts[1:], ends[:-1]))
+
+        # a smooth border has a dimension of 1
+        assert_equals(True, abs(get_vector_power(borders["Square"]) - 1)
+                      < 0.05)
+        powers = dict(get_state_roughness_vector(path))
+        assert_equals(["Islands", "Square"], sorted(powers))
+        assert_equals(True, abs(powers["Islands"] - 1) < 0.05)
+
+
+def test_benchmarks():
+    """
+    tests for benchmarks.py
+    """
+    print("Testing Benchmarks")
+
+    result = time_call(lambda: None, repeat=2)
+    assert_equals(2, result["repeat"])
+    assert_equals(True, result["min"] <= result["median"])
+
+    baseline = {"results": {"a": {"median": 1.0}, "b": {"median": 1.0},
+                            "c": {"median": 1.0}}}
+    current = {"results": {"a": {"median": 1.2}, "b": {"median": 3.0},
+                           "c": {"median": 1.5}, "d": {"median": 9.0}}}
+    assert_equals([("b", 3.0), ("c", 1.5)],
+                  find_regressions(baseline, current, 0.25))
+    assert_equals([("b", 3.0)], find_regressions(baseline, current, 1))
+
+
 def main():
     test_image_tools()
     test_compile_images()
+    test_downloads()
+    test_http_store()
+    test_tensor_cache()
+    test_ml()
+    test_box_signature()
     test_fractal()
+    test_result_cache()
+    test_dedupe_index()
+    test_packed_mask()
+    test_roughness()
+    test_benchmarks()
 
 
 if "__main__" in __name__: